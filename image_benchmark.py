@@ -0,0 +1,312 @@
+"""Image Repository Benchmark
+
+Reproducible benchmark of the ingest and search hot paths. For every
+database size (1k, 100k and 1M rows by default) it builds a throw-away
+repository in a temporary directory, fills it with synthetic rows whose
+keywords follow a Zipf distribution over a synthetic vocabulary, writes a
+sample of synthetic image files, and measures:
+
+    * encrypt_file - encrypting one sample image file
+    * store_images - storing a directory of sample images into the database
+    * get_dataframe - loading the whole database
+    * search_images - keyword searches for vocabulary terms
+
+Each benchmark reports its throughput, latency percentiles and the peak
+resident memory of the process so far. Every size runs in a fresh process,
+so the peak memory of one size does not leak into the next. Results are
+written as JSON; with --timing (or IMAGE_REPO_TIMING) the per-stage
+timings from image_timing are included.
+
+Run it with:
+
+    python image_benchmark.py [--sizes 1000 100000 1000000] [--output results.json]
+
+This file can be imported as a module and contains the following:
+
+    * make_vocabulary() - the synthetic keyword vocabulary
+    * make_rows() - generates synthetic database rows in batches
+    * make_images() - writes synthetic image files
+    * peak_rss_mb() - peak resident memory of the process
+    * measure() - times repeated calls of an operation
+    * run_size() - runs every benchmark against one database size
+    * run() - runs the benchmarks for several sizes and writes the results
+"""
+
+## Import modules
+import argparse
+import hashlib
+import json
+import os
+import platform
+import sys
+import tempfile
+import time
+import uuid
+from concurrent.futures import ProcessPoolExecutor
+import cv2
+import numpy as np
+import image_timing
+import keith_data_intern_project_3 as repository
+
+try:
+    import resource
+except ImportError: # Windows: no getrusage
+    resource = None
+
+## Constants
+SIZES = [1000, 100000, 1000000]
+SAMPLE_IMAGES = 200 # image files encrypted and stored per size
+IMAGES_PER_STORE = 50 # images per store_images() call
+SEARCHES = 200
+LOAD_REPEATS = 3
+INSERT_BATCH_SIZE = 50000 # synthetic rows per insert_many()
+BUDGET_SECONDS = 60 # a benchmark stops issuing calls once it has run this long
+KEYWORDS_PER_ROW = (1, 6) # uniform number of keywords, upper bound excluded
+ZIPF_EXPONENT = 1.1
+FEATURES = ['red', 'orange', 'yellow', 'green', 'blue', 'purple', 'brown', 'black', 'white', 'gray',
+            'landscape', 'portrait', 'square']
+PUBLIC_FRACTION = 0.9
+BENCHMARK_USER = 'benchmark'
+
+## Functions
+def make_vocabulary(rows):
+    '''
+    :param rows: number of database rows
+    :return: List of keywords, larger for larger databases (at least 100)
+    '''
+    return ['kw%06d' % i for i in range(max(100, rows // 20))]
+
+def zipf_weights(count):
+    '''
+    :param count: number of terms
+    :return: float64 array of term probabilities, most frequent term first
+    '''
+    weights = 1.0 / np.arange(1, count + 1) ** ZIPF_EXPONENT
+    return weights / weights.sum()
+
+def make_rows(count, vocabulary, seed=0, batch_size=INSERT_BATCH_SIZE):
+    '''
+    Generates synthetic rows shaped like the ones image_row() builds. The
+    image_code values are blob references to blobs that don't exist, so
+    the rows can be searched and loaded but not decrypted.
+    :param count: number of rows
+    :param vocabulary: List of keywords (see make_vocabulary())
+    :param seed: random seed, the same seed gives the same rows
+    :param batch_size: rows per batch
+    :return: generator of Lists of dictionaries of column -> value
+    '''
+    rng = np.random.default_rng(seed)
+    vocabulary = np.array(vocabulary)
+    weights = zipf_weights(len(vocabulary))
+    for start in range(0, count, batch_size):
+        size = min(batch_size, count - start)
+        lengths = rng.integers(KEYWORDS_PER_ROW[0], KEYWORDS_PER_ROW[1], size)
+        terms = vocabulary[rng.choice(len(vocabulary), int(lengths.sum()), p=weights)]
+        features = rng.choice(FEATURES, (size, 2))
+        public = rng.random(size) < PUBLIC_FRACTION
+        sizes = rng.integers(10000, 5000000, size)
+        ids = rng.bytes(16 * size)
+        rows = []
+        offset = 0
+        for i in range(size):
+            number = start + i
+            image_uuid = uuid.UUID(bytes=ids[16 * i:16 * i + 16], version=4)
+            image_code = hashlib.sha256(image_uuid.bytes).hexdigest()
+            rows.append({
+                'image_name': 'synthetic_%d' % number,
+                'image_code': image_code,
+                'image_keywords': ','.join(terms[offset:offset + lengths[i]]),
+                'image_features': ','.join(features[i]),
+                'image_access': 'public' if public[i] else 'private',
+                'user_pass': '',
+                'image_owner': '' if public[i] else BENCHMARK_USER,
+                'unique_uuid': str(image_uuid),
+                'image_size': int(sizes[i]),
+                'image_encoding': 'raw',
+                'image_hash': image_code,
+                'image_phash': ''
+            })
+            offset += lengths[i]
+        yield rows
+
+def make_images(directory, count, seed=0, side=256):
+    '''
+    Writes synthetic PNG images: random color blocks, scaled up so they
+    compress like photographs rather than noise. Every image is different.
+    :param directory: directory to write the images into (created if needed)
+    :param count: number of images
+    :param seed: random seed
+    :param side: width and height in pixels
+    :return: List of filepaths
+    '''
+    os.makedirs(directory, exist_ok=True)
+    rng = np.random.default_rng(seed)
+    paths = []
+    for i in range(count):
+        blocks = rng.integers(0, 256, (8, 8, 3), dtype=np.uint8)
+        image = cv2.resize(blocks, (side, side), interpolation=cv2.INTER_LINEAR)
+        path = os.path.join(directory, 'image_%06d.png' % i)
+        cv2.imwrite(path, image)
+        paths.append(path)
+    return paths
+
+def peak_rss_mb():
+    '''
+    :return: peak resident memory of this process in MB (None where unknown)
+    '''
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return round(peak / (1024 * 1024 if sys.platform == 'darwin' else 1024), 1) # bytes on macOS, KB on Linux
+
+def measure(name, operation, calls, items_per_call=1, budget=BUDGET_SECONDS):
+    '''
+    Calls operation once per element of calls and times every call.
+    :param name: benchmark name
+    :param operation: function taking one element of calls
+    :param calls: List of arguments, one per call
+    :param items_per_call: items handled by each call (images, rows, ...),
+                           for the throughput
+    :param budget: seconds after which the remaining calls are skipped (the
+                   first call always runs), so slow paths on large databases
+                   still finish; 'calls' in the result is the number made
+    :return: dictionary of the results
+    '''
+    image_timing.reset()
+    latencies = []
+    for argument in calls:
+        start = time.perf_counter()
+        operation(argument)
+        latencies.append(time.perf_counter() - start)
+        if budget is not None and sum(latencies) >= budget:
+            break
+    total = sum(latencies)
+    latencies.sort()
+    result = {
+        'benchmark': name,
+        'calls': len(latencies),
+        'items': len(latencies) * items_per_call,
+        'seconds': round(total, 6),
+        'throughput_per_s': round(len(latencies) * items_per_call / total, 3) if total else None,
+        'latency_ms': {
+            'p50': round(image_timing.percentile(latencies, 0.50) * 1000, 4),
+            'p95': round(image_timing.percentile(latencies, 0.95) * 1000, 4),
+            'p99': round(image_timing.percentile(latencies, 0.99) * 1000, 4),
+            'max': round(latencies[-1] * 1000, 4) if latencies else 0.0
+        },
+        'peak_rss_mb': peak_rss_mb()
+    }
+    if image_timing.ENABLED:
+        result['stages'] = image_timing.summary()
+    return result
+
+def run_size(rows, backend='csv', images=SAMPLE_IMAGES, searches=SEARCHES, seed=0, timing=False,
+             budget=BUDGET_SECONDS):
+    '''
+    Runs every benchmark against a new database of rows synthetic rows
+    (meant to run in a fresh process, see run()).
+    :param rows: number of rows in the database
+    :param backend: 'csv' or 'sqlite'
+    :param images: number of sample image files encrypted and stored
+    :param searches: number of keyword searches
+    :param seed: random seed
+    :param timing: also record the per-stage timings
+    :param budget: time budget of each benchmark in seconds (see measure())
+    :return: dictionary with the size, setup time and a List of results
+    '''
+    if timing:
+        image_timing.enable()
+    with tempfile.TemporaryDirectory() as directory:
+        # a private repository: nothing in the working directory is read or written
+        repository.KEY_FILENAME = os.path.join(directory, 'key.key')
+        repository.DATA_FILENAME = os.path.join(directory, 'data.db' if backend == 'sqlite' else 'data.csv')
+        repository.INDEX_FILENAME = os.path.join(directory, 'index.json')
+        repository.USERS_FILENAME = os.path.join(directory, 'users.json')
+        repository.BLOB_DIRECTORY = os.path.join(directory, 'blobs')
+        repository.DESCRIPTOR_FILENAME = os.path.join(directory, 'descriptors')
+        repository.CURRENT_USER = BENCHMARK_USER
+        repository.get_key()
+
+        start = time.perf_counter()
+        vocabulary = make_vocabulary(rows)
+        with repository.get_storage() as storage:
+            for batch in make_rows(rows, vocabulary, seed):
+                storage.insert_many(batch)
+        directories = []
+        paths = []
+        for number in range(0, images, IMAGES_PER_STORE): # one directory per store_images() call
+            directories.append(os.path.join(directory, 'images', str(number)))
+            paths += make_images(directories[-1], min(IMAGES_PER_STORE, images - number), seed + number)
+        setup = time.perf_counter() - start
+        answer = ['y'] # what the prompts are answered with: store as public, then the search terms
+        repository.get_input = lambda prompt='': answer[0]
+
+        results = []
+        results.append(measure('encrypt_file', lambda path: repository.encrypt_file(path, '.png'), paths, 1, budget))
+        results.append(measure('store_images', repository.store_images, directories, IMAGES_PER_STORE, budget))
+        total_rows = len(repository.get_dataframe())
+        results.append(measure('get_dataframe', lambda _: repository.get_dataframe(), range(LOAD_REPEATS), total_rows, budget))
+
+        rng = np.random.default_rng(seed + 1)
+        terms = np.array(vocabulary)[rng.choice(len(vocabulary), searches, p=zipf_weights(len(vocabulary)))]
+        def search(term):
+            answer[0] = term
+            return repository.search_images('image_keywords')
+        results.append(measure('search_images', search, list(terms), 1, budget))
+        repository.close_repository()
+
+    return {'rows': rows, 'backend': backend, 'setup_seconds': round(setup, 3), 'results': results}
+
+def run(sizes=None, output=None, backend='csv', images=SAMPLE_IMAGES, searches=SEARCHES, seed=0, timing=None,
+        budget=BUDGET_SECONDS):
+    '''
+    Runs the benchmarks for every size, each in its own process.
+    :param sizes: List of database sizes (default SIZES)
+    :param output: filepath of the JSON results (None: only returned)
+    :param backend: 'csv' or 'sqlite'
+    :param images: number of sample image files per size
+    :param searches: number of keyword searches per size
+    :param seed: random seed
+    :param timing: record the per-stage timings (default: image_timing.ENABLED)
+    :param budget: time budget of each benchmark in seconds (see measure())
+    :return: dictionary of the results
+    '''
+    timing = image_timing.ENABLED if timing is None else timing
+    report = {
+        'environment': {
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'cpus': os.cpu_count(),
+            'numpy': np.__version__,
+            'opencv': cv2.__version__
+        },
+        'settings': {'backend': backend, 'images': images, 'searches': searches, 'seed': seed, 'budget': budget},
+        'sizes': []
+    }
+    for rows in sizes or SIZES:
+        with ProcessPoolExecutor(1) as pool: # fresh process: its own peak memory
+            report['sizes'].append(pool.submit(run_size, rows, backend, images, searches, seed, timing, budget).result())
+    if output:
+        with open(output, 'w') as output_file:
+            json.dump(report, output_file, indent=1)
+    return report
+
+# main guard
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmarks ingest and search of the image repository.')
+    parser.add_argument('--sizes', type=int, nargs='+', default=SIZES, help='database sizes in rows')
+    parser.add_argument('--output', default='benchmark.json', help='JSON results file')
+    parser.add_argument('--backend', choices=['csv', 'sqlite'], default='csv')
+    parser.add_argument('--images', type=int, default=SAMPLE_IMAGES, help='sample image files per size')
+    parser.add_argument('--searches', type=int, default=SEARCHES, help='keyword searches per size')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--budget', type=float, default=BUDGET_SECONDS, help='seconds per benchmark')
+    parser.add_argument('--timing', action='store_true', help='include per-stage timings')
+    arguments = parser.parse_args()
+    results = run(arguments.sizes, arguments.output, arguments.backend, arguments.images,
+                  arguments.searches, arguments.seed, arguments.timing or None, arguments.budget)
+    for size in results['sizes']:
+        for result in size['results']:
+            print('%8d rows  %-14s %12.1f/s  p50 %9.3f ms  p99 %9.3f ms  peak %s MB' % (
+                size['rows'], result['benchmark'], result['throughput_per_s'] or 0,
+                result['latency_ms']['p50'], result['latency_ms']['p99'], result['peak_rss_mb']))
@@ -0,0 +1,163 @@
+"""Image Repository Crawler
+
+Finds the image files to ingest under a directory. The tree is walked
+lazily with os.scandir (one directory open at a time, no list of the
+whole tree is ever built), file extensions are matched case-insensitively,
+and hidden directories (.git, ...) are skipped.
+
+A scan manifest (SQLite) records the modification time, size and inode
+of every file that has been ingested. A re-scan compares each file with
+its entry and only passes on the files that are new or changed, so
+re-running an ingest over a large tree costs one stat() per image file
+instead of reading, hashing and encrypting all of them again. The
+manifest also records the first UUID of the database the files were
+stored in, and forgets its entries when that database is deleted or
+recreated, so the files are stored again.
+
+This file can be imported as a module and contains the following:
+
+    * is_image_file() - checks a file name against the image extensions
+    * file_signature() - (mtime, size, inode) of a file's stat result
+    * crawl() - lazily yields the image files under a directory
+    * ScanManifest - remembers the files already ingested
+"""
+
+## Import modules
+import os
+import sqlite3
+from image_storage import SQLITE_TIMEOUT
+
+## Constants
+IMAGE_EXTENSIONS = ['.bmp', '.jpeg', '.jpg', '.png', '.tif', '.tiff', '.webp']
+
+## Functions
+def is_image_file(name, extensions=IMAGE_EXTENSIONS):
+    '''
+    :param name: file name or path
+    :param extensions: List of lowercase extensions (with the dot)
+    :return: True if the extension is one of extensions, in any case ('.JPG')
+    '''
+    return os.path.splitext(name)[1].lower() in extensions
+
+def file_signature(stat):
+    '''
+    :param stat: os.stat_result of a file
+    :return: Tuple of (mtime in ns, size, inode); a file whose signature
+             is unchanged is assumed to have the same content
+    '''
+    return (stat.st_mtime_ns, stat.st_size, stat.st_ino)
+
+def crawl(root, extensions=IMAGE_EXTENSIONS):
+    '''
+    Walks root and its sub-directories depth first. Only files with an
+    image extension are stat()ed; directories that can't be read are
+    skipped, symbolic links to directories are not followed.
+    :param root: directory (or a single image file)
+    :param extensions: List of lowercase extensions (with the dot)
+    :return: generator of (filepath under root, os.stat_result)
+    '''
+    if os.path.isfile(root):
+        if is_image_file(root, extensions):
+            yield root, os.stat(root)
+        return
+
+    directories = [root]
+    while directories:
+        directory = directories.pop()
+        subdirectories = []
+        try:
+            with os.scandir(directory) as entries:
+                for entry in entries:
+                    if entry.name.startswith('.'):
+                        continue
+                    if entry.is_dir(follow_symlinks=False):
+                        subdirectories.append(entry.path)
+                    elif is_image_file(entry.name, extensions) and entry.is_file():
+                        yield entry.path, entry.stat()
+        except OSError: # removed or unreadable while walking
+            continue
+        directories.extend(reversed(subdirectories))
+
+## Classes
+class ScanManifest:
+    '''
+    SQLite table of the files already ingested: (directory, name) ->
+    signature. Entries are looked up one directory at a time, in the
+    order crawl() yields them.
+    :param path: filepath of the manifest
+    :param storage: Storage backend the files are stored in; the entries
+                    are only trusted while its first_uuid() is the one
+                    recorded with them (None trusts them unconditionally)
+    '''
+    def __init__(self, path, storage=None):
+        self.path = path
+        self.storage = storage
+        self.connection = sqlite3.connect(path, timeout=SQLITE_TIMEOUT)
+        self.connection.execute('CREATE TABLE IF NOT EXISTS files (directory TEXT, name TEXT, mtime_ns INTEGER, '
+                                'size INTEGER, inode INTEGER, PRIMARY KEY (directory, name)) WITHOUT ROWID')
+        self.connection.execute('CREATE TABLE IF NOT EXISTS database (first_uuid TEXT)')
+        self.connection.commit()
+        self._directory = None
+        self._known = {}
+        self._first_uuid = None
+        if storage is not None:
+            self._check_database()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def close(self):
+        self.connection.close()
+
+    def __len__(self):
+        return self.connection.execute('SELECT COUNT(*) FROM files').fetchone()[0]
+
+    def changed(self, files):
+        '''
+        :param files: iterable of (filepath, os.stat_result), e.g. from crawl()
+        :return: generator of the (filepath, os.stat_result) that are not in
+                 the manifest or whose signature differs from their entry
+        '''
+        for path, stat in files:
+            directory, name = os.path.split(os.path.abspath(path))
+            if directory != self._directory: # one query per directory, not per file
+                self._known = {row[0]: tuple(row[1:]) for row in self.connection.execute(
+                    'SELECT name, mtime_ns, size, inode FROM files WHERE directory = ?', (directory,))}
+                self._directory = directory
+            if self._known.get(name) != file_signature(stat):
+                yield path, stat
+
+    def record(self, files):
+        '''
+        Marks files as ingested. Call it only once their rows are committed,
+        so an interrupted ingest processes them again.
+        :param files: List of (filepath, os.stat_result)
+        '''
+        rows = [os.path.split(os.path.abspath(path)) + file_signature(stat) for path, stat in files]
+        with self.connection:
+            if self.storage is not None and self._first_uuid is None: # the first rows of a new database
+                self._set_first_uuid(self.storage.first_uuid())
+            self.connection.executemany('INSERT OR REPLACE INTO files VALUES (?, ?, ?, ?, ?)', rows)
+        self._directory = None
+
+    def _check_database(self):
+        '''
+        Forgets every entry if the database is gone or is not the one they
+        were recorded for (its first UUID differs), e.g. after data.csv was
+        deleted, so those files are not skipped forever.
+        '''
+        first_uuid = self.storage.first_uuid()
+        row = self.connection.execute('SELECT first_uuid FROM database').fetchone()
+        if first_uuid != (None if row is None else row[0]):
+            with self.connection:
+                self.connection.execute('DELETE FROM files')
+                self._set_first_uuid(first_uuid)
+        self._first_uuid = first_uuid
+
+    def _set_first_uuid(self, first_uuid):
+        self.connection.execute('DELETE FROM database')
+        self.connection.execute('INSERT INTO database VALUES (?)', (first_uuid,))
+        self._first_uuid = first_uuid
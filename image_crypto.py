@@ -0,0 +1,176 @@
+"""Image Repository Keys
+
+Process-wide encryption key provider for the Searchable Image Repository.
+The key file is read once per process and the cipher is reused for every
+image, instead of re-reading key.key and building a new Fernet object
+per image.
+
+The key file holds one Fernet key per line, newest first (a file with a
+single key, as written by older versions, is still valid). New images
+are encrypted with the newest key and every listed key can decrypt, so
+after rotate_key() older images stay readable until they are re-encrypted.
+
+This file can be imported as a module and contains the following:
+
+    * get_provider() - returns the shared KeyProvider for a key file
+    * KeyProvider - loads/creates/rotates the keys and encrypts/decrypts
+"""
+
+## Import modules
+import os
+import threading
+import uuid
+from cryptography.fernet import Fernet, InvalidToken, MultiFernet
+
+## Constants
+_PROVIDERS = {}
+_PROVIDERS_LOCK = threading.Lock()
+
+## Functions
+def get_provider(key_filename):
+    '''
+    Returns the process-wide KeyProvider for a key file, creating it on
+    first use.
+    :param key_filename: filepath of the key file
+    :return: KeyProvider
+    '''
+    path = os.path.abspath(key_filename)
+    with _PROVIDERS_LOCK:
+        provider = _PROVIDERS.get(path)
+        if provider is None:
+            provider = _PROVIDERS[path] = KeyProvider(path)
+        return provider
+
+def write_atomic(path, data, exclusive=False):
+    '''
+    Writes a file via a temporary file so no reader sees a partial key.
+    :param path: filepath to write
+    :param data: bytes to write
+    :param exclusive: only create the file; raises FileExistsError if
+                      another process already created it
+    '''
+    temp_path = '%s.%s.tmp' % (path, uuid.uuid4().hex)
+    with open(temp_path, 'wb') as temp_file:
+        temp_file.write(data)
+        temp_file.flush()
+        os.fsync(temp_file.fileno())
+    try:
+        if exclusive:
+            os.link(temp_path, path) # fails if the file exists, unlike rename
+        else:
+            os.replace(temp_path, path)
+    finally:
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+
+## Classes
+class KeyProvider:
+    '''
+    Loads the keys of a key file once and keeps the MultiFernet cipher
+    built from them.
+    '''
+    def __init__(self, path):
+        self.path = path
+        self._keys = None
+        self._cipher = None
+        self._lock = threading.Lock()
+
+    def keys(self):
+        '''
+        :return: List of keys (bytes), newest first. The key file is
+                 created with a new key if it does not exist yet.
+        '''
+        if self._keys is None:
+            with self._lock:
+                if self._keys is None:
+                    self._load()
+        return self._keys
+
+    def primary_key(self):
+        '''
+        :return: the key new images are encrypted with
+        '''
+        return self.keys()[0]
+
+    def cipher(self):
+        '''
+        :return: MultiFernet over every key (encrypts with the newest)
+        '''
+        if self._cipher is None:
+            keys = self.keys()
+            self._cipher = MultiFernet([Fernet(key) for key in keys])
+        return self._cipher
+
+    def encrypt(self, data):
+        return self.cipher().encrypt(data)
+
+    def decrypt(self, token):
+        '''
+        Decrypts a token. If none of the loaded keys match, the key file is
+        re-read once in case another process rotated the key.
+        '''
+        try:
+            return self.cipher().decrypt(token)
+        except InvalidToken:
+            self.reload()
+            return self.cipher().decrypt(token)
+
+    def rotate_token(self, token):
+        '''
+        :param token: token encrypted with any known key
+        :return: the same data encrypted with the newest key
+        '''
+        return self.cipher().rotate(token)
+
+    def rotate(self):
+        '''
+        Adds a new primary key in front of the existing ones.
+        :return: the new key
+        '''
+        with self._lock:
+            self._load()
+            key = Fernet.generate_key()
+            write_atomic(self.path, b'\n'.join([key] + self._keys) + b'\n')
+            self._set_keys([key] + self._keys)
+        return key
+
+    def retire_old_keys(self):
+        '''
+        Removes every key but the newest. Only call this once everything
+        has been re-encrypted with the newest key.
+        '''
+        with self._lock:
+            self._load()
+            write_atomic(self.path, self._keys[0] + b'\n')
+            self._set_keys(self._keys[:1])
+
+    def reload(self):
+        '''
+        Forgets the cached keys so the key file is read again.
+        '''
+        with self._lock:
+            self._keys = None
+            self._cipher = None
+
+    def _load(self):
+        try:
+            with open(self.path, 'rb') as key_file:
+                keys = [line.strip() for line in key_file.read().splitlines() if line.strip()]
+        except FileNotFoundError:
+            keys = []
+        if not keys:
+            key = Fernet.generate_key() # encryption key
+            try:
+                write_atomic(self.path, key, exclusive=True)
+                keys = [key]
+            except FileExistsError: # another process created it first, use theirs
+                with open(self.path, 'rb') as key_file:
+                    keys = [line.strip() for line in key_file.read().splitlines() if line.strip()]
+                if not keys: # an empty key file left behind, replace it
+                    write_atomic(self.path, key)
+                    keys = [key]
+        self._set_keys(keys)
+
+    def _set_keys(self, keys):
+        self._keys = keys
+        self._cipher = None
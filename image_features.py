@@ -0,0 +1,205 @@
+"""Image Repository Features
+
+Image processing helpers for the Searchable Image Repository, computed
+from an image that has already been decoded with cv2.
+
+This file can be imported as a module and contains the following
+functions:
+
+    * decode_image() - decodes image file bytes into a pixel array
+    * dhash() - difference hash (64 bit perceptual hash) of an image
+    * image_summary() - dimensions, ORB descriptors and thumbnail of one image
+    * color_features() - color histograms & dominant colors of a batch of thumbnails
+    * descriptors() - similarity search vectors of a batch of thumbnails
+    * finish_features() - adds the batched color features to a List of image summaries
+    * extract_features() - all of the above for a batch of images
+    * feature_terms() - searchable feature words (colors, orientation) from extracted features
+
+Extracted features are stored as an encrypted NumPy .npz file next to the
+image (see BlobStore.write_features()).
+"""
+
+## Import modules
+import cv2
+import numpy as np
+
+## Constants
+THUMBNAIL_SIDE = 32 # thumbnails used for the color features
+COLOR_LEVELS = 4 # levels per channel, so histograms have 64 bins
+ORB_FEATURES = 64 # ORB keypoints kept per image
+ORB_MAX_SIDE = 512 # images are downscaled to this size before ORB
+MIN_COLOR_SHARE = 0.05 # dominant colors covering less of the image are not named
+LAYOUT_SIDE = 8 # grayscale grid describing the layout of an image
+DESCRIPTOR_SIZE = COLOR_LEVELS ** 3 + LAYOUT_SIDE ** 2 # color histogram + layout
+COLOR_NAMES = {
+    'black': (0, 0, 0),
+    'white': (255, 255, 255),
+    'gray': (128, 128, 128),
+    'red': (200, 30, 30),
+    'orange': (240, 140, 30),
+    'yellow': (240, 220, 40),
+    'green': (40, 160, 60),
+    'cyan': (40, 200, 210),
+    'blue': (30, 70, 200),
+    'purple': (130, 50, 170),
+    'pink': (240, 150, 190),
+    'brown': (120, 80, 40)
+}
+
+## Functions
+def decode_image(image_bytes):
+    '''
+    Decodes image file bytes that are already in memory (no second read
+    of the file).
+    :param image_bytes: contents of an image file
+    :return: BGR pixel array, or None if cv2 cannot decode the format
+    '''
+    return cv2.imdecode(np.frombuffer(image_bytes, np.uint8), cv2.IMREAD_COLOR)
+
+def _grayscale(image, size):
+    if image.ndim == 3:
+        image = cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)
+    return cv2.resize(image, size, interpolation=cv2.INTER_AREA)
+
+def _to_hex(bits):
+    return '%0*x' % (bits.size // 4, int(''.join('1' if bit else '0' for bit in bits.flatten()), 2))
+
+def dhash(image, hash_size=8):
+    '''
+    Difference hash: one bit per horizontally adjacent pixel pair of a
+    grayscale thumbnail, set when brightness increases. Robust to scaling
+    and re-compression, so near-duplicates have a small Hamming distance.
+    :param image: pixel array from cv2
+    :return: hex String of hash_size * hash_size bits
+    '''
+    small = _grayscale(image, (hash_size + 1, hash_size)).astype(np.int16)
+    return _to_hex(small[:, 1:] > small[:, :-1])
+
+def image_summary(image):
+    '''
+    Per-image part of feature extraction, done while the full-resolution
+    array is in memory: dimensions, ORB keypoint descriptors and a small
+    thumbnail for the batched color features (so the full image can be
+    freed straight away).
+    :param image: BGR pixel array from cv2
+    :return: dictionary of width, height, aspect_ratio, orb, thumbnail
+    '''
+    height, width = image.shape[:2]
+    scale = min(1.0, ORB_MAX_SIDE / max(height, width))
+    gray = cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)
+    if scale < 1.0:
+        gray = cv2.resize(gray, None, fx=scale, fy=scale, interpolation=cv2.INTER_AREA)
+    descriptors = cv2.ORB_create(nfeatures=ORB_FEATURES).detectAndCompute(gray, None)[1]
+    return {
+        'width': width,
+        'height': height,
+        'aspect_ratio': width / height,
+        'orb': descriptors if descriptors is not None else np.zeros((0, 32), np.uint8),
+        'thumbnail': cv2.resize(image, (THUMBNAIL_SIDE, THUMBNAIL_SIDE), interpolation=cv2.INTER_AREA)
+    }
+
+def color_features(thumbnails, dominant=3):
+    '''
+    Color histogram and dominant colors for a whole batch of thumbnails
+    in one vectorized pass. Colors are quantized to COLOR_LEVELS levels
+    per channel.
+    :param thumbnails: array of shape (N, side, side, 3), BGR
+    :param dominant: number of dominant colors per image
+    :return: Tuple of (histograms (N, COLOR_LEVELS ** 3) float32 summing to 1,
+             dominant colors (N, dominant, 3) uint8 RGB, most common first)
+    '''
+    thumbnails = np.asarray(thumbnails)
+    count = thumbnails.shape[0]
+    levels = thumbnails // np.uint8(256 // COLOR_LEVELS) # stays uint8 until the final bincount
+    codes = (levels[..., 2] * COLOR_LEVELS + levels[..., 1]) * COLOR_LEVELS + levels[..., 0] # RGB order
+    bins = COLOR_LEVELS ** 3
+    offsets = (np.arange(count, dtype=np.int32) * bins)[:, None]
+    histograms = np.bincount((codes.reshape(count, -1) + offsets).ravel(), minlength=count * bins)
+    histograms = histograms.reshape(count, bins).astype(np.float32)
+    histograms /= histograms.sum(axis=1, keepdims=True)
+
+    top = np.argsort(-histograms, axis=1, kind='stable')[:, :dominant]
+    step = 256 // COLOR_LEVELS
+    centers = np.stack([top // (COLOR_LEVELS * COLOR_LEVELS), (top // COLOR_LEVELS) % COLOR_LEVELS, top % COLOR_LEVELS], axis=-1)
+    return histograms, (centers * step + step // 2).astype(np.uint8)
+
+def descriptors(thumbnails, histograms):
+    '''
+    Similarity search vectors for a batch of images: the square root of the
+    color histogram (so the dot product is the Hellinger similarity) next
+    to a mean-centered LAYOUT_SIDE x LAYOUT_SIDE grayscale grid. Each half
+    is L2 normalized, then the whole vector, so comparing two descriptors
+    is a single dot product (cosine similarity).
+    :param thumbnails: array of shape (N, THUMBNAIL_SIDE, THUMBNAIL_SIDE, 3), BGR
+    :param histograms: color histograms from color_features()
+    :return: float32 array (N, DESCRIPTOR_SIZE)
+    '''
+    thumbnails = np.asarray(thumbnails, np.float32)
+    count = thumbnails.shape[0]
+    block = THUMBNAIL_SIDE // LAYOUT_SIDE
+    gray = thumbnails @ np.array([0.114, 0.587, 0.299], np.float32) # BGR weights
+    layout = gray.reshape(count, LAYOUT_SIDE, block, LAYOUT_SIDE, block).mean(axis=(2, 4)).reshape(count, -1)
+    layout -= layout.mean(axis=1, keepdims=True)
+    parts = [np.sqrt(np.asarray(histograms, np.float32)), layout]
+    vectors = np.concatenate([part / np.maximum(np.linalg.norm(part, axis=1, keepdims=True), 1e-6) for part in parts], axis=1)
+    return vectors / np.maximum(np.linalg.norm(vectors, axis=1, keepdims=True), 1e-6)
+
+def finish_features(summaries):
+    '''
+    Completes a batch of image_summary() results with their color
+    histogram, dominant colors (computed together in color_features())
+    and similarity descriptor, replacing the thumbnails.
+    :param summaries: List of image_summary() dictionaries (None entries are skipped)
+    :return: the same List, completed in place
+    '''
+    valid = [summary for summary in summaries if summary is not None]
+    if valid:
+        thumbnails = np.stack([summary.pop('thumbnail') for summary in valid])
+        histograms, dominant = color_features(thumbnails)
+        for summary, histogram, colors, vector in zip(valid, histograms, dominant, descriptors(thumbnails, histograms)):
+            summary['histogram'] = histogram
+            summary['dominant_colors'] = colors
+            summary['descriptor'] = vector
+    return summaries
+
+def extract_features(images):
+    '''
+    Extracts the features of a batch of decoded images.
+    :param images: List of BGR pixel arrays (None entries are skipped)
+    :return: List of dictionaries (None for skipped images) with width, height,
+             aspect_ratio, orb, histogram, dominant_colors and descriptor
+    '''
+    return finish_features([image_summary(image) if image is not None else None for image in images])
+
+def color_name(rgb):
+    '''
+    :param rgb: color as (red, green, blue) 0-255
+    :return: name of the nearest color in COLOR_NAMES
+    '''
+    names = list(COLOR_NAMES)
+    palette = np.array([COLOR_NAMES[name] for name in names], np.int32)
+    return names[int(np.argmin(((palette - np.asarray(rgb, np.int32)) ** 2).sum(axis=1)))]
+
+def feature_terms(features):
+    '''
+    Turns extracted features into searchable image_features terms:
+    the names of the dominant colors (covering at least MIN_COLOR_SHARE
+    of the image) and the orientation.
+    :param features: dictionary from extract_features()
+    :return: List of terms
+    '''
+    terms = []
+    shares = np.sort(features['histogram'])[::-1] # share of the image covered by each dominant color
+    for colors, share in zip(features['dominant_colors'], shares):
+        if share < MIN_COLOR_SHARE:
+            continue
+        name = color_name(colors)
+        if name not in terms:
+            terms.append(name)
+    if features['aspect_ratio'] > 1.1:
+        terms.append('landscape')
+    elif features['aspect_ratio'] < 0.9:
+        terms.append('portrait')
+    else:
+        terms.append('square')
+    return terms
@@ -0,0 +1,140 @@
+"""Image Repository Index
+
+Inverted index for the Searchable Image Repository. Maps every keyword
+(or feature) term to the set of image UUIDs that carry it, so a search
+is a handful of set lookups instead of a scan over every row.
+
+The index is persisted as JSON next to the database and can always be
+rebuilt from the rows themselves.
+
+This file can be imported as a module and contains the following:
+
+    * split_terms() - splits a comma-joined string into normalized terms
+    * hash_bands() - splits a perceptual hash into band terms for near-duplicate lookups
+    * hamming_distance() - number of differing bits between two hex hashes
+    * InvertedIndex - term -> set of UUIDs, per indexed column
+"""
+
+## Import modules
+import json
+import os
+import threading
+
+## Constants
+INDEXED_COLUMNS = ['image_keywords', 'image_features']
+INDEX_VERSION = 2
+
+## Functions
+def split_terms(value):
+    '''
+    Splits a comma-joined keyword string into lowercase, stripped terms.
+    :param value: comma separated String (may be None/NaN)
+    :return: List of non-empty terms
+    '''
+    if not isinstance(value, str):
+        return []
+    terms = []
+    for term in value.split(','):
+        term = term.strip().lower()
+        if term and term not in terms:
+            terms.append(term)
+    return terms
+
+def hash_bands(value, bands):
+    '''
+    Splits a hex perceptual hash into equal bands, as terms like '0:ab12'.
+    Two hashes within bands - 1 bits of each other share at least one
+    band, so a band lookup finds every near-duplicate candidate.
+    :param value: hex String (may be empty/NaN)
+    :param bands: number of bands
+    :return: List of band terms
+    '''
+    if not isinstance(value, str) or not value:
+        return []
+    width = max(1, len(value) // bands)
+    return ['%d:%s' % (i, value[i * width:(i + 1) * width]) for i in range(bands)]
+
+def hamming_distance(first, second):
+    '''
+    :param first: hex hash
+    :param second: hex hash
+    :return: number of bits that differ
+    '''
+    return bin(int(first, 16) ^ int(second, 16)).count('1')
+
+## Classes
+class InvertedIndex:
+    '''
+    Term -> set of image UUIDs for each of the indexed columns.
+    '''
+    def __init__(self, columns=None):
+        self.columns = {column: {} for column in (columns or INDEXED_COLUMNS)}
+
+    def add(self, image_id, row):
+        '''
+        Adds the terms of one image row to the index.
+        :param image_id: UUID (or other unique id) of the image
+        :param row: mapping of column name -> comma-joined terms
+        '''
+        image_id = str(image_id)
+        for column, terms in self.columns.items():
+            for term in split_terms(row.get(column)):
+                terms.setdefault(term, set()).add(image_id)
+
+    def lookup(self, column, terms, match_all=False):
+        '''
+        Finds the images carrying the searched terms.
+        :param column: indexed column to search
+        :param terms: iterable of search terms
+        :param match_all: True intersects the postings, False unions them
+        :return: set of image UUIDs
+        '''
+        postings = self.columns[column]
+        result = None
+        for term in terms:
+            term = term.strip().lower()
+            if not term:
+                continue
+            ids = postings.get(term, set())
+            if result is None:
+                result = set(ids)
+            elif match_all:
+                result &= ids
+            else:
+                result |= ids
+        return result or set()
+
+    def save(self, path):
+        '''
+        Writes the index to disk atomically (temp file + rename).
+        :param path: filepath of the index
+        '''
+        payload = {
+            'version': INDEX_VERSION,
+            'columns': {
+                column: {term: sorted(ids) for term, ids in terms.items()}
+                for column, terms in self.columns.items()
+            }
+        }
+        temp_path = '%s.%d.%d.tmp' % (path, os.getpid(), threading.get_ident()) # readers may rebuild it at the same time
+        with open(temp_path, 'w') as index_file:
+            json.dump(payload, index_file)
+            index_file.flush()
+            os.fsync(index_file.fileno())
+        os.replace(temp_path, path)
+
+    @classmethod
+    def load(cls, path):
+        '''
+        Reads an index previously written with save().
+        :param path: filepath of the index
+        :return: InvertedIndex
+        '''
+        with open(path) as index_file:
+            payload = json.load(index_file)
+        if payload.get('version') != INDEX_VERSION:
+            raise ValueError('unsupported index version: %r' % payload.get('version'))
+        index = cls(list(payload['columns']))
+        for column, terms in payload['columns'].items():
+            index.columns[column] = {term: set(ids) for term, ids in terms.items()}
+        return index
@@ -0,0 +1,327 @@
+"""Image Repository Queries
+
+Boolean, ranked and paginated search for the Searchable Image Repository.
+A query combines keyword/feature terms with AND, OR and NOT:
+
+    dog AND (park OR beach) NOT cat
+    dog, cat                      (a comma is OR, as in the search prompts)
+    dog -cat                      (terms next to each other are ANDed; -term is NOT)
+    feature:brown "golden retriever" access:public
+
+A bare term matches the keywords or the features of an image; the
+keyword:, feature: and access: prefixes restrict it to one column.
+Queries run over a Table (see image_snapshot): every term is a slice of
+a posting array, the query is evaluated as boolean arrays over the row
+numbers and the matches are ranked with BM25 over the keyword/feature
+lists, without building a Python object per match.
+
+Access control is applied before ranking: a search on behalf of a user
+(the viewer) only considers the public images and the viewer's own,
+using the Table's cached visibility array of that viewer.
+
+Results are returned a page at a time with an opaque cursor for the next
+page. The cursor holds the position of the last result (score, row) and
+the number of rows the first page was ranked over: later pages leave out
+the images added since, so the statistics, and with them the scores and
+the order, stay the same from page to page. The ranked matches of recent
+queries are cached, so a later page is a slice of them, and only the
+rows of the requested page are ever decoded.
+
+This file can be imported as a module and contains the following:
+
+    * parse_query() - parses a query string into a tree of tuples
+    * QueryEngine - evaluates, ranks and paginates queries over a Table
+"""
+
+## Import modules
+import base64
+import hashlib
+import json
+import math
+import re
+from collections import OrderedDict
+import numpy as np
+from image_index import INDEXED_COLUMNS
+
+## Constants
+FIELDS = {
+    'keyword': ('image_keywords',),
+    'keywords': ('image_keywords',),
+    'feature': ('image_features',),
+    'features': ('image_features',),
+    'access': ('image_access',)
+}
+DEFAULT_FIELDS = tuple(INDEXED_COLUMNS)
+OPERATORS = ['AND', 'OR', 'NOT']
+BM25_K1 = 1.2
+BM25_B = 0.75
+QUERY_CACHE_SIZE = 32 # ranked queries kept for their later pages
+TOKEN = re.compile(r'\s*(?:(\()|(\))|(,)|(-)?(?:(\w+):)?"([^"]*)"|([^\s(),"]+))')
+
+## Functions
+def _tokenize(text):
+    tokens = []
+    position = 0
+    text = text.strip()
+    while position < len(text):
+        match = TOKEN.match(text, position)
+        if match is None or match.end() == position:
+            raise ValueError('cannot parse query at: %r' % text[position:])
+        position = match.end()
+        opening, closing, comma, negated, field, phrase, word = match.groups()
+        if opening or closing:
+            tokens.append(('op', opening or closing))
+        elif comma:
+            tokens.append(('op', 'OR'))
+        elif phrase is not None:
+            if negated:
+                tokens.append(('op', 'NOT'))
+            tokens.append(('term', field, phrase))
+        elif word.upper() in OPERATORS:
+            tokens.append(('op', word.upper()))
+        else:
+            if word.startswith('-') and len(word) > 1:
+                tokens.append(('op', 'NOT'))
+                word = word[1:]
+            field, _, term = word.rpartition(':') if ':' in word else (None, '', word)
+            tokens.append(('term', field or None, term))
+    return tokens
+
+def parse_query(text):
+    '''
+    Parses a query string. NOT binds tighter than AND, and AND tighter
+    than OR; parentheses group.
+    :param text: query String (see the module docstring)
+    :return: tree of ('term', columns, term), ('and', [nodes]),
+             ('or', [nodes]) and ('not', node) tuples
+    '''
+    tokens = _tokenize(text)
+    if not tokens:
+        raise ValueError('empty query')
+    position = [0]
+
+    def peek():
+        return tokens[position[0]] if position[0] < len(tokens) else None
+
+    def take():
+        position[0] += 1
+        return tokens[position[0] - 1]
+
+    def parse_or():
+        nodes = [parse_and()]
+        while peek() == ('op', 'OR'):
+            take()
+            nodes.append(parse_and())
+        return nodes[0] if len(nodes) == 1 else ('or', nodes)
+
+    def parse_and():
+        nodes = [parse_not()]
+        while peek() is not None and peek() not in [('op', 'OR'), ('op', ')')]:
+            if peek() == ('op', 'AND'):
+                take()
+            nodes.append(parse_not())
+        return nodes[0] if len(nodes) == 1 else ('and', nodes)
+
+    def parse_not():
+        if peek() == ('op', 'NOT'):
+            take()
+            return ('not', parse_not())
+        return parse_atom()
+
+    def parse_atom():
+        token = peek()
+        if token is None:
+            raise ValueError('query ends unexpectedly')
+        take()
+        if token == ('op', '('):
+            node = parse_or()
+            if peek() != ('op', ')'):
+                raise ValueError('missing closing parenthesis')
+            take()
+            return node
+        if token[0] != 'term':
+            raise ValueError('unexpected %r in query' % token[1])
+        field, term = token[1], token[2].strip().lower()
+        if field is not None and field.lower() not in FIELDS:
+            raise ValueError('unknown field: %r' % field)
+        if not term:
+            raise ValueError('empty term in query')
+        return ('term', FIELDS[field.lower()] if field else DEFAULT_FIELDS, term)
+
+    node = parse_or()
+    if peek() is not None:
+        raise ValueError('unexpected %r in query' % peek()[1])
+    return node
+
+def _encode_cursor(score, row, limit, fingerprint):
+    payload = json.dumps([score, row, limit, fingerprint]).encode('utf-8')
+    return base64.urlsafe_b64encode(payload).decode('ascii')
+
+def _decode_cursor(cursor, fingerprint):
+    try:
+        score, row, limit, cursor_fingerprint = json.loads(base64.urlsafe_b64decode(cursor.encode('ascii')))
+        score, row, limit = float(score), int(row), int(limit)
+    except (ValueError, TypeError):
+        raise ValueError('invalid cursor')
+    if cursor_fingerprint != fingerprint:
+        raise ValueError('cursor belongs to a different query')
+    return score, row, limit
+
+def _after(rows, scores, score, row):
+    '''
+    :return: position of the first result after (score, row) in results
+             ordered by score (highest first) then row
+    '''
+    keys = -scores # ascending
+    start = int(np.searchsorted(keys, -score, 'left'))
+    end = int(np.searchsorted(keys, -score, 'right'))
+    return start + int(np.searchsorted(rows[start:end], row, 'right'))
+
+## Classes
+class QueryEngine:
+    '''
+    Evaluates parsed queries over the rows of the database, ranks the
+    matches with BM25 and returns them a page at a time. Keep one engine
+    around while paging: the ranked matches of the QUERY_CACHE_SIZE most
+    recent queries are kept for their later pages.
+    :param tables: function returning the current Table of the database
+                   (see image_snapshot), e.g. Repository.table
+    '''
+    def __init__(self, tables):
+        self.tables = tables
+        self._results = OrderedDict() # (fingerprint, rows ranked) -> (Table, rows, scores)
+
+    def search(self, query, access=None, page_size=20, cursor=None, viewer=None):
+        '''
+        Runs a query and returns one page of ranked results.
+        :param query: query String (or a tree from parse_query())
+        :param access: only return 'public' or 'private' images (None for both)
+        :param page_size: number of results per page (at least 1)
+        :param cursor: cursor of the previous page, None for the first page
+        :param viewer: UUID of the user searching ('' for anonymous), or None
+                       to skip the access check (trusted callers only)
+        :return: dictionary with rows (Pandas dataframe of the page, best first,
+                 with a 'score' column), cursor (for the next page, None on the
+                 last page) and total (number of matching images)
+        '''
+        if page_size < 1:
+            raise ValueError('page_size must be at least 1')
+        node = parse_query(query) if isinstance(query, str) else query
+        fingerprint = hashlib.sha1(repr((node, access, viewer)).encode('utf-8')).hexdigest()[:16]
+        table = self.tables()
+        limit = len(table)
+        if cursor is not None:
+            last_score, last_row, limit = _decode_cursor(cursor, fingerprint)
+            limit = min(limit, len(table)) # rows added since the first page are left out
+        rows, scores = self._ranked(table, node, access, viewer, fingerprint, limit)
+        start = 0 if cursor is None else _after(rows, scores, last_score, last_row)
+
+        end = start + page_size
+        page = table.frame(rows[start:end]).assign(score=scores[start:end])
+        next_cursor = None
+        if end < len(rows):
+            next_cursor = _encode_cursor(float(scores[end - 1]), int(rows[end - 1]), limit, fingerprint)
+        return {'rows': page, 'cursor': next_cursor, 'total': len(rows)}
+
+    def _ranked(self, table, node, access, viewer, fingerprint, limit):
+        '''
+        :return: Tuple of (rows, scores) of the matches among the first limit
+                 rows, ordered by score (highest first) then row
+        '''
+        key = (fingerprint, limit)
+        cached = self._results.get(key)
+        if cached is not None and cached[0] is table: # appended rows are past limit, nothing else changes a Table
+            self._results.move_to_end(key)
+            return cached[1], cached[2]
+        masks = {}
+        rows = self._matches(table, node, access, viewer, limit, masks)
+        scores = self._score(table, node, rows, limit, masks)
+        order = np.argsort(-scores, kind='stable') # equal scores stay in row order
+        rows, scores = rows[order], scores[order]
+        self._results[key] = (table, rows, scores)
+        if len(self._results) > QUERY_CACHE_SIZE:
+            self._results.popitem(last=False)
+        return rows, scores
+
+    def _matches(self, table, node, access, viewer, limit, masks):
+        universe = np.ones(limit, bool) if viewer is None else table.visible(viewer)[:limit]
+        matches = self._evaluate(table, node, limit, universe, masks) & universe # before anything is ranked or loaded
+        if access is not None:
+            matches &= self._term(table, FIELDS['access'], access, limit, masks)
+        return np.flatnonzero(matches)
+
+    def _evaluate(self, table, node, limit, universe, masks):
+        '''
+        :param universe: boolean array of the rows NOT is taken against
+        :return: boolean array over the first limit rows, True for the rows
+                 matching a query node
+        '''
+        kind = node[0]
+        if kind == 'term':
+            return self._term(table, node[1], node[2], limit, masks)
+        if kind == 'not':
+            return universe & ~self._evaluate(table, node[1], limit, universe, masks)
+        if kind == 'or':
+            matches = np.zeros(limit, bool)
+            for child in node[1]:
+                matches |= self._evaluate(table, child, limit, universe, masks)
+            return matches
+        matches = universe.copy()
+        for child in node[1]:
+            if not matches.any():
+                break
+            matches &= self._evaluate(table, child, limit, universe, masks)
+        return matches
+
+    def _term(self, table, columns, term, limit, masks):
+        '''
+        :param masks: dictionary of the arrays of the terms already looked up
+                      by the query
+        :return: boolean array over the first limit rows, True for the rows
+                 carrying term in any of columns (do not modify it)
+        '''
+        key = (columns, term)
+        if key not in masks:
+            mask = np.zeros(limit, bool)
+            for column in columns:
+                rows = table.postings(column, term)
+                mask[rows[:np.searchsorted(rows, limit)]] = True
+            masks[key] = mask
+        return masks[key]
+
+    def _terms(self, node, negated=False):
+        '''
+        :return: List of (column, term) of the positive (not negated) terms of a query
+        '''
+        if node[0] == 'term':
+            if negated or node[1] == FIELDS['access']:
+                return []
+            return [(column, node[2]) for column in node[1]]
+        if node[0] == 'not':
+            return self._terms(node[1], not negated)
+        return [term for child in node[1] for term in self._terms(child, negated)]
+
+    def _score(self, table, node, rows, limit, masks):
+        '''
+        BM25 score of every matching row, with the statistics of the first
+        limit rows. Keyword lists hold each term at most once, so the term
+        frequency is 1 and the score of a term only depends on its rarity
+        (idf) and the length of the list.
+        :return: float64 array of scores, aligned with rows
+        '''
+        scores = np.zeros(len(rows))
+        terms = list(dict.fromkeys(self._terms(node)))
+        if not terms or not len(rows):
+            return scores
+        norms = {}
+        for column, term in terms:
+            if column not in norms:
+                lengths = table.lengths(column)[:limit]
+                counted = lengths[lengths > 0]
+                average = counted.mean() if len(counted) else 0.0
+                norms[column] = (BM25_K1 + 1) / (1 + BM25_K1 * (1 - BM25_B + BM25_B * lengths[rows] / max(average, 1e-9)))
+            mask = self._term(table, (column,), term, limit, masks)
+            frequency = int(np.count_nonzero(mask))
+            idf = math.log(1 + (limit - frequency + 0.5) / (frequency + 0.5))
+            scores += idf * norms[column] * mask[rows]
+        return scores
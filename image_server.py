@@ -0,0 +1,375 @@
+"""Image Repository HTTP Service
+
+asyncio HTTP front-end for the Searchable Image Repository, so several
+clients can store, search and retrieve images at the same time instead
+of one user at a time through the menu in main(). Uses only the standard
+library:
+
+    POST /users           register: JSON object with name and password
+    POST /images          store images: multipart/form-data with one or more
+                          image files and optional keywords, features and
+                          access ('public'/'private') fields for all of them
+    GET  /search          ranked boolean search (see image_query) with the
+                          parameters q, access, page_size and cursor
+    GET  /images/<uuid>   the decrypted image; size=thumbnail, preview or
+                          original (default)
+
+Users sign in with HTTP Basic authentication. Storing images requires it
+(the images are owned by the user); searches and retrievals without it
+only see public images, with it the user's private images as well.
+
+The event loop only parses requests and writes responses. Decoding,
+hashing and encrypting uploads runs in the ingest process pool (or a
+thread when workers is 1); searches and decryption run in a thread pool,
+each thread keeping its own Repository (storage connection, index and
+snapshot) between requests; writes go through a single writer thread,
+so they are serialized and never block the reads.
+
+Run it with:
+
+    python image_server.py [port]
+"""
+
+## Import modules
+import asyncio
+import base64
+import binascii
+import email.parser
+import email.policy
+import json
+import math
+import os
+import sys
+import tempfile
+import traceback
+import urllib.parse
+from concurrent.futures import ThreadPoolExecutor
+import keith_data_intern_project_3 as repository
+from image_storage import is_blob_reference
+
+## Constants
+MAX_BODY_BYTES = 64 * 1024 * 1024 # largest request body accepted
+MAX_PAGE_SIZE = 100
+READ_THREADS = 8 # concurrent searches / retrievals
+STATUS_TEXT = {
+    200: 'OK',
+    201: 'Created',
+    400: 'Bad Request',
+    401: 'Unauthorized',
+    404: 'Not Found',
+    405: 'Method Not Allowed',
+    411: 'Length Required',
+    413: 'Payload Too Large',
+    500: 'Internal Server Error'
+}
+IMAGE_TYPES = [
+    (b'\x89PNG', 'image/png'),
+    (b'\xff\xd8', 'image/jpeg'),
+    (b'BM', 'image/bmp'),
+    (b'II*\x00', 'image/tiff'),
+    (b'MM\x00*', 'image/tiff')
+]
+
+## Functions
+def parse_multipart(content_type, body):
+    '''
+    Splits a multipart/form-data request body into its form fields and
+    uploaded files.
+    :param content_type: Content-Type header of the request (with the boundary)
+    :param body: request body as bytes
+    :return: Tuple of (dictionary of field name -> String,
+             List of (file name, file bytes))
+    '''
+    if not content_type.lower().startswith('multipart/form-data'):
+        raise HttpError(400, 'expected multipart/form-data')
+    message = email.parser.BytesParser(policy=email.policy.HTTP).parsebytes(
+        b'Content-Type: ' + content_type.encode('latin-1') + b'\r\n\r\n' + body)
+    fields = {}
+    files = []
+    for part in message.iter_parts():
+        data = part.get_payload(decode=True) or b''
+        filename = part.get_filename()
+        if filename:
+            files.append((os.path.basename(filename.replace('\\', '/')), data))
+        else:
+            fields[part.get_param('name', header='content-disposition')] = data.decode('utf-8')
+    return fields, files
+
+def image_type(image_bytes):
+    '''
+    :param image_bytes: image file bytes
+    :return: MIME type guessed from the first bytes of the file
+    '''
+    for magic, mime_type in IMAGE_TYPES:
+        if image_bytes.startswith(magic):
+            return mime_type
+    if image_bytes[:4] == b'RIFF' and image_bytes[8:12] == b'WEBP':
+        return 'image/webp'
+    return 'application/octet-stream'
+
+def json_rows(frame):
+    '''
+    :param frame: Pandas dataframe of image rows
+    :return: List of dictionaries ready for json.dumps (no credentials, no NaN)
+    '''
+    rows = []
+    for row in frame.drop(columns=['user_pass'], errors='ignore').to_dict('records'):
+        rows.append({column: '' if isinstance(value, float) and math.isnan(value) else value
+                     for column, value in row.items()})
+    return rows
+
+def serve(host='127.0.0.1', port=8080, workers=None):
+    '''
+    Runs the service until interrupted.
+    :param host: interface to listen on (localhost by default)
+    :param port: TCP port
+    :param workers: ingest worker processes (default INGEST_WORKERS)
+    '''
+    async def run():
+        server = ImageServer(host, port, workers)
+        await server.start()
+        print('Serving on http://%s:%d' % (host, server.port))
+        try:
+            await server.serve_forever()
+        finally:
+            await server.close()
+    asyncio.run(run())
+
+## Classes
+class HttpError(Exception):
+    '''
+    Error returned to the client with its HTTP status.
+    '''
+    def __init__(self, status, message):
+        super().__init__(message)
+        self.status = status
+
+class ImageServer:
+    '''
+    The HTTP service. start() binds the socket (port 0 picks a free one,
+    see .port), close() stops it and its worker pools.
+    '''
+    def __init__(self, host='127.0.0.1', port=8080, workers=None):
+        self.host = host
+        self.port = port
+        self.workers = repository.INGEST_WORKERS if workers is None else workers
+        self._server = None
+
+    async def start(self):
+        self._readers = ThreadPoolExecutor(READ_THREADS, thread_name_prefix='image-server-read')
+        self._writer = ThreadPoolExecutor(1, thread_name_prefix='image-server-write') # the single writer
+        if self.workers > 1:
+            self._encoders = repository.open_ingest_pool(self.workers)
+        else:
+            self._encoders = ThreadPoolExecutor(1, thread_name_prefix='image-server-encode')
+        self._server = await asyncio.start_server(self._handle, self.host, self.port)
+        self.port = self._server.sockets[0].getsockname()[1]
+
+    async def serve_forever(self):
+        await self._server.serve_forever()
+
+    async def close(self):
+        self._server.close()
+        await self._server.wait_closed()
+        await self._run(self._writer, repository.close_repository) # compacts what the writer stored
+        for pool in [self._readers, self._writer, self._encoders]:
+            pool.shutdown(wait=True)
+
+    async def _handle(self, reader, writer):
+        try:
+            try:
+                status, content_type, body = await self._respond(reader)
+            except HttpError as error:
+                status, content_type, body = error.status, 'application/json', {'error': str(error)}
+            except Exception: # keep serving the other clients; the details only go to the log
+                traceback.print_exc(file=sys.stderr)
+                status, content_type, body = 500, 'application/json', {'error': 'internal server error'}
+            if content_type == 'application/json':
+                body = json.dumps(body).encode('utf-8')
+            head = 'HTTP/1.1 %d %s\r\nContent-Type: %s\r\nContent-Length: %d\r\nConnection: close\r\n' % (
+                status, STATUS_TEXT[status], content_type, len(body))
+            if status == 401:
+                head += 'WWW-Authenticate: Basic realm="images"\r\n'
+            head += '\r\n'
+            writer.write(head.encode('latin-1') + body)
+            await writer.drain()
+        finally:
+            writer.close()
+
+    async def _respond(self, reader):
+        '''
+        Reads one request and routes it.
+        :return: Tuple of (status, content type, body: bytes, or a value for JSON)
+        '''
+        try:
+            method, target, _ = (await reader.readline()).decode('latin-1').split()
+        except ValueError:
+            raise HttpError(400, 'malformed request line')
+        headers = {}
+        while True:
+            line = (await reader.readline()).decode('latin-1')
+            if line in ['\r\n', '\n', '']:
+                break
+            name, _, value = line.partition(':')
+            headers[name.strip().lower()] = value.strip()
+        if 'chunked' in headers.get('transfer-encoding', '').lower():
+            raise HttpError(411, 'send a Content-Length instead of a chunked body')
+        length = int(headers.get('content-length') or 0)
+        if length > MAX_BODY_BYTES:
+            raise HttpError(413, 'request body larger than %d bytes' % MAX_BODY_BYTES)
+        body = await reader.readexactly(length) if length else b''
+
+        url = urllib.parse.urlsplit(target)
+        params = dict(urllib.parse.parse_qsl(url.query))
+        parts = [urllib.parse.unquote(part) for part in url.path.strip('/').split('/')]
+        if parts == ['users']:
+            if method != 'POST':
+                raise HttpError(405, 'use POST to register')
+            return (201, 'application/json', await self._run(self._readers, self._register, body))
+        viewer = await self._run(self._readers, self._authenticate, headers.get('authorization'))
+        if parts == ['images']:
+            if method != 'POST':
+                raise HttpError(405, 'use POST to store images')
+            if not viewer:
+                raise HttpError(401, 'sign in to store images')
+            return (201, 'application/json', await self._store(headers.get('content-type', ''), body, viewer))
+        if parts == ['search']:
+            if method != 'GET':
+                raise HttpError(405, 'use GET to search')
+            return (200, 'application/json', await self._run(self._readers, self._search, params, viewer))
+        if len(parts) == 2 and parts[0] == 'images':
+            if method != 'GET':
+                raise HttpError(405, 'use GET to retrieve an image')
+            image_bytes = await self._run(self._readers, self._retrieve, parts[1], params.get('size', 'original'), viewer)
+            return (200, image_type(image_bytes), image_bytes)
+        raise HttpError(404, 'no such endpoint: %s' % url.path)
+
+    async def _run(self, pool, function, *args):
+        return await asyncio.get_running_loop().run_in_executor(pool, function, *args)
+
+    def _authenticate(self, authorization):
+        '''
+        :param authorization: Authorization header of the request (or None)
+        :return: UUID of the signed-in user, '' when the request is anonymous
+        '''
+        if not authorization:
+            return ''
+        scheme, _, credentials = authorization.partition(' ')
+        try:
+            name, separator, password = base64.b64decode(credentials.strip(), validate=True).decode('utf-8').partition(':')
+        except (binascii.Error, UnicodeDecodeError):
+            separator = ''
+        if scheme.lower() != 'basic' or not separator:
+            raise HttpError(401, 'malformed Authorization header')
+        user_id = repository.get_users().authenticate(name, password)
+        if user_id is None:
+            raise HttpError(401, 'wrong user name or password')
+        return user_id
+
+    def _register(self, body):
+        try:
+            user = json.loads(body)
+            return {'id': repository.get_users().create(str(user['name']), str(user['password']))}
+        except (ValueError, KeyError, TypeError) as error:
+            raise HttpError(400, 'expected a JSON object with name and password: %s' % error)
+
+    async def _store(self, content_type, body, owner):
+        fields, files = await self._run(self._readers, parse_multipart, content_type, body)
+        if not files:
+            raise HttpError(400, 'no image files uploaded')
+        metadata = {
+            'image_keywords': fields.get('keywords', ''),
+            'image_features': fields.get('features', ''),
+            'image_access': fields.get('access', 'private').strip().lower(),
+            'image_owner': owner
+        }
+        with tempfile.TemporaryDirectory() as directory:
+            paths = await self._run(self._readers, self._stage, directory, files)
+            fingerprints = await self._run(self._encoders, repository.fingerprint_image_batch, paths)
+            new_paths = await self._run(self._writer, self._check, paths, fingerprints)
+            blobs = await self._run(self._encoders, repository.encrypt_image_batch, new_paths) if new_paths else []
+            stored = await self._run(self._writer, self._commit, new_paths, blobs, metadata)
+            stored['duplicates'] = [os.path.splitext(os.path.basename(path))[0] for path in paths
+                                    if path not in new_paths] + stored['duplicates']
+            return stored
+
+    def _stage(self, directory, files):
+        '''
+        Writes the uploads to a temporary directory (one sub-directory per
+        file, so the image names are kept) for the encoders to read.
+        :return: List of filepaths
+        '''
+        paths = []
+        for number, (filename, data) in enumerate(files):
+            if os.path.splitext(filename)[1].lower() not in repository.IMAGE_FORMATS:
+                raise HttpError(400, 'not a supported image file: %s' % filename)
+            path = os.path.join(directory, str(number), filename)
+            os.makedirs(os.path.dirname(path))
+            with open(path, 'wb') as image_file:
+                image_file.write(data)
+            paths.append(path)
+        return paths
+
+    def _check(self, paths, fingerprints):
+        '''
+        Runs on the writer thread: drops the duplicates before anything is
+        encrypted (see repository.new_images()).
+        :return: List of the filepaths to store
+        '''
+        pending = {}
+        storage = repository.get_repository()
+        return [path for path, fingerprint in zip(paths, fingerprints)
+                if not repository.is_duplicate(storage, fingerprint, pending)]
+
+    def _commit(self, paths, blobs, metadata):
+        '''
+        Runs on the writer thread: skips images stored by another upload
+        since _check() and stores the rows.
+        :return: dictionary of stored images and names of the duplicates
+        '''
+        rows = []
+        duplicates = []
+        pending = {}
+        storage = repository.get_repository() # the writer thread's, kept between uploads
+        for path, blob in zip(paths, blobs):
+            if repository.is_duplicate(storage, blob, pending):
+                duplicates.append(os.path.splitext(os.path.basename(path))[0])
+                continue
+            rows.append(repository.image_row(path, blob, metadata))
+        repository.commit_rows(storage, rows)
+        return {
+            'stored': [{'unique_uuid': str(row['unique_uuid']), 'image_name': row['image_name']} for row in rows],
+            'duplicates': duplicates
+        }
+
+    def _search(self, params, viewer):
+        if not params.get('q', '').strip():
+            raise HttpError(400, 'missing query parameter q')
+        try:
+            page_size = int(params.get('page_size', repository.QUERY_PAGE_SIZE))
+        except ValueError:
+            raise HttpError(400, 'page_size must be a whole number')
+        if page_size < 1:
+            raise HttpError(400, 'page_size must be at least 1')
+        try:
+            page = repository.query_images(params['q'], params.get('access') or None, min(MAX_PAGE_SIZE, page_size),
+                                           params.get('cursor'), viewer)
+        except ValueError as error:
+            raise HttpError(400, str(error))
+        return {'total': page['total'], 'cursor': page['cursor'], 'results': json_rows(page['rows'])}
+
+    def _retrieve(self, image_id, size, viewer):
+        if size != 'original' and size not in repository.DERIVATIVE_SIZES:
+            raise HttpError(400, 'unknown size: %s' % size)
+        rows = repository.get_repository().get([image_id]) # one Repository per reader thread
+        row = rows.iloc[0] if len(rows) else None
+        # someone else's private image looks exactly like a missing one
+        if row is None or (row['image_access'] != 'public' and not (viewer and row.get('image_owner') == viewer)):
+            raise HttpError(404, 'no image with UUID %s' % image_id)
+        if is_blob_reference(row['image_code']):
+            return repository.get_image(row['image_code'], size, viewer)
+        return repository.decrypt_image(row) # images stored inline by older versions only have the original
+
+# main guard
+if __name__ == '__main__':
+    serve(port=int(sys.argv[1]) if len(sys.argv) > 1 else 8080)
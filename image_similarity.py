@@ -0,0 +1,222 @@
+"""Image Repository Similarity Search
+
+"Find images like this one" for the Searchable Image Repository. Every
+stored image has a descriptor vector (see image_features.descriptors()),
+and the vectors of the whole repository are kept in one contiguous
+float32 matrix on disk:
+
+    <path>.f32 - N x DESCRIPTOR_SIZE float32 rows, append-only
+    <path>.ids - N image UUIDs (36 ASCII bytes each), same order
+    <path>.ivf.npz - optional coarse quantization (IVF) index
+
+Both files are memory-mapped, so opening the matrix costs nothing and a
+query is a single vectorized dot product over it (descriptors are L2
+normalized, so the dot product is the cosine similarity). For large
+repositories build_ivf() clusters the vectors so a query only scores the
+rows of the nprobe closest clusters (plus rows added after the build).
+Being mapped, the files are not encrypted, which is why the repository
+only keeps them when similarity search is turned on.
+
+This file can be imported as a module and contains the following:
+
+    * kmeans() - spherical k-means used to train the IVF index
+    * DescriptorIndex - the memory-mapped descriptor matrix
+"""
+
+## Import modules
+import os
+import numpy as np
+from image_features import DESCRIPTOR_SIZE
+from image_storage import file_lock
+
+## Constants
+UUID_SIZE = 36
+
+## Functions
+def kmeans(vectors, clusters, iterations=10, seed=0):
+    '''
+    Spherical k-means (cosine similarity) over L2 normalized vectors.
+    :param vectors: float32 array (N, D)
+    :param clusters: number of centroids
+    :param iterations: Lloyd iterations
+    :return: centroids, float32 array (clusters, D), L2 normalized
+    '''
+    rng = np.random.default_rng(seed)
+    centroids = vectors[rng.choice(len(vectors), clusters, replace=False)].copy()
+    for _ in range(iterations):
+        assignment = np.argmax(vectors @ centroids.T, axis=1)
+        sums = np.zeros_like(centroids)
+        np.add.at(sums, assignment, vectors)
+        norms = np.linalg.norm(sums, axis=1, keepdims=True)
+        filled = norms[:, 0] > 0 # empty clusters keep their old centroid
+        centroids[filled] = sums[filled] / norms[filled]
+    return centroids
+
+def _top(scores, k):
+    '''
+    :return: positions of the k highest scores, best first
+    '''
+    k = min(k, len(scores))
+    if k <= 0:
+        return np.zeros(0, np.int64)
+    top = np.argpartition(-scores, k - 1)[:k]
+    return top[np.argsort(-scores[top], kind='stable')]
+
+def _truncate(path, size):
+    '''
+    Cuts a file down to size bytes (nothing to do if it is missing or
+    already that size).
+    '''
+    if os.path.exists(path) and os.path.getsize(path) > size:
+        with open(path, 'r+b') as data_file:
+            data_file.truncate(size)
+
+## Classes
+class DescriptorIndex:
+    '''
+    Append-only, memory-mapped matrix of image descriptors with optional
+    IVF (inverted file) coarse quantization.
+    '''
+    def __init__(self, path):
+        self.path = path
+        self.vectors_path = path + '.f32'
+        self.ids_path = path + '.ids'
+        self.ivf_path = path + '.ivf.npz'
+        self.lock_path = path + '.lock'
+        self._vectors = None
+        self._ids = None
+        self._ivf = None
+        self._ivf_mtime = None
+
+    def __len__(self):
+        if not os.path.exists(self.vectors_path):
+            return 0
+        return os.path.getsize(self.vectors_path) // (DESCRIPTOR_SIZE * 4)
+
+    def append(self, uuids, vectors):
+        '''
+        Adds descriptors to the end of the matrix.
+        :param uuids: List of image UUIDs
+        :param vectors: array (len(uuids), DESCRIPTOR_SIZE)
+        '''
+        if not len(uuids):
+            return
+        vectors = np.ascontiguousarray(vectors, dtype=np.float32).reshape(len(uuids), DESCRIPTOR_SIZE)
+        ids = np.array([str(uuid).encode('ascii') for uuid in uuids], dtype='S%d' % UUID_SIZE)
+        # one writer at a time, so the rows of both files stay aligned across processes;
+        # ids first: a reader sizes the matrix by the vectors file, so it never sees a vector without its id
+        with file_lock(self.lock_path):
+            # a writer that crashed may have left a partial row or an id without its vector
+            rows = len(self)
+            if os.path.exists(self.ids_path):
+                rows = min(rows, os.path.getsize(self.ids_path) // UUID_SIZE)
+            _truncate(self.ids_path, rows * UUID_SIZE)
+            _truncate(self.vectors_path, rows * DESCRIPTOR_SIZE * 4)
+            with open(self.ids_path, 'ab') as ids_file:
+                ids_file.write(ids.tobytes())
+            with open(self.vectors_path, 'ab') as vectors_file:
+                vectors_file.write(vectors.tobytes())
+
+    def vectors(self):
+        '''
+        :return: read-only memory-mapped array (N, DESCRIPTOR_SIZE), re-mapped
+                 when other writers have appended rows
+        '''
+        count = len(self)
+        if self._vectors is None or len(self._vectors) != count:
+            if count == 0:
+                self._vectors = np.zeros((0, DESCRIPTOR_SIZE), np.float32)
+                self._ids = np.zeros(0, 'S%d' % UUID_SIZE)
+            else:
+                self._vectors = np.memmap(self.vectors_path, np.float32, 'r', shape=(count, DESCRIPTOR_SIZE))
+                self._ids = np.memmap(self.ids_path, 'S%d' % UUID_SIZE, 'r', shape=(count,))
+        return self._vectors
+
+    def ids(self):
+        '''
+        :return: memory-mapped array of the UUIDs (bytes) of every row
+        '''
+        self.vectors()
+        return self._ids
+
+    def search(self, query, k=10, nprobe=8, allowed=None):
+        '''
+        Finds the k stored descriptors most similar to query.
+        :param query: descriptor of the query image (DESCRIPTOR_SIZE,)
+        :param k: number of results
+        :param nprobe: clusters scanned when an IVF index has been built
+        :param allowed: optional boolean mask over the rows (see ids()); rows
+                        that are False are never returned
+        :return: List of (UUID, similarity) tuples, most similar first
+        '''
+        vectors = self.vectors()
+        query = np.asarray(query, np.float32).reshape(DESCRIPTOR_SIZE)
+        ivf = self._load_ivf()
+        if ivf is None or len(vectors) < ivf['indexed']:
+            rows = None
+            scores = vectors @ query # one pass over the whole matrix
+        else:
+            lists = _top(ivf['centroids'] @ query, nprobe)
+            offsets = ivf['offsets']
+            rows = np.sort(np.concatenate([ivf['order'][offsets[l]:offsets[l + 1]] for l in lists]
+                                          + [np.arange(ivf['indexed'], len(vectors))])) # rows added after the build
+            scores = vectors[rows] @ query
+        if allowed is not None:
+            allowed = np.asarray(allowed)[:len(vectors)]
+            scores = np.where(allowed if rows is None else allowed[rows], scores, -np.inf)
+            k = min(k, int(np.count_nonzero(np.isfinite(scores))))
+        top = _top(scores, k)
+        positions = top if rows is None else rows[top]
+        ids = self.ids()
+        return [(ids[position].decode('ascii'), float(scores[i])) for i, position in zip(top, positions)]
+
+    def build_ivf(self, clusters=None, iterations=10, sample=100000, seed=0):
+        '''
+        Builds the coarse quantization index: trains centroids with k-means
+        on a sample of the vectors, then assigns every row to its closest
+        centroid and stores the rows grouped by centroid.
+        :param clusters: number of clusters (default sqrt(N))
+        :param iterations: k-means iterations
+        :param sample: maximum number of vectors used for training
+        :return: number of clusters
+        '''
+        vectors = self.vectors()
+        count = len(vectors)
+        if count == 0:
+            return 0
+        clusters = min(count, clusters or max(1, int(np.sqrt(count))))
+        rng = np.random.default_rng(seed)
+        training = vectors[np.sort(rng.choice(count, min(count, sample), replace=False))]
+        centroids = kmeans(np.asarray(training), clusters, iterations, seed)
+
+        assignment = np.empty(count, np.int32)
+        for start in range(0, count, 65536): # chunked so memory stays bounded
+            assignment[start:start + 65536] = np.argmax(vectors[start:start + 65536] @ centroids.T, axis=1)
+        order = np.argsort(assignment, kind='stable').astype(np.int64)
+        offsets = np.concatenate([[0], np.cumsum(np.bincount(assignment, minlength=clusters))]).astype(np.int64)
+
+        temp_path = self.ivf_path + '.tmp.npz'
+        np.savez(temp_path, centroids=centroids, order=order, offsets=offsets, indexed=np.int64(count))
+        os.replace(temp_path, self.ivf_path)
+        self._ivf = None
+        return clusters
+
+    def drop_ivf(self):
+        '''
+        Removes the IVF index, so queries scan the whole matrix again.
+        '''
+        if os.path.exists(self.ivf_path):
+            os.remove(self.ivf_path)
+        self._ivf = None
+
+    def _load_ivf(self):
+        if not os.path.exists(self.ivf_path):
+            self._ivf = None
+            return None
+        mtime = os.path.getmtime(self.ivf_path)
+        if self._ivf is None or self._ivf_mtime != mtime:
+            with np.load(self.ivf_path) as arrays:
+                self._ivf = {name: arrays[name] for name in arrays.files}
+            self._ivf['indexed'] = int(self._ivf['indexed'])
+            self._ivf_mtime = mtime
+        return self._ivf
@@ -0,0 +1,540 @@
+"""Image Repository Snapshot
+
+Columnar, memory-mappable snapshot of the database, so a process can
+open a repository of millions of rows in milliseconds and search it
+without parsing the CSV file or building Python objects for every row.
+
+A snapshot is one file: a small JSON header followed by aligned NumPy
+arrays, mapped read-only with np.memmap (pages are only read when used).
+For every column:
+
+    <column>.codes    int32 per row, index into the column's string pool
+                      (-1 for a missing value)
+    <column>.pool     the distinct values, UTF-8, sorted and concatenated
+    <column>.offsets  int64 start of each value in the pool (+ the end)
+
+so repeated strings (access, owner, features) are stored once. The
+UUID column, looked up by value, also gets its pool as a fixed-width
+array, so lookups run directly on the mapped file:
+
+    <column>.fixed      the pool, NumPy 'S<width>' (zero-padded)
+    <column>.fixed_rows int64 row holding each value
+
+The keyword/feature columns are also dictionary-encoded term by term, as
+CSR (offsets/values) arrays in both directions:
+
+    <column>.terms, <column>.term_offsets  sorted term pool
+    <column>.row_offsets, <column>.row_terms  term ids of every row
+    <column>.posting_offsets, <column>.posting_rows  rows of every term
+
+A search is a binary search of the term pool and a slice of the posting
+arrays; only the rows that are returned are decoded.
+
+A Table puts a snapshot and the rows stored after it was taken (kept in
+memory) together, so the whole database can be searched by row number
+without rebuilding the snapshot after every write.
+
+This file can be imported as a module and contains the following:
+
+    * fixed_width() - copies a string pool into a fixed-width array for lookups
+    * intern_strings() - dictionary-encodes a column of strings
+    * encode_terms() - dictionary-encodes a comma-joined keyword column
+    * write_snapshot() - writes a dataframe as a snapshot file
+    * Snapshot - a snapshot file, memory-mapped
+    * Table - a snapshot plus the rows stored since
+"""
+
+## Import modules
+import json
+import os
+import threading
+import numpy as np
+import pandas as pd
+from image_index import INDEXED_COLUMNS, split_terms
+from image_storage import empty_frame
+
+## Constants
+SNAPSHOT_MAGIC = b'IMGSNAP1'
+SNAPSHOT_VERSION = 2
+ALIGNMENT = 64 # bytes, every array starts on a cache line
+VIEWER_MASKS = 64 # per-viewer visibility arrays kept by a Table
+LOOKUP_COLUMNS = ['unique_uuid'] # columns written as fixed-width arrays too, see Snapshot.rows_of()
+
+## Functions
+def _align(offset):
+    return (offset + ALIGNMENT - 1) // ALIGNMENT * ALIGNMENT
+
+def _pool(strings):
+    '''
+    :param strings: List of Strings
+    :return: Tuple of (uint8 array of the concatenated UTF-8 bytes, int64 offsets)
+    '''
+    data = ''.join(strings)
+    if data.isascii(): # one character per byte, no need to encode the values one by one
+        data = data.encode('ascii')
+        lengths = np.fromiter(map(len, strings), np.int64, len(strings))
+    else:
+        encoded = [string.encode('utf-8') for string in strings]
+        data = b''.join(encoded)
+        lengths = np.fromiter(map(len, encoded), np.int64, len(encoded))
+    offsets = np.zeros(len(strings) + 1, np.int64)
+    np.cumsum(lengths, out=offsets[1:])
+    return np.frombuffer(data, np.uint8), offsets
+
+def fixed_width(codes, pool, offsets):
+    '''
+    Copies a string pool into a fixed-width array, so many values can be
+    looked up at once with a vectorized binary search.
+    :param codes: int32 codes of every row (see intern_strings())
+    :param pool: uint8 pool
+    :param offsets: int64 offsets of the pool
+    :return: Tuple of (NumPy 'S<width>' array in pool order, int64 row
+             holding each value, the last one if several do)
+    '''
+    lengths = np.diff(offsets)
+    width = max(1, int(lengths.max()) if len(lengths) else 1)
+    padded = np.zeros((len(lengths), width), np.uint8)
+    padded[np.arange(width) < lengths[:, None]] = pool # row-major order is the pool order
+    present = np.flatnonzero(codes >= 0)
+    row_of_code = np.full(len(lengths), -1, np.int64)
+    row_of_code[codes[present]] = present
+    return padded.view('S%d' % width).reshape(-1), row_of_code
+
+def intern_strings(values):
+    '''
+    Dictionary-encodes a column: every distinct value is stored once.
+    :param values: Pandas Series (missing values as NaN/None)
+    :return: Tuple of (int32 codes, -1 for missing; uint8 pool; int64 offsets),
+             with the pool sorted so a value can be found by binary search
+    '''
+    values = np.asarray(values, dtype=object)
+    if pd.api.types.infer_dtype(values, skipna=True) != 'string': # numbers etc. are stored as their str()
+        missing = pd.isna(values)
+        values = values.copy()
+        values[~missing] = [str(value) for value in values[~missing]]
+    codes, uniques = pd.factorize(values) # hashing, in order of appearance
+    uniques = uniques.tolist()
+    order = sorted(range(len(uniques)), key=uniques.__getitem__) # much faster than factorize(sort=True) on strings
+    rank = np.empty(len(uniques) + 1, np.int32)
+    rank[order] = np.arange(len(uniques), dtype=np.int32)
+    rank[-1] = -1 # missing values keep code -1
+    pool, offsets = _pool(list(map(uniques.__getitem__, order)))
+    return rank[codes], pool, offsets
+
+def encode_terms(values):
+    '''
+    Dictionary-encodes a comma-joined keyword column into term ids, as
+    offsets/values arrays per row and per term (see split_terms() for how
+    a value is split).
+    :param values: Pandas Series of comma-joined Strings
+    :return: dictionary of terms, term_offsets, row_offsets, row_terms,
+             posting_offsets and posting_rows arrays
+    '''
+    term_ids = {}
+    row_terms = []
+    row_offsets = np.zeros(len(values) + 1, np.int64)
+    for row, value in enumerate(values):
+        for term in split_terms(value):
+            row_terms.append(term_ids.setdefault(term, len(term_ids)))
+        row_offsets[row + 1] = len(row_terms)
+
+    # number the terms in sorted order, so a term is found by binary search
+    terms = sorted(term_ids)
+    renumber = np.empty(len(terms), np.int32)
+    renumber[[term_ids[term] for term in terms]] = np.arange(len(terms), dtype=np.int32)
+    row_terms = renumber[np.array(row_terms, np.int32)] if row_terms else np.zeros(0, np.int32)
+
+    # the same pairs grouped by term: the posting list of every term, rows in order
+    rows = np.repeat(np.arange(len(values), dtype=np.int32), np.diff(row_offsets))
+    posting_rows = rows[np.argsort(row_terms, kind='stable')]
+    posting_offsets = np.zeros(len(terms) + 1, np.int64)
+    np.cumsum(np.bincount(row_terms, minlength=len(terms)), out=posting_offsets[1:])
+
+    pool, term_offsets = _pool(terms)
+    return {
+        'terms': pool,
+        'term_offsets': term_offsets,
+        'row_offsets': row_offsets,
+        'row_terms': row_terms,
+        'posting_offsets': posting_offsets,
+        'posting_rows': posting_rows
+    }
+
+def write_snapshot(path, frame, source=None):
+    '''
+    Writes a dataframe as a snapshot file, atomically (temp file + rename),
+    so processes that have the old snapshot open keep reading it.
+    :param path: filepath of the snapshot
+    :param frame: Pandas dataframe of the database
+    :param source: JSON-serializable state of the database the frame was
+                   read from, returned by Snapshot.source
+    '''
+    arrays = {}
+    for column in frame.columns:
+        codes, pool, offsets = intern_strings(frame[column])
+        arrays[column + '.codes'] = codes
+        arrays[column + '.pool'] = pool
+        arrays[column + '.offsets'] = offsets
+        if column in LOOKUP_COLUMNS:
+            arrays[column + '.fixed'], arrays[column + '.fixed_rows'] = fixed_width(codes, pool, offsets)
+    term_columns = [column for column in INDEXED_COLUMNS if column in frame.columns]
+    for column in term_columns:
+        for name, array in encode_terms(frame[column]).items():
+            arrays[column + '.' + name] = array
+
+    layout = {}
+    offset = 0
+    for name, array in arrays.items():
+        offset = _align(offset)
+        layout[name] = [array.dtype.str, list(array.shape), offset]
+        offset += array.nbytes
+    header = json.dumps({
+        'version': SNAPSHOT_VERSION,
+        'rows': len(frame),
+        'columns': list(frame.columns),
+        'term_columns': term_columns,
+        'source': source,
+        'arrays': layout
+    }).encode('utf-8')
+
+    start = _align(len(SNAPSHOT_MAGIC) + 8 + len(header))
+    temp_path = '%s.%d.%d.tmp' % (path, os.getpid(), threading.get_ident()) # threads of one process may race too
+    with open(temp_path, 'wb') as snapshot_file:
+        snapshot_file.write(SNAPSHOT_MAGIC + len(header).to_bytes(8, 'little') + header)
+        for name, array in arrays.items():
+            snapshot_file.seek(start + layout[name][2])
+            snapshot_file.write(np.ascontiguousarray(array).tobytes())
+        snapshot_file.truncate(start + offset)
+        snapshot_file.flush()
+        os.fsync(snapshot_file.fileno())
+    os.replace(temp_path, path)
+
+## Classes
+class Snapshot:
+    '''
+    A snapshot file, memory-mapped read-only. Rows are addressed by their
+    number (insertion order); lookups return NumPy arrays of row numbers
+    and frame() decodes just the rows asked for.
+    '''
+    def __init__(self, path):
+        self.path = path
+        with open(path, 'rb') as snapshot_file:
+            if snapshot_file.read(len(SNAPSHOT_MAGIC)) != SNAPSHOT_MAGIC:
+                raise ValueError('not a snapshot file: %s' % path)
+            length = int.from_bytes(snapshot_file.read(8), 'little')
+            header = json.loads(snapshot_file.read(length))
+        if header['version'] != SNAPSHOT_VERSION:
+            raise ValueError('unsupported snapshot version: %r' % header['version'])
+        self.rows = header['rows']
+        self.columns = header['columns']
+        self.term_columns = header['term_columns']
+        self.source = header['source']
+        start = _align(len(SNAPSHOT_MAGIC) + 8 + length)
+        buffer = np.memmap(path, np.uint8, 'r')
+        self._sorted = {} # column -> fixed-width copy of its pool, for the columns not in LOOKUP_COLUMNS
+        self._arrays = {}
+        for name, (dtype, shape, offset) in header['arrays'].items():
+            dtype = np.dtype(dtype)
+            count = int(np.prod(shape))
+            self._arrays[name] = buffer[start + offset:start + offset + count * dtype.itemsize].view(dtype).reshape(shape)
+
+    def __len__(self):
+        return self.rows
+
+    def array(self, name):
+        '''
+        :param name: array name, e.g. 'image_access.codes'
+        :return: the memory-mapped array
+        '''
+        return self._arrays[name]
+
+    def code(self, column, value):
+        '''
+        :param column: column name
+        :param value: String
+        :return: code of value in the column's pool, or -1 if no row has it
+        '''
+        return self._find(column + '.pool', column + '.offsets', value)
+
+    def term_id(self, column, term):
+        '''
+        :param column: one of the term columns (INDEXED_COLUMNS)
+        :param term: search term (normalized like split_terms())
+        :return: id of the term, or -1 if no row has it
+        '''
+        return self._find(column + '.terms', column + '.term_offsets', term.strip().lower())
+
+    def postings(self, column, term):
+        '''
+        :param column: one of the term columns
+        :param term: search term
+        :return: int32 array of the rows carrying the term, in order (a view
+                 of the mapped file, no copy)
+        '''
+        term_id = self.term_id(column, term)
+        if term_id < 0:
+            return np.zeros(0, np.int32)
+        offsets = self._arrays[column + '.posting_offsets']
+        return self._arrays[column + '.posting_rows'][offsets[term_id]:offsets[term_id + 1]]
+
+    def lookup(self, column, terms, match_all=False):
+        '''
+        Finds the rows carrying the searched terms (like InvertedIndex.lookup()).
+        :param column: one of the term columns
+        :param terms: iterable of search terms
+        :param match_all: True intersects the postings, False unions them
+        :return: sorted int32 array of row numbers
+        '''
+        result = None
+        for term in terms:
+            if not term.strip():
+                continue
+            rows = self.postings(column, term)
+            if result is None:
+                result = rows
+            elif match_all:
+                result = np.intersect1d(result, rows, assume_unique=True)
+            else:
+                result = np.union1d(result, rows)
+        return np.zeros(0, np.int32) if result is None else np.array(result, np.int32)
+
+    def rows_of(self, column, values):
+        '''
+        Looks many values of a column up at once, e.g. the UUIDs of a page
+        of results (a vectorized binary search of the fixed-width pool, read
+        from the file for LOOKUP_COLUMNS and copied on the first call for
+        the other columns).
+        :param column: column name
+        :param values: NumPy bytes array (dtype 'S...') of UTF-8 values
+        :return: int64 array of the row holding each value (the last one
+                 if several do), -1 for the values no row holds
+        '''
+        if column + '.fixed' in self._arrays:
+            pool, row_of_code = self._arrays[column + '.fixed'], self._arrays[column + '.fixed_rows']
+        else:
+            if column not in self._sorted:
+                self._sorted[column] = fixed_width(self._arrays[column + '.codes'], self._arrays[column + '.pool'],
+                                                   self._arrays[column + '.offsets'])
+            pool, row_of_code = self._sorted[column]
+        values = np.asarray(values, dtype='S')
+        if not len(pool) or not len(values):
+            return np.full(len(values), -1, np.int64)
+        positions = np.minimum(np.searchsorted(pool, values), len(pool) - 1)
+        return np.where(pool[positions] == values, row_of_code[positions], -1)
+
+    def equals(self, column, value):
+        '''
+        :param column: column name
+        :param value: String
+        :return: boolean array, True for the rows whose column is exactly value
+        '''
+        code = self.code(column, value)
+        if code < 0:
+            return np.zeros(self.rows, bool)
+        return self._arrays[column + '.codes'] == code
+
+    def visible(self, viewer):
+        '''
+        :param viewer: UUID of the user ('' for anonymous users: public images only)
+        :return: boolean array, True for the rows the viewer may see (public
+                 images and their own)
+        '''
+        visible = self.equals('image_access', 'public')
+        if viewer and 'image_owner' in self.columns:
+            visible |= self.equals('image_owner', viewer)
+        return visible
+
+    def values(self, column, rows=None):
+        '''
+        :param column: column name
+        :param rows: row numbers (default every row)
+        :return: object array of the Strings (NaN for missing values); each
+                 distinct value is decoded once
+        '''
+        codes = self._arrays[column + '.codes']
+        codes = codes if rows is None else codes[rows]
+        unique, inverse = np.unique(codes, return_inverse=True)
+        present = unique[unique >= 0]
+        offsets = self._arrays[column + '.offsets']
+        if len(present) * 8 > len(offsets): # most of the pool: decode it in one go
+            data = self._arrays[column + '.pool'].tobytes()
+            bounds = offsets.tolist()
+            strings = [data[bounds[code]:bounds[code + 1]].decode('utf-8') for code in present.tolist()]
+        else:
+            pool = self._arrays[column + '.pool']
+            starts = offsets[present].tolist()
+            ends = offsets[present + 1].tolist()
+            strings = [pool[start:end].tobytes().decode('utf-8') for start, end in zip(starts, ends)]
+        decoded = np.empty(len(unique), object)
+        decoded[:len(unique) - len(present)] = np.nan # code -1 sorts first
+        decoded[len(unique) - len(present):] = strings
+        return decoded[inverse.reshape(-1)]
+
+    def frame(self, rows=None):
+        '''
+        :param rows: row numbers (default every row)
+        :return: Pandas dataframe of those rows, like Storage.load()
+        '''
+        index = None if rows is None else pd.RangeIndex(len(rows))
+        return pd.DataFrame({column: self.values(column, rows) for column in self.columns},
+                            columns=self.columns, index=index)
+
+    def _find(self, pool_name, offsets_name, value):
+        pool = self._arrays[pool_name]
+        offsets = self._arrays[offsets_name]
+        target = value.encode('utf-8')
+        low, high = 0, len(offsets) - 1
+        while low < high: # UTF-8 byte order is code point order, the order the pool was sorted in
+            middle = (low + high) // 2
+            if pool[offsets[middle]:offsets[middle + 1]].tobytes() < target:
+                low = middle + 1
+            else:
+                high = middle
+        if low < len(offsets) - 1 and pool[offsets[low]:offsets[low + 1]].tobytes() == target:
+            return low
+        return -1
+
+class Table:
+    '''
+    The rows of the whole database: a Snapshot (or None) followed by the
+    rows stored after it was taken, which are kept in memory. Rows are
+    addressed by their number in insertion order, so a row keeps its
+    number when the snapshot is rebuilt. Lookups return sorted int64
+    arrays of row numbers, like Snapshot's.
+    '''
+    def __init__(self, snapshot=None):
+        self.snapshot = snapshot
+        self.base = 0 if snapshot is None else len(snapshot) # number of the first row after the snapshot
+        self._frames = [] # the rows after the snapshot, as appended
+        self._recent = None # _frames concatenated, built on first use
+        self._count = 0
+        self._terms = {column: {} for column in INDEXED_COLUMNS} # term -> rows, of the rows after the snapshot
+        self._recent_lengths = {column: [] for column in INDEXED_COLUMNS}
+        self._uuids = {} # UUID -> row, of the rows after the snapshot
+        self._lengths = {} # column -> number of terms of every snapshot row
+        self._visible = {} # viewer -> boolean array over the rows
+
+    def __len__(self):
+        return self.base + self._count
+
+    def append(self, frame):
+        '''
+        Adds rows stored after the snapshot was taken.
+        :param frame: Pandas dataframe of the rows, like Storage.load()
+        '''
+        if not len(frame):
+            return
+        start = len(self)
+        for column, postings in self._terms.items():
+            values = frame[column].tolist() if column in frame.columns else [None] * len(frame)
+            for row, value in enumerate(values, start):
+                terms = split_terms(value)
+                for term in terms:
+                    postings.setdefault(term, []).append(row)
+                self._recent_lengths[column].append(len(terms))
+        self._uuids.update(zip(frame['unique_uuid'].tolist(), range(start, start + len(frame))))
+        for viewer, mask in self._visible.items():
+            self._visible[viewer] = np.concatenate([mask, self._recent_visible(frame, viewer)])
+        self._frames.append(frame)
+        self._recent = None
+        self._count += len(frame)
+
+    def recent(self):
+        '''
+        :return: Pandas dataframe of the rows after the snapshot
+        '''
+        if self._recent is None and self._frames:
+            self._recent = pd.concat(self._frames, ignore_index=True)
+            self._frames = [self._recent]
+        return self._recent
+
+    def postings(self, column, term):
+        '''
+        :param column: one of the term columns, or another column (e.g.
+                       image_access) for the rows whose value is exactly term
+        :param term: search term (normalized like split_terms())
+        :return: sorted int64 array of the rows carrying the term
+        '''
+        term = term.strip().lower()
+        parts = []
+        if self.snapshot is not None and column in self.snapshot.columns:
+            if column in self.snapshot.term_columns:
+                parts.append(self.snapshot.postings(column, term).astype(np.int64))
+            else:
+                parts.append(np.flatnonzero(self.snapshot.equals(column, term)))
+        if column in self._terms:
+            parts.append(np.array(self._terms[column].get(term, []), np.int64))
+        elif self._count and column in self.recent().columns:
+            parts.append(np.flatnonzero(self.recent()[column].to_numpy(object) == term) + self.base)
+        return np.concatenate(parts) if parts else np.zeros(0, np.int64)
+
+    def lengths(self, column):
+        '''
+        :param column: one of the term columns
+        :return: int32 array of the number of terms of every row
+        '''
+        if column not in self._lengths:
+            if self.snapshot is not None and column in self.snapshot.term_columns:
+                self._lengths[column] = np.diff(self.snapshot.array(column + '.row_offsets')).astype(np.int32)
+            else:
+                self._lengths[column] = np.zeros(self.base, np.int32)
+        return np.concatenate([self._lengths[column], np.array(self._recent_lengths[column], np.int32)])
+
+    def visible(self, viewer):
+        '''
+        :param viewer: UUID of the user ('' for anonymous users: public images only)
+        :return: boolean array, True for the rows the viewer may see; kept
+                 for the VIEWER_MASKS most recent viewers (do not modify it)
+        '''
+        mask = self._visible.get(viewer)
+        if mask is None:
+            mask = np.zeros(0, bool) if self.snapshot is None else self.snapshot.visible(viewer)
+            if self._count:
+                mask = np.concatenate([mask, self._recent_visible(self.recent(), viewer)])
+            if len(self._visible) >= VIEWER_MASKS:
+                self._visible.pop(next(iter(self._visible)))
+            self._visible[viewer] = mask
+        return mask
+
+    def rows_of(self, uuids):
+        '''
+        :param uuids: NumPy bytes array (dtype 'S...') of UUIDs
+        :return: int64 array of the row of each UUID, -1 for unknown ones
+        '''
+        uuids = np.asarray(uuids, dtype='S')
+        rows = np.full(len(uuids), -1, np.int64)
+        if self.snapshot is not None:
+            rows = self.snapshot.rows_of('unique_uuid', uuids)
+        if self._uuids:
+            for position in np.flatnonzero(rows < 0).tolist():
+                rows[position] = self._uuids.get(uuids[position].decode('utf-8'), -1)
+        return rows
+
+    def frame(self, rows=None):
+        '''
+        :param rows: row numbers, in any order (default every row)
+        :return: Pandas dataframe of those rows, in that order
+        '''
+        if rows is None:
+            rows = np.arange(len(self))
+        rows = np.asarray(rows, np.int64)
+        if not len(rows):
+            return empty_frame() if self.snapshot is None else self.snapshot.frame(rows)
+        old = rows < self.base
+        parts = []
+        if old.any():
+            parts.append(self.snapshot.frame(rows[old]))
+        if not old.all():
+            parts.append(self.recent().iloc[rows[~old] - self.base].reset_index(drop=True))
+        if len(parts) == 1:
+            return parts[0]
+        frame = pd.concat(parts, ignore_index=True)
+        order = np.argsort(np.concatenate([np.flatnonzero(old), np.flatnonzero(~old)]), kind='stable')
+        return frame.iloc[order].reset_index(drop=True)
+
+    def _recent_visible(self, frame, viewer):
+        access = frame['image_access'].to_numpy(object) if 'image_access' in frame.columns else np.full(len(frame), None)
+        visible = access == 'public'
+        if viewer and 'image_owner' in frame.columns:
+            visible |= frame['image_owner'].to_numpy(object) == viewer
+        return visible
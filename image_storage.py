@@ -0,0 +1,1032 @@
+"""Image Repository Storage
+
+Storage backends for the Searchable Image Repository. Every backend
+implements the same small interface (see Storage) so the repository can
+keep its rows in the original CSV file or in an indexed SQLite database.
+
+    * CsvStorage - the original data.csv layout, kept for compatibility.
+      Rows go through a locked write-ahead journal that is compacted into
+      the file, so several processes can store at once, and duplicate
+      checks go through the JSON inverted index from image_index.
+    * SqliteStorage - SQLite database in write-ahead-log mode with indexed
+      image_name/unique_uuid columns and a term join table, so stores
+      are single-row inserts and duplicate checks are indexed queries.
+
+Encrypted image bytes are kept out of both backends: BlobStore writes
+them to a content-addressed directory (sharded by hash prefix) and the
+rows only hold the SHA-256 reference in image_code plus image_size.
+
+Smaller versions of each image (thumbnail, preview) and the features
+extracted from it are encrypted next to its blob, and LRUCache keeps
+recently decrypted images in memory.
+
+Both backends also index image_hash (SHA-256 of the file) and the bands
+of image_phash (perceptual hash) for O(1) duplicate checks. Rows stored by
+older versions carry no image_hash; they are found by name instead, as
+those versions did (see legacy_hash()).
+
+An existing data.csv can be converted with migrate_csv(), or from the
+command line:
+
+    python image_storage.py data.csv data.db
+"""
+
+## Import modules
+import contextlib
+import csv
+import hashlib
+import io
+import os
+import re
+import sqlite3
+import sys
+import threading
+from collections import OrderedDict
+try:
+    import fcntl
+except ImportError: # Windows: no advisory locks, single process only
+    fcntl = None
+import pandas as pd
+from image_index import INDEXED_COLUMNS, InvertedIndex, hamming_distance, hash_bands, split_terms
+
+## Constants
+COLUMNS = [
+    'image_name',
+    'image_code',
+    'image_keywords',
+    'image_features',
+    'image_access',
+    'user_pass',
+    'unique_uuid',
+    'image_size',
+    'image_encoding',
+    'image_hash',
+    'image_phash',
+    'image_owner'
+]
+ACCESS_COLUMNS = ['image_access', 'image_owner'] # who may see an image
+TERM_COLUMNS = INDEXED_COLUMNS + ['image_hash', 'image_phash'] + ACCESS_COLUMNS # columns kept in the term index
+PHASH_BANDS = 4 # finds every perceptual hash within 3 bits
+SQLITE_EXTENSIONS = ['.db', '.sqlite', '.sqlite3']
+BLOB_REFERENCE = re.compile(r'^[0-9a-f]{64}$')
+JOURNAL_COMPACT_BYTES = 4 * 1024 * 1024 # journal size that triggers a compaction into data.csv
+SQLITE_TIMEOUT = 30 # seconds a writer waits for another process's transaction
+TAIL_CHECK_BYTES = 64 # bytes before a tail() position compared to tell it is still valid
+
+## Functions
+def content_hash(data):
+    '''
+    :param data: bytes of an image
+    :return: hex SHA-256 digest used as the blob reference
+    '''
+    return hashlib.sha256(data).hexdigest()
+
+def is_blob_reference(value):
+    '''
+    :param value: contents of an image_code cell
+    :return: True if it is a blob reference, False for inline ciphertext
+             written by older versions
+    '''
+    return isinstance(value, str) and BLOB_REFERENCE.match(value) is not None
+
+def legacy_hash(image_name):
+    '''
+    Stands in for the image_hash of a row stored by an older version, which
+    did not hash the files and told duplicates apart by name.
+    :param image_name: name of the image
+    :return: String that cannot be taken for a SHA-256
+    '''
+    return 'name:' + content_hash(str(image_name).encode('utf-8'))
+
+def index_terms(row):
+    '''
+    The comma-joined terms a row contributes to the term index.
+    :param row: dictionary of column -> value
+    :return: dictionary of TERM_COLUMNS -> comma-joined terms
+    '''
+    terms = {column: row.get(column) for column in INDEXED_COLUMNS}
+    terms['image_hash'] = row.get('image_hash')
+    if not isinstance(terms['image_hash'], str) or not terms['image_hash']:
+        terms['image_hash'] = legacy_hash(row.get('image_name'))
+    terms['image_phash'] = ','.join(hash_bands(row.get('image_phash'), PHASH_BANDS))
+    for column in ACCESS_COLUMNS:
+        terms[column] = row.get(column)
+    return terms
+
+@contextlib.contextmanager
+def file_lock(path, exclusive=True):
+    '''
+    Advisory lock shared by every process using the same lock file.
+    :param path: filepath of the lock file (created if missing)
+    :param exclusive: True for one writer, False for any number of readers
+    '''
+    with open(path, 'a') as lock_file:
+        if fcntl is not None:
+            fcntl.flock(lock_file.fileno(), fcntl.LOCK_EX if exclusive else fcntl.LOCK_SH)
+        try:
+            yield
+        finally:
+            if fcntl is not None:
+                fcntl.flock(lock_file.fileno(), fcntl.LOCK_UN)
+
+def write_atomic_text(path, text):
+    '''
+    Writes a small text file via a temporary file + rename.
+    '''
+    temp_path = '%s.%d.%d.tmp' % (path, os.getpid(), threading.get_ident())
+    with open(temp_path, 'w') as temp_file:
+        temp_file.write(text)
+        temp_file.flush()
+        os.fsync(temp_file.fileno())
+    os.replace(temp_path, path)
+
+def write_atomic_csv(path, frame):
+    '''
+    Writes a dataframe as a CSV file via a temporary file + rename, so a
+    crash while writing leaves the old file as it was.
+    '''
+    temp_path = '%s.%d.%d.tmp' % (path, os.getpid(), threading.get_ident())
+    with open(temp_path, 'w', newline='') as temp_file:
+        frame.to_csv(temp_file, index=False)
+        temp_file.flush()
+        os.fsync(temp_file.fileno())
+    os.replace(temp_path, path)
+
+def empty_frame():
+    '''
+    Builds an empty dataframe with the database columns.
+    :return: Pandas dataframe with no rows
+    '''
+    return pd.DataFrame({column: pd.Series(dtype='str') for column in COLUMNS})
+
+def normalize_row(row):
+    '''
+    Converts an image row into plain strings ready to be written
+    (bytes are decoded, UUIDs and missing values become strings).
+    :param row: dictionary of column -> value
+    :return: dictionary with every column in COLUMNS
+    '''
+    values = {}
+    for column in COLUMNS:
+        value = row.get(column)
+        if isinstance(value, bytes):
+            value = value.decode('ascii')
+        elif value is None or (isinstance(value, float) and value != value):
+            value = ''
+        values[column] = str(value)
+    return values
+
+def open_storage(data_path, index_path=None):
+    '''
+    Opens the storage backend that matches the data file extension.
+    :param data_path: filepath of the database (.csv, .db, .sqlite, .sqlite3)
+    :param index_path: filepath of the inverted index (CSV backend only)
+    :return: Storage
+    '''
+    if os.path.splitext(data_path)[1].lower() in SQLITE_EXTENSIONS:
+        return SqliteStorage(data_path)
+    return CsvStorage(data_path, index_path or os.path.splitext(data_path)[0] + '.index.json')
+
+def migrate_csv(csv_path, db_path, batch_size=1000):
+    '''
+    One-shot migration of an existing data.csv into a SQLite database.
+    The CSV is read in chunks so memory stays flat for large files; the
+    rows still in its journal (see CsvStorage) are migrated after them.
+    :param csv_path: filepath of the existing CSV database
+    :param db_path: filepath of the SQLite database to create/extend
+    :param batch_size: number of rows inserted per transaction
+    :return: number of rows migrated
+    '''
+    source = CsvStorage(csv_path, os.path.splitext(csv_path)[0] + '.index.json')
+    storage = SqliteStorage(db_path)
+    migrated = 0
+    try:
+        source._recover()
+        with source._lock(): # no writer can compact the journal into data.csv meanwhile
+            if os.path.exists(csv_path):
+                for chunk in pd.read_csv(csv_path, dtype=str, chunksize=batch_size, keep_default_na=False):
+                    rows = chunk.to_dict('records')
+                    storage.insert_many(rows)
+                    migrated += len(rows)
+            journal = source._read_journal()
+            if journal is not None:
+                rows = journal.to_dict('records')
+                for start in range(0, len(rows), batch_size):
+                    storage.insert_many(rows[start:start + batch_size])
+                migrated += len(rows)
+    finally:
+        storage.close()
+    return migrated
+
+## Classes
+class Storage:
+    '''
+    Interface implemented by every storage backend.
+    '''
+    def load(self):
+        '''
+        :return: Pandas dataframe of every stored row
+        '''
+        raise NotImplementedError
+
+    def insert(self, row):
+        '''
+        Stores a single image row.
+        :param row: dictionary of column -> value
+        '''
+        self.insert_many([row])
+
+    def insert_many(self, rows):
+        '''
+        Stores several image rows in one write.
+        :param rows: List of dictionaries of column -> value
+        '''
+        raise NotImplementedError
+
+    def get(self, uuids):
+        '''
+        :param uuids: iterable of image UUIDs
+        :return: Pandas dataframe of the rows with those UUIDs
+        '''
+        raise NotImplementedError
+
+    def first_uuid(self):
+        '''
+        :return: UUID of the first stored image, None if there is none. It
+                 stays the same while rows are added and changes when the
+                 database is deleted or recreated (see ScanManifest).
+        '''
+        raise NotImplementedError
+
+    def version(self):
+        '''
+        :return: a value that changes whenever any process changes the
+                 stored rows (for invalidating caches)
+        '''
+        raise NotImplementedError
+
+    def tail(self, position=None):
+        '''
+        Reads the rows stored after a position, so a cache can catch up
+        with the writes of every process without loading every row again.
+        :param position: position returned by an earlier call, None for
+                         every row
+        :return: Tuple of (Pandas dataframe of the rows stored since, like
+                 load(), new position). The dataframe is None when rows were
+                 changed in place or the database was recreated since: call
+                 tail() again without a position.
+        '''
+        raise NotImplementedError
+
+    def find_duplicate(self, image_hash, image_name=None):
+        '''
+        :param image_hash: SHA-256 of an image file
+        :param image_name: name of the image, also matched against the rows
+                           stored without a hash by older versions
+        :return: UUID of a stored image with exactly that hash, or None
+        '''
+        raise NotImplementedError
+
+    def find_near_duplicates(self, image_phash, max_distance):
+        '''
+        :param image_phash: perceptual hash of an image
+        :param max_distance: largest Hamming distance counted as a near-duplicate
+                             (at most PHASH_BANDS - 1 to find every match)
+        :return: List of UUIDs of stored images within max_distance
+        '''
+        raise NotImplementedError
+
+    def update_many(self, rows):
+        '''
+        Overwrites stored rows, matched by unique_uuid. Only the columns
+        present in each row are changed.
+        :param rows: List of dictionaries of column -> value
+        '''
+        raise NotImplementedError
+
+    def rebuild_index(self):
+        '''
+        Rebuilds the keyword/feature index from the stored rows.
+        '''
+        raise NotImplementedError
+
+    def close(self):
+        '''
+        Flushes pending state and releases the backend.
+        '''
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+class CsvStorage(Storage):
+    '''
+    The original data.csv database, safe for several processes at once.
+    Writers append their rows to a write-ahead journal (<data>.journal,
+    same CSV format) while holding an exclusive lock on <data>.lock, and
+    the journal is compacted into data.csv (with the inverted index saved
+    alongside) when it grows past JOURNAL_COMPACT_BYTES or the storage is
+    closed. Readers hold a shared lock while reading data.csv and the
+    journal, so they always see a consistent snapshot of both.
+    '''
+    def __init__(self, path, index_path):
+        self.path = path
+        self.index_path = index_path
+        self.journal_path = path + '.journal'
+        self.marker_path = self.journal_path + '.compacting'
+        self.lock_path = path + '.lock'
+        self._index = None
+        self._data_state = None # (size, mtime) of data.csv the index was built for
+        self._journal_offset = 0 # bytes of the journal already in the index
+        self._locked = None
+
+    def load(self):
+        self._recover()
+        with self._lock():
+            frames = [self._read_data()]
+            journal = self._read_journal()
+            if journal is not None:
+                frames.append(journal)
+        if len(frames) == 1:
+            return frames[0]
+        return pd.concat(frames, ignore_index=True)
+
+    def insert_many(self, rows):
+        if not rows:
+            return
+        frame = pd.DataFrame([normalize_row(row) for row in rows], columns=COLUMNS)
+        data = frame.to_csv(index=False, header=False).encode('utf-8')
+        with self._lock(exclusive=True):
+            self._recover()
+            self._trim_journal()
+            with open(self.journal_path, 'ab') as journal_file:
+                journal_file.write(data) # one write per batch
+                journal_file.flush()
+                os.fsync(journal_file.fileno())
+            if os.path.getsize(self.journal_path) >= JOURNAL_COMPACT_BYTES:
+                self._compact()
+
+    def get(self, uuids):
+        frame = self.load()
+        return frame[frame['unique_uuid'].isin(set(uuids))]
+
+    def first_uuid(self):
+        self._recover()
+        with self._lock():
+            if os.path.exists(self.path):
+                frame = pd.read_csv(self.path, dtype=str, nrows=1)
+                if len(frame) and 'unique_uuid' in frame:
+                    return frame['unique_uuid'].iloc[0]
+            if not os.path.exists(self.journal_path):
+                return None
+            with open(self.journal_path, 'rb') as journal_file:
+                data = journal_file.read(65536) # the first rows are enough
+        journal = self._parse_journal(data[:data.rfind(b'\n') + 1])
+        return None if journal is None else journal['unique_uuid'].iloc[0]
+
+    def version(self):
+        with self._lock():
+            return (self._state(self.path), self._state(self.journal_path))
+
+    def tail(self, position=None):
+        '''
+        Positions count the bytes of the rows in data.csv (without its
+        header) followed by the complete rows of the journal. A compaction
+        moves rows from one to the other, so it leaves positions valid;
+        rewriting data.csv (update_many()) replaces the file, and a
+        recreated database fails the check of the bytes before a position.
+        '''
+        self._recover()
+        with self._lock():
+            inode, header, body_size = self._data_layout()
+            offset = 0
+            if position is not None:
+                if not isinstance(position, list) or len(position) != 4 or position[0] != 'csv':
+                    return None, None # written by an older version
+                if position[1] is not None and position[1] != inode:
+                    return None, None
+                offset = position[2]
+            start = max(0, (offset or body_size) - TAIL_CHECK_BYTES)
+            data = b''
+            if start < body_size:
+                with open(self.path, 'rb') as data_file:
+                    data_file.seek(len(header) + start)
+                    data = data_file.read(body_size - start)
+            data += self._journal_bytes(max(0, start - body_size))
+            if offset > start + len(data) or (offset and content_hash(data[:offset - start]) != position[3]):
+                return None, None
+            if offset:
+                frames = []
+                if offset < body_size:
+                    frame = pd.read_csv(io.BytesIO(header + data[offset - start:body_size - start]), dtype=str)
+                    frames.append(frame.drop(columns=[c for c in frame.columns if c.startswith('Unnamed')]))
+                frames.append(self._parse_journal(data[max(offset, body_size) - start:]))
+            else:
+                frames = [self._read_data(), self._parse_journal(data[body_size - start:])]
+        frames = [frame for frame in frames if frame is not None and len(frame)]
+        frame = pd.concat(frames, ignore_index=True) if len(frames) > 1 else frames[0] if frames else empty_frame()
+        return frame, ['csv', inode, start + len(data), content_hash(data[-TAIL_CHECK_BYTES:])]
+
+    def find_duplicate(self, image_hash, image_name=None):
+        terms = [image_hash] if image_name is None else [image_hash, legacy_hash(image_name)]
+        return next(iter(self.index.lookup('image_hash', terms)), None)
+
+    def find_near_duplicates(self, image_phash, max_distance):
+        candidates = self.index.lookup('image_phash', hash_bands(image_phash, PHASH_BANDS))
+        if not candidates:
+            return []
+        frame = self.get(candidates)
+        return [uuid for uuid, phash in zip(frame['unique_uuid'], frame['image_phash'])
+                if isinstance(phash, str) and hamming_distance(phash, image_phash) <= max_distance]
+
+    def update_many(self, rows):
+        if not rows:
+            return
+        with self._lock(exclusive=True):
+            self._compact()
+            frame = self._read_data().reindex(columns=COLUMNS).astype(object).set_index('unique_uuid', drop=False)
+            for row in rows:
+                values = normalize_row(row)
+                if values['unique_uuid'] not in frame.index:
+                    continue
+                for column in row:
+                    if column in COLUMNS and column != 'unique_uuid':
+                        frame.loc[values['unique_uuid'], column] = values[column]
+            write_atomic_csv(self.path, frame)
+            self.rebuild_index()
+
+    @property
+    def index(self):
+        '''
+        The inverted index over data.csv and the journal. The saved index
+        is loaded on first use (rebuilt if it is missing or older than the
+        data file), then kept up to date with the journal; it is reloaded
+        when another process compacts the journal into data.csv.
+        '''
+        self._recover()
+        with self._lock():
+            if self._index is None or self._data_state != self._state(self.path):
+                self._load_index()
+            self._read_journal_into_index()
+        return self._index
+
+    def rebuild_index(self):
+        with self._lock(exclusive=True):
+            self._index = InvertedIndex(TERM_COLUMNS)
+            for row in self._read_data().to_dict('records'):
+                self._index.add(row['unique_uuid'], index_terms(row))
+            self._index.save(self.index_path)
+            self._data_state = self._state(self.path)
+            self._journal_offset = 0
+        return self._index
+
+    def compact(self):
+        '''
+        Moves the rows in the journal into data.csv and saves the index.
+        :return: number of rows moved
+        '''
+        with self._lock(exclusive=True):
+            return self._compact()
+
+    def close(self):
+        if os.path.exists(self.journal_path) and os.path.getsize(self.journal_path):
+            self.compact()
+
+    def _lock(self, exclusive=False):
+        '''
+        Shared (readers) or exclusive (writers) lock on the lock file.
+        Nested calls reuse the lock already held.
+        '''
+        if self._locked == 'exclusive' or (self._locked == 'shared' and not exclusive):
+            return contextlib.nullcontext()
+        if self._locked == 'shared':
+            raise RuntimeError('cannot upgrade a shared lock')
+        return self._hold_lock('exclusive' if exclusive else 'shared')
+
+    @contextlib.contextmanager
+    def _hold_lock(self, mode):
+        with file_lock(self.lock_path, exclusive=(mode == 'exclusive')):
+            self._locked = mode
+            try:
+                yield
+            finally:
+                self._locked = None
+
+    def _recover(self):
+        '''
+        Finishes the recovery of a compaction interrupted by a crash (see
+        _compact()). Readers call it too, so they never see the rows of
+        the journal twice; it takes the exclusive lock, so it is skipped
+        while this backend already holds the shared one.
+        '''
+        if not os.path.exists(self.marker_path) or self._locked == 'shared':
+            return
+        with self._lock(exclusive=True):
+            if not os.path.exists(self.marker_path): # recovered by another process meanwhile
+                return
+            with open(self.marker_path) as marker_file:
+                sizes = [int(size) for size in marker_file.read().split()]
+            data_size = sizes[0] if sizes else 0
+            journal_size = sizes[1] if len(sizes) > 1 else 1 # markers of older versions only hold the data size
+            if self._state(self.journal_path) is not None and os.path.getsize(self.journal_path) >= journal_size:
+                # the journal still holds the rows: undo the partial append, the next compaction repeats it
+                if os.path.exists(self.path) and data_size:
+                    os.truncate(self.path, data_size)
+                elif os.path.exists(self.path):
+                    os.remove(self.path)
+            # otherwise the journal was already emptied, so data.csv holds every row
+            os.remove(self.marker_path)
+            self._index = None
+
+    def _trim_journal(self):
+        '''
+        Cuts a row left half-written by a crash off the end of the journal
+        (exclusive lock held), so the next batch does not run into it.
+        '''
+        if not os.path.exists(self.journal_path):
+            return
+        with open(self.journal_path, 'rb+') as journal_file:
+            size = journal_file.seek(0, os.SEEK_END)
+            end = size
+            while end > 0:
+                start = max(0, end - 65536)
+                journal_file.seek(start)
+                newline = journal_file.read(end - start).rfind(b'\n')
+                if newline >= 0:
+                    end = start + newline + 1
+                    break
+                end = start
+            if end != size:
+                journal_file.truncate(end)
+
+    def _state(self, path):
+        if not os.path.exists(path):
+            return None
+        stat = os.stat(path)
+        return (stat.st_size, stat.st_mtime_ns)
+
+    def _data_layout(self):
+        '''
+        :return: Tuple of (inode of data.csv, its header line as bytes, size
+                 of the rows after the header); (None, b'', 0) without a file
+        '''
+        if not os.path.exists(self.path):
+            return None, b'', 0
+        with open(self.path, 'rb') as data_file:
+            header = data_file.readline()
+            return os.fstat(data_file.fileno()).st_ino, header, data_file.seek(0, os.SEEK_END) - len(header)
+
+    def _read_data(self):
+        if not os.path.exists(self.path):
+            return empty_frame()
+        frame = pd.read_csv(self.path, dtype=str)
+        # files written by older versions carry the dataframe index as an unnamed column
+        return frame.drop(columns=[c for c in frame.columns if c.startswith('Unnamed')])
+
+    def _journal_bytes(self, offset=0):
+        '''
+        :return: the complete rows of the journal after offset (a batch cut
+                 short by a crash is ignored)
+        '''
+        if not os.path.exists(self.journal_path):
+            return b''
+        with open(self.journal_path, 'rb') as journal_file:
+            journal_file.seek(offset)
+            data = journal_file.read()
+        return data[:data.rfind(b'\n') + 1]
+
+    def _parse_journal(self, data):
+        if not data:
+            return None
+        return pd.read_csv(io.BytesIO(data), header=None, names=COLUMNS, dtype=str)
+
+    def _read_journal(self):
+        return self._parse_journal(self._journal_bytes())
+
+    def _load_index(self):
+        fresh = os.path.exists(self.index_path) and (not os.path.exists(self.path)
+            or os.path.getmtime(self.index_path) >= os.path.getmtime(self.path))
+        if fresh:
+            try:
+                self._index = InvertedIndex.load(self.index_path)
+                fresh = sorted(self._index.columns) == sorted(TERM_COLUMNS)
+            except ValueError:
+                fresh = False # unreadable or old format, rebuild below
+        if not fresh:
+            self._index = InvertedIndex(TERM_COLUMNS)
+            for row in self._read_data().to_dict('records'):
+                self._index.add(row['unique_uuid'], index_terms(row))
+            # only the shared lock is held: other readers may save the same
+            # index meanwhile, each through its own temporary file
+            self._index.save(self.index_path)
+        self._data_state = self._state(self.path)
+        self._journal_offset = 0
+
+    def _read_journal_into_index(self):
+        data = self._journal_bytes(self._journal_offset)
+        journal = self._parse_journal(data)
+        if journal is not None:
+            for row in journal.to_dict('records'):
+                self._index.add(row['unique_uuid'], index_terms(row))
+        self._journal_offset += len(data)
+
+    def _compact(self):
+        '''
+        Appends the journal to data.csv (exclusive lock held). A marker file
+        records the sizes of data.csv and of the journal first: if the
+        compaction is interrupted while the journal still holds the rows,
+        the append is rolled back (see _recover()) instead of duplicating
+        them; once the journal has been emptied, data.csv is kept.
+        '''
+        self._recover() # an earlier compaction was interrupted
+        data = self._journal_bytes()
+        if not data:
+            return 0
+        self._check_header()
+        index = self.index # data.csv + journal
+        data_size = os.path.getsize(self.path) if os.path.exists(self.path) else 0
+        write_atomic_text(self.marker_path, '%d %d' % (data_size, len(data)))
+        with open(self.path, 'ab') as data_file:
+            if data_file.tell() == 0:
+                data_file.write((','.join(COLUMNS) + '\n').encode('utf-8'))
+            data_file.write(data)
+            data_file.flush()
+            os.fsync(data_file.fileno())
+        index.save(self.index_path)
+        open(self.journal_path, 'wb').close()
+        os.remove(self.marker_path)
+        self._data_state = self._state(self.path)
+        self._journal_offset = 0
+        return len(self._parse_journal(data))
+
+    def _check_header(self):
+        '''
+        Rewrites files from older versions (extra index column, different
+        column order) once so that rows can be appended to them.
+        '''
+        if not os.path.exists(self.path):
+            return
+        with open(self.path, newline='') as data_file:
+            header = next(csv.reader(data_file), None)
+        if header != COLUMNS:
+            write_atomic_csv(self.path, self._read_data().reindex(columns=COLUMNS))
+            self._index = None
+
+class SqliteStorage(Storage):
+    '''
+    SQLite database with indexed name/UUID columns and an image_terms
+    join table holding one row per (column, term, image).
+    '''
+    SCHEMA = '''
+        CREATE TABLE IF NOT EXISTS images (
+            id INTEGER PRIMARY KEY,
+            image_name TEXT NOT NULL,
+            image_code TEXT,
+            image_keywords TEXT,
+            image_features TEXT,
+            image_access TEXT,
+            user_pass TEXT,
+            unique_uuid TEXT NOT NULL UNIQUE,
+            image_size TEXT,
+            image_encoding TEXT,
+            image_hash TEXT,
+            image_phash TEXT,
+            image_owner TEXT
+        );
+        CREATE TABLE IF NOT EXISTS image_terms (
+            field TEXT NOT NULL,
+            term TEXT NOT NULL,
+            image_id INTEGER NOT NULL REFERENCES images (id) ON DELETE CASCADE,
+            PRIMARY KEY (field, term, image_id)
+        ) WITHOUT ROWID;
+        CREATE INDEX IF NOT EXISTS image_terms_image_id ON image_terms (image_id);
+    '''
+    INDEXES = '''
+        CREATE INDEX IF NOT EXISTS images_image_name ON images (image_name);
+        CREATE INDEX IF NOT EXISTS images_image_hash ON images (image_hash);
+        CREATE INDEX IF NOT EXISTS images_image_access ON images (image_access);
+        CREATE INDEX IF NOT EXISTS images_image_owner ON images (image_owner);
+    '''
+
+    def __init__(self, path):
+        self.path = path
+        self.connection = sqlite3.connect(path, timeout=SQLITE_TIMEOUT)
+        self.connection.execute('PRAGMA journal_mode=WAL')
+        self.connection.execute('PRAGMA foreign_keys=ON')
+        self.connection.executescript(self.SCHEMA)
+        # databases created by older versions lack the newer columns
+        existing = [row[1] for row in self.connection.execute('PRAGMA table_info(images)')]
+        with self.connection:
+            for column in COLUMNS:
+                if column not in existing:
+                    self.connection.execute('ALTER TABLE images ADD COLUMN %s TEXT' % column)
+        self.connection.executescript(self.INDEXES)
+
+    def load(self):
+        return self._query('SELECT %s FROM images ORDER BY id' % ', '.join(COLUMNS))
+
+    def insert_many(self, rows):
+        if not rows:
+            return
+        with self.connection:
+            for row in rows:
+                values = normalize_row(row)
+                cursor = self.connection.execute(
+                    'INSERT INTO images (%s) VALUES (%s)' % (', '.join(COLUMNS), ', '.join('?' * len(COLUMNS))),
+                    [values[column] for column in COLUMNS])
+                self._insert_terms(cursor.lastrowid, values)
+
+    def get(self, uuids):
+        uuids = [str(u) for u in uuids]
+        frames = []
+        for start in range(0, len(uuids), 500): # stay below SQLite's bound-parameter limit
+            chunk = uuids[start:start + 500]
+            frames.append(self._query('SELECT %s FROM images WHERE unique_uuid IN (%s) ORDER BY id'
+                                      % (', '.join(COLUMNS), ', '.join('?' * len(chunk))), chunk))
+        return pd.concat(frames, ignore_index=True) if frames else empty_frame()
+
+    def first_uuid(self):
+        row = self.connection.execute('SELECT unique_uuid FROM images ORDER BY id LIMIT 1').fetchone()
+        return None if row is None else row[0]
+
+    def version(self):
+        # data_version changes with other connections' commits, total_changes with this one's
+        return (self.connection.execute('PRAGMA data_version').fetchone()[0], self.connection.total_changes)
+
+    def tail(self, position=None):
+        '''
+        Positions hold the last id read and its UUID (a recreated database
+        numbers its rows again) plus PRAGMA user_version, which
+        update_many() increments.
+        '''
+        version = self.connection.execute('PRAGMA user_version').fetchone()[0]
+        last_id, last_uuid = 0, None
+        if position is not None:
+            if not isinstance(position, list) or len(position) != 4 or position[0] != 'sqlite' or position[1] != version:
+                return None, None
+            last_id, last_uuid = position[2], position[3]
+            row = self.connection.execute('SELECT unique_uuid FROM images WHERE id = ?', (last_id,)).fetchone()
+            if last_id and (row is None or row[0] != last_uuid):
+                return None, None
+        frame = self._query('SELECT id, %s FROM images WHERE id > ? ORDER BY id' % ', '.join(COLUMNS), (last_id,))
+        if len(frame):
+            last_id, last_uuid = int(frame['id'].iloc[-1]), frame['unique_uuid'].iloc[-1]
+        return frame.drop(columns='id'), ['sqlite', version, last_id, last_uuid]
+
+    def find_duplicate(self, image_hash, image_name=None):
+        cursor = self.connection.execute('SELECT unique_uuid FROM images WHERE image_hash = ? LIMIT 1', (image_hash,))
+        row = cursor.fetchone()
+        if row is None and image_name is not None:
+            cursor = self.connection.execute("SELECT unique_uuid FROM images WHERE image_name = ? "
+                                             "AND (image_hash IS NULL OR image_hash = '') LIMIT 1", (image_name,))
+            row = cursor.fetchone()
+        return row[0] if row else None
+
+    def find_near_duplicates(self, image_phash, max_distance):
+        bands = hash_bands(image_phash, PHASH_BANDS)
+        if not bands:
+            return []
+        cursor = self.connection.execute(
+            'SELECT unique_uuid, image_phash FROM images WHERE id IN ('
+            "SELECT image_id FROM image_terms WHERE field = 'image_phash' AND term IN (%s))"
+            % ', '.join('?' * len(bands)), bands)
+        return [uuid for uuid, phash in cursor.fetchall()
+                if phash and hamming_distance(phash, image_phash) <= max_distance]
+
+    def update_many(self, rows):
+        with self.connection:
+            for row in rows:
+                values = normalize_row(row)
+                columns = [column for column in row if column in COLUMNS and column != 'unique_uuid']
+                if not columns:
+                    continue
+                self.connection.execute(
+                    'UPDATE images SET %s WHERE unique_uuid = ?' % ', '.join('%s = ?' % c for c in columns),
+                    [values[column] for column in columns] + [values['unique_uuid']])
+                if any(column in TERM_COLUMNS for column in columns):
+                    image_id = self.connection.execute('SELECT id FROM images WHERE unique_uuid = ?',
+                                                       (values['unique_uuid'],)).fetchone()[0]
+                    self.connection.execute('DELETE FROM image_terms WHERE image_id = ?', (image_id,))
+                    self._insert_terms(image_id, self._row(image_id))
+            # in the same transaction: tail() positions taken before it are no longer valid
+            version = self.connection.execute('PRAGMA user_version').fetchone()[0]
+            self.connection.execute('PRAGMA user_version = %d' % (version + 1))
+
+    def rebuild_index(self):
+        with self.connection:
+            self.connection.execute('DELETE FROM image_terms')
+            cursor = self.connection.execute('SELECT id, %s FROM images' % ', '.join(TERM_COLUMNS))
+            for row in cursor.fetchall():
+                self._insert_terms(row[0], dict(zip(TERM_COLUMNS, row[1:])))
+
+    def close(self):
+        self.connection.close()
+
+    def _insert_terms(self, image_id, values):
+        terms = index_terms(values)
+        self.connection.executemany(
+            'INSERT OR IGNORE INTO image_terms (field, term, image_id) VALUES (?, ?, ?)',
+            [(column, term, image_id) for column in TERM_COLUMNS if column not in ACCESS_COLUMNS
+             for term in split_terms(terms[column])])
+
+    def _row(self, image_id):
+        cursor = self.connection.execute('SELECT %s FROM images WHERE id = ?' % ', '.join(COLUMNS), (image_id,))
+        return dict(zip(COLUMNS, cursor.fetchone()))
+
+    def _query(self, sql, params=()):
+        return pd.read_sql_query(sql, self.connection, params=params, dtype=str)
+
+class BlobStore:
+    '''
+    Content-addressed store for encrypted image bytes. Each blob lives at
+    <root>/<hash[0:2]>/<hash[2:4]>/<hash>, where hash is the SHA-256 of
+    the unencrypted image bytes, so identical images are stored once.
+    '''
+    def __init__(self, root):
+        self.root = root
+
+    def path(self, digest):
+        '''
+        :param digest: blob reference (hex SHA-256)
+        :return: filepath of the blob
+        '''
+        return os.path.join(self.root, digest[0:2], digest[2:4], digest)
+
+    def exists(self, digest):
+        return os.path.exists(self.path(digest))
+
+    def write(self, digest, ciphertext):
+        '''
+        Writes a blob atomically (temp file + rename), so readers never
+        see a partial blob and concurrent writers of the same image are safe.
+        :param digest: blob reference (hex SHA-256 of the plaintext)
+        :param ciphertext: encrypted image bytes
+        '''
+        self._write(self.path(digest), ciphertext)
+
+    def _write(self, path, data):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        temp_path = '%s.%d.tmp' % (path, os.getpid())
+        with open(temp_path, 'wb') as blob_file:
+            blob_file.write(data)
+        os.replace(temp_path, path)
+
+    def read(self, digest):
+        '''
+        :param digest: blob reference
+        :return: encrypted image bytes
+        '''
+        with open(self.path(digest), 'rb') as blob_file:
+            return blob_file.read()
+
+    def derivative_path(self, digest, name):
+        '''
+        :param digest: blob reference
+        :param name: name of the derivative (e.g. 'thumbnail', 'preview')
+        :return: filepath of the derivative stored next to the blob
+        '''
+        return self.path(digest) + '.' + name
+
+    def has_derivative(self, digest, name):
+        return os.path.exists(self.derivative_path(digest, name))
+
+    def write_derivative(self, digest, name, ciphertext):
+        '''
+        Writes an encrypted smaller version of an image next to its blob
+        (atomically, like write()).
+        :param digest: blob reference of the original image
+        :param name: name of the derivative
+        :param ciphertext: encrypted image bytes of the derivative
+        '''
+        self._write(self.derivative_path(digest, name), ciphertext)
+
+    def read_derivative(self, digest, name):
+        '''
+        :param digest: blob reference of the original image
+        :param name: name of the derivative
+        :return: encrypted image bytes, or None if the derivative was never made
+        '''
+        try:
+            with open(self.derivative_path(digest, name), 'rb') as blob_file:
+                return blob_file.read()
+        except FileNotFoundError:
+            return None
+
+    def features_path(self, digest):
+        '''
+        :param digest: blob reference
+        :return: filepath of the encrypted features stored next to the blob
+        '''
+        return self.path(digest) + '.features'
+
+    def plain_features_path(self, digest):
+        '''
+        :param digest: blob reference
+        :return: filepath of the unencrypted features written by older versions
+        '''
+        return self.path(digest) + '.features.npz'
+
+    def write_features(self, digest, ciphertext):
+        '''
+        Stores the extracted features of an image (an encrypted NumPy .npz
+        file) next to its blob.
+        :param digest: blob reference
+        :param ciphertext: encrypted bytes of the features
+        '''
+        self._write(self.features_path(digest), ciphertext)
+
+    def read_features(self, digest):
+        '''
+        :param digest: blob reference
+        :return: encrypted bytes of the features, or None if none were stored
+        '''
+        try:
+            with open(self.features_path(digest), 'rb') as features_file:
+                return features_file.read()
+        except FileNotFoundError:
+            return None
+
+    def digests(self):
+        '''
+        Walks the blob directory lazily.
+        :return: generator of the references of every stored blob
+        '''
+        if not os.path.isdir(self.root):
+            return
+        for first in os.scandir(self.root):
+            if not first.is_dir():
+                continue
+            for second in os.scandir(first.path):
+                if not second.is_dir():
+                    continue
+                for entry in os.scandir(second.path):
+                    if is_blob_reference(entry.name):
+                        yield entry.name
+
+class LRUCache:
+    '''
+    Thread-safe least-recently-used cache of bytes values, bounded by the
+    total size of the values rather than their number.
+    '''
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.size = 0
+        self._items = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._items)
+
+    def get(self, key):
+        '''
+        :param key: cache key
+        :return: the cached value (now most recently used), or None
+        '''
+        with self._lock:
+            value = self._items.get(key)
+            if value is not None:
+                self._items.move_to_end(key)
+            return value
+
+    def put(self, key, value):
+        '''
+        Caches a value, evicting the least recently used values until the
+        cache fits in max_bytes. Values larger than max_bytes are not cached.
+        :param key: cache key
+        :param value: bytes
+        '''
+        with self._lock:
+            old = self._items.pop(key, None)
+            if old is not None:
+                self.size -= len(old)
+            if len(value) > self.max_bytes:
+                return
+            self._items[key] = value
+            self.size += len(value)
+            self._evict()
+
+    def resize(self, max_bytes):
+        '''
+        Changes the byte budget, evicting values if it shrank.
+        :param max_bytes: new budget in bytes
+        '''
+        with self._lock:
+            self.max_bytes = max_bytes
+            self._evict()
+
+    def clear(self):
+        with self._lock:
+            self._items.clear()
+            self.size = 0
+
+    def _evict(self):
+        while self.size > self.max_bytes:
+            self.size -= len(self._items.popitem(last=False)[1])
+
+# main guard
+if __name__ == '__main__':
+    if len(sys.argv) != 3:
+        sys.exit('usage: python image_storage.py <data.csv> <data.db>')
+    print('%d rows migrated' % migrate_csv(sys.argv[1], sys.argv[2]))
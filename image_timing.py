@@ -0,0 +1,134 @@
+"""Image Repository Stage Timing
+
+Optional per-stage timing of the ingest and search hot paths (decode,
+encode, encrypt, persist, search, ...). It is off by default and then
+costs one global lookup per stage. Turn it on for a run with the
+IMAGE_REPO_TIMING environment variable:
+
+    IMAGE_REPO_TIMING=1           print a JSON summary to stderr at exit
+    IMAGE_REPO_TIMING=timing.json write the JSON summary to that file at exit
+
+or at runtime with enable(). Stages that run in ingest worker processes
+are timed in those processes, so time a run with IMAGE_REPO_WORKERS=1 to
+see every stage in one summary.
+
+This file can be imported as a module and contains the following:
+
+    * enable() - turns the timing on or off at runtime
+    * stage() - context manager timing one stage of the work
+    * record() - adds one duration of a stage
+    * percentile() - nearest-rank percentile of a List of durations
+    * summary() - count, total and latency percentiles of every stage
+    * reset() - forgets the recorded durations
+"""
+
+## Import modules
+import atexit
+import json
+import math
+import os
+import sys
+import threading
+import time
+from contextlib import nullcontext
+
+## Constants
+TIMING_SETTING = os.environ.get('IMAGE_REPO_TIMING', '')
+MAX_SAMPLES = 100000 # durations kept per stage for the percentiles (count and total are exact)
+ENABLED = TIMING_SETTING not in ['', '0']
+_durations = {}
+_totals = {}
+_lock = threading.Lock()
+_NOT_TIMED = nullcontext()
+
+## Functions
+def enable(enabled=True):
+    '''
+    :param enabled: True to record stage durations from now on, False to stop
+    '''
+    global ENABLED
+    ENABLED = enabled
+
+def stage(name):
+    '''
+    Times the code inside a with block as one occurrence of a stage:
+
+        with stage('encrypt'):
+            token = F.encrypt(image_bytes)
+
+    :param name: stage name
+    :return: context manager (a shared no-op one while timing is off)
+    '''
+    if not ENABLED:
+        return _NOT_TIMED
+    return _Stage(name)
+
+def record(name, seconds):
+    '''
+    :param name: stage name
+    :param seconds: duration of one occurrence of the stage
+    '''
+    with _lock:
+        count, total = _totals.get(name, (0, 0.0))
+        _totals[name] = (count + 1, total + seconds)
+        durations = _durations.setdefault(name, [])
+        if len(durations) < MAX_SAMPLES:
+            durations.append(seconds)
+
+def percentile(values, fraction):
+    '''
+    :param values: sorted List of numbers
+    :param fraction: 0.5 for the median, 0.99 for the 99th percentile
+    :return: nearest-rank percentile (0.0 for an empty List)
+    '''
+    if not values:
+        return 0.0
+    return values[min(len(values) - 1, max(0, math.ceil(fraction * len(values)) - 1))]
+
+def summary():
+    '''
+    :return: dictionary of stage name -> dictionary of count, total_s and
+             the p50_ms, p95_ms, p99_ms and max_ms latencies
+    '''
+    with _lock:
+        stages = {name: (_totals[name], sorted(durations)) for name, durations in _durations.items()}
+    return {name: {
+        'count': count,
+        'total_s': round(total, 6),
+        'p50_ms': round(percentile(durations, 0.50) * 1000, 4),
+        'p95_ms': round(percentile(durations, 0.95) * 1000, 4),
+        'p99_ms': round(percentile(durations, 0.99) * 1000, 4),
+        'max_ms': round(durations[-1] * 1000, 4)
+    } for name, ((count, total), durations) in sorted(stages.items())}
+
+def reset():
+    '''
+    Forgets every recorded duration.
+    '''
+    with _lock:
+        _durations.clear()
+        _totals.clear()
+
+def _report():
+    if not _totals:
+        return
+    report = json.dumps(summary(), indent=1)
+    if TIMING_SETTING == '1':
+        print(report, file=sys.stderr)
+    else:
+        with open(TIMING_SETTING, 'w') as report_file:
+            report_file.write(report)
+
+## Classes
+class _Stage:
+    def __init__(self, name):
+        self.name = name
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+
+    def __exit__(self, *exc):
+        record(self.name, time.perf_counter() - self.start)
+
+if ENABLED:
+    atexit.register(_report)
@@ -0,0 +1,113 @@
+"""Image Repository Users
+
+User accounts for the Searchable Image Repository. Every image row
+records the UUID of its owner (image_owner); private images are only
+visible to their owner.
+
+Accounts are kept in a JSON file next to the database. Passwords are
+never stored: each user has a random salt and the scrypt hash of the
+password with that salt.
+
+This file can be imported as a module and contains the following:
+
+    * hash_password() - salted scrypt hash of a password
+    * verify_password() - checks a password against a stored hash
+    * UserStore - creates users and checks their credentials
+"""
+
+## Import modules
+import hashlib
+import hmac
+import json
+import os
+import uuid
+from image_crypto import write_atomic
+from image_storage import file_lock
+
+## Constants
+SCRYPT_N = 2 ** 14
+SCRYPT_R = 8
+SCRYPT_P = 1
+SALT_BYTES = 16
+
+## Functions
+def hash_password(password, salt=None, n=SCRYPT_N, r=SCRYPT_R, p=SCRYPT_P):
+    '''
+    :param password: String
+    :param salt: bytes (a new random salt by default)
+    :return: String 'scrypt$n$r$p$salt$hash' (hex salt and hash)
+    '''
+    salt = salt or os.urandom(SALT_BYTES)
+    digest = hashlib.scrypt(password.encode('utf-8'), salt=salt, n=n, r=r, p=p, dklen=32)
+    return 'scrypt$%d$%d$%d$%s$%s' % (n, r, p, salt.hex(), digest.hex())
+
+def verify_password(password, stored):
+    '''
+    :param password: String to check
+    :param stored: String from hash_password()
+    :return: True if the password matches (compared in constant time)
+    '''
+    try:
+        scheme, n, r, p, salt, _ = stored.split('$')
+    except (AttributeError, ValueError):
+        return False
+    if scheme != 'scrypt':
+        return False
+    expected = hash_password(password, bytes.fromhex(salt), int(n), int(r), int(p))
+    return hmac.compare_digest(expected, stored)
+
+## Classes
+class UserStore:
+    '''
+    User accounts in a JSON file: name -> {id, password hash}. Changes
+    are written atomically under a file lock, so several processes can
+    register users at once.
+    '''
+    def __init__(self, path):
+        self.path = path
+        self.lock_path = path + '.lock'
+
+    def create(self, name, password):
+        '''
+        Registers a new user.
+        :param name: user name (case-insensitive, must be new)
+        :param password: password (not empty)
+        :return: UUID of the new user
+        '''
+        name = name.strip().lower()
+        if not name or not password:
+            raise ValueError('user name and password are required')
+        password_hash = hash_password(password) # slow on purpose, done outside the lock
+        with file_lock(self.lock_path):
+            users = self._load()
+            if name in users:
+                raise ValueError('user already exists: %s' % name)
+            user_id = uuid.uuid4().hex
+            users[name] = {'id': user_id, 'password': password_hash}
+            write_atomic(self.path, json.dumps(users, indent=1).encode('utf-8'))
+        return user_id
+
+    def authenticate(self, name, password):
+        '''
+        :param name: user name
+        :param password: password
+        :return: UUID of the user, or None if the name or password is wrong
+        '''
+        user = self._load().get(name.strip().lower())
+        if user is None or not verify_password(password, user['password']):
+            return None
+        return user['id']
+
+    def get_id(self, name):
+        '''
+        :param name: user name
+        :return: UUID of the user, or None if there is no such user
+        '''
+        user = self._load().get(name.strip().lower())
+        return user['id'] if user else None
+
+    def _load(self):
+        if not os.path.exists(self.path):
+            return {}
+        with open(self.path) as users_file:
+            return json.load(users_file)
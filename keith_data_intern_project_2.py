@@ -159,6 +159,7 @@ def store_images(directory):
     IMAGE_FORMATS = ['.bmp', '.jpeg', '.jpg', '.png', '.tiff']
 
     DATA_DF = get_dataframe()
+    new_rows = []
     
     # Check if the directory is a file or a directory
     files = glob.glob(os.path.join(directory,'*')) # glob searches over every file in the directory that the user entered
@@ -174,10 +175,16 @@ def store_images(directory):
         filename = os.path.basename(extension[0])
         if DATA_DF is not None and DATA_DF['image_name'].str.contains(filename).any():
             continue
+        if any(row['image_name'] == filename for row in new_rows):
+            continue
 
-        DATA_DF = DATA_DF.append([image_data(file)]) # create a List of the image data
+        new_rows.append(image_data(file)) # create a List of the image data
 
-    DATA_DF.to_csv(DATA_FILENAME)
+    if not new_rows:
+        return
+    # append only the new rows, without the dataframe index column
+    pd.DataFrame(new_rows, columns=DATA_DF.columns).to_csv(
+        DATA_FILENAME, mode='a', header=not os.path.exists(DATA_FILENAME), index=False)
 
 def search_images(column):
     '''
@@ -4,22 +4,63 @@ This script allows the user to store encrypted images and accompanying
 keywords in a database. The user can then search the images via keyword 
 search. 
 
-Program accepts the following image file types: .bmp, .jpeg, .jpg, .png, .tiff
+Program accepts the following image file types (in any case): .bmp, .jpeg,
+.jpg, .png, .tif, .tiff, .webp
 
 This script requires the following to be installed within the Python environment
 you are running the script in: 
-`os` `sys` `cv2` `glob``pandas` `cryptography.fernet` `uuid`
+`os` `sys` `cv2` `pandas` `cryptography.fernet` `uuid`
 
 This file can also be imported as a module and contains the following
 functions:
 
+    * get_users() - opens the user accounts (hashed credentials)
+    * login() - asks for a user name & password and signs the user in (or registers them)
     * get_key() - returns an encryption key for the file
+    * get_cipher() - returns the process-wide cipher (key file is read once per process)
+    * rotate_key() - adds a new key and re-encrypts the stored images with it in batches
+    * get_storage() - opens the storage backend (CSV or SQLite) for the database
+    * get_scan_manifest() - opens the manifest of the image files already stored
+    * file_state() - returns the size & modification time of a file
+    * get_table() - returns the memory-mapped columnar snapshot of the database plus the rows stored since
+    * get_repository() - returns the session's Repository (the database kept loaded between calls)
+    * close_repository() - closes the session's Repository
     * get_dataframe() - returns Pandas dataframe of existing database, or creates a new one
+    * read_image() - returns the bytes of an image file ready for encryption (raw or normalized)
+    * encode_image() - returns image file decoded & re-compressed as bytes
     * encrypt_file() - returns image file in encrypted format
+    * store_blob() - encrypts image bytes into the content-addressed blob store
+    * store_features() - encrypts the features extracted from an image next to its blob
+    * load_features() - returns the features extracted from an image at ingest
+    * make_derivatives() - resizes a decoded image into its thumbnail & preview
+    * store_derivatives() - encrypts the thumbnail & preview of an image next to its blob
+    * get_image() - returns the decrypted image at the requested resolution (LRU cached)
+    * decrypt_image() - returns the decrypted image file bytes of a database row
+    * retrieve_images() - lazily yields the decrypted images of UUIDs, with optional prefetch
+    * externalize_images() - moves inline ciphertext from older databases into the blob store
     * image_data() - requests image attributes from user & populates corresponding values
-    * store_images() - stores image(s) in the database
+    * image_row() - builds a database row from an encrypted image and its attributes
+    * image_permission() - returns the access & owner of an image, refusing private images without an owner
+    * collect_metadata() - requests the attributes of several images up front
+    * is_duplicate() - checks the dedup index for an exact (or near) duplicate of an image
+    * new_images() - drops the images already stored, before any of them is encrypted
+    * store_images() - stores the new or changed image(s) under a directory in the database
+    * store_batch() - asks for the attributes of a batch of images & stores them
+    * ingest_images() - encrypts images in a process pool and commits them in ordered batches
+    * read_manifest() - streams the entries of a CSV/JSONL manifest file
+    * import_manifest() - non-interactive, resumable bulk import from a manifest file
+    * rebuild_index() - rebuilds the keyword/feature index from the database
+    * visible_rows() - keeps the rows of a dataframe the signed-in user may see
     * search_images() - requests image keyword(s) & returns corresponding image(s) 
+    * query_images() - runs an AND/OR/NOT query & returns one ranked page of images
+    * browse_query() - requests a query & shows its results page by page
+    * get_descriptors() - opens the memory-mapped similarity search descriptors
+    * commit_rows() - stores a batch of rows and appends their descriptors
+    * find_similar() - returns the stored images most similar to an image file
+    * build_similarity_index() - builds the optional IVF index for similarity search
+    * search_similar() - requests an image filepath & returns the most similar image(s)
     * main - main function permits user interactivity with the script
+    * Repository - the database, index, snapshot & cipher of a session, updated as rows are stored
 
 The script is a submission to the Summer 2022 Shopify Data Engineering 
 Internship Challenge. It is intended to be used as a base program which
@@ -29,37 +70,235 @@ etc.)
 """
 
 ## Import modules
+import csv
+import getpass
+import io
+import itertools
+import json
 import os
 import re
 import sys
 import cv2
-import glob
+import numpy as np
 import pandas as pd
-from cryptography.fernet import Fernet
+import threading
 import uuid
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from image_crawler import IMAGE_EXTENSIONS, ScanManifest, crawl
+from image_crypto import get_provider
+from image_features import decode_image, dhash, extract_features, feature_terms, finish_features, image_summary
+from image_index import INDEXED_COLUMNS, hamming_distance, split_terms
+from image_query import QueryEngine
+from image_similarity import DescriptorIndex
+from image_snapshot import Snapshot, Table, write_snapshot
+from image_storage import COLUMNS, BlobStore, LRUCache, content_hash, empty_frame, is_blob_reference, open_storage
+from image_timing import stage
+from image_users import UserStore
 
 ## Constants
 KEY_FILENAME = './key.key'
-DATA_FILENAME = './data.csv'
+DATA_FILENAME = os.environ.get('IMAGE_REPO_DATA', './data.csv') # use a .db file for the SQLite backend
+INDEX_FILENAME = './index.json'
+USERS_FILENAME = './users.json'
+BLOB_DIRECTORY = './blobs'
+DESCRIPTOR_FILENAME = './descriptors' # .f32/.ids (+ .ivf.npz) matrix for similarity search
+SIMILAR_RESULTS = 10
+QUERY_PAGE_SIZE = 20
+INGEST_WORKERS = int(os.environ.get('IMAGE_REPO_WORKERS', '1')) # more than 1 runs the parallel pipeline
+INGEST_BATCH_SIZE = 500 # rows committed per write by the parallel pipeline
+IMAGE_FORMATS = IMAGE_EXTENSIONS # matched case-insensitively
+# encrypt the original file bytes ('raw'), unless normalizing (decode + re-encode with cv2) is asked for
+NORMALIZE_IMAGES = os.environ.get('IMAGE_REPO_NORMALIZE', '') == '1'
+# also reject near-duplicates (perceptual hash within PHASH_MAX_DISTANCE bits), not just identical files
+DETECT_NEAR_DUPLICATES = os.environ.get('IMAGE_REPO_PHASH', '') == '1'
+PHASH_MAX_DISTANCE = 3
+# extract features (colors, dimensions, ORB descriptors) at ingest and add color/orientation words to image_features
+EXTRACT_FEATURES = os.environ.get('IMAGE_REPO_FEATURES', '1') == '1'
+# keep the descriptor of every image in DESCRIPTOR_FILENAME for the similarity search (option 4); the
+# matrix is memory-mapped to be searched, so unlike the images and their features it is NOT encrypted
+SIMILARITY_SEARCH = os.environ.get('IMAGE_REPO_SIMILARITY', '') == '1'
+FEATURE_BATCH_SIZE = 16 # images per batch of vectorized feature extraction
+RETRIEVE_BATCH_SIZE = 500 # rows looked up at a time by retrieve_images()
+# encrypted smaller versions of every image, by name -> longest side in pixels
+DERIVATIVE_SIZES = {'thumbnail': 128, 'preview': 640}
+DERIVATIVE_FORMAT = '.jpg'
+MAKE_DERIVATIVES = os.environ.get('IMAGE_REPO_DERIVATIVES', '1') == '1'
+# decrypted images kept in memory by get_image(); DERIVATIVE_CACHE.resize() changes the budget
+DERIVATIVE_CACHE = LRUCache(int(os.environ.get('IMAGE_REPO_CACHE_BYTES', str(64 * 1024 * 1024))))
+
+# UUID of the signed-in user: owner of the images they store, and the only one
+# (besides public images) who sees their private images. '' is anonymous.
+CURRENT_USER = ''
+SESSION_RECENT_ROWS = 10000 # rows a Repository keeps beside its snapshot before the snapshot is rebuilt
+SESSION_VIEWER_MASKS = 64 # per-viewer similarity search masks a Repository keeps
+_SESSION = threading.local() # one Repository per thread: storage backends are not shared between threads
 
 ## MOCKFunction
 def get_input(prompt = ''):
     return input(prompt)
 
+def get_password(prompt = ''):
+    return getpass.getpass(prompt)
+
 ## Functions
+def get_users():
+    '''
+    :return: UserStore over USERS_FILENAME
+    '''
+    return UserStore(USERS_FILENAME)
+
+def login():
+    '''
+    Asks for a user name and password. Unknown names are registered
+    with the password given. Signs the user in (sets CURRENT_USER).
+    :return: UUID of the user, or '' if they chose to stay anonymous
+    '''
+    global CURRENT_USER
+    users = get_users()
+    while True:
+        name = get_input('Enter your user name (press Enter to continue anonymously): ').strip()
+        if name == '':
+            CURRENT_USER = ''
+            return CURRENT_USER
+        password = get_password('Password: ')
+        if users.get_id(name) is None:
+            try:
+                CURRENT_USER = users.create(name, password)
+            except ValueError as error:
+                print(error)
+                continue
+            print('New user %s registered.' % name)
+            return CURRENT_USER
+        user_id = users.authenticate(name, password)
+        if user_id is not None:
+            CURRENT_USER = user_id
+            return CURRENT_USER
+        print('Wrong user name or password, please try again.')
+
 def get_key():
     '''
     Generates encryption key, if one doesn't already exist. 
-    :return: Fernet generated encryption key
+    :return: Fernet generated encryption key (the newest one after a rotation)
     '''
-    if os.path.exists(KEY_FILENAME):
-        with open(KEY_FILENAME, 'rb') as key_file:
-            return key_file.read()
-    else:
-        KEY = Fernet.generate_key() # encryption key
-        with open(KEY_FILENAME, 'wb') as key_file:
-            key_file.write(KEY)
-        return KEY
+    return get_cipher().primary_key()
+
+def get_cipher():
+    '''
+    Gets the cipher for KEY_FILENAME. The key file is read (or created,
+    atomically) once per process and the cipher is reused afterwards.
+    :return: KeyProvider with encrypt()/decrypt() over every key in the file
+    '''
+    return get_provider(KEY_FILENAME)
+
+def rotate_key(background=False, batch_size=100):
+    '''
+    Adds a new encryption key and re-encrypts every stored image with it,
+    batch_size blobs at a time. Images stay readable throughout, since the
+    old keys are kept in the key file.
+    :param background: run the re-encryption in a daemon thread
+    :param batch_size: number of blobs re-encrypted per batch
+    :return: the re-encryption thread if background, else the number of
+             blobs re-encrypted
+    '''
+    cipher = get_cipher()
+    cipher.rotate()
+    blobs = BlobStore(BLOB_DIRECTORY)
+
+    def reencrypt():
+        count = 0
+        batch = []
+        for digest in itertools.chain(blobs.digests(), [None]):
+            if digest is not None:
+                batch.append(digest)
+            if len(batch) >= batch_size or (digest is None and batch):
+                for blob in batch:
+                    blobs.write(blob, cipher.rotate_token(blobs.read(blob)))
+                    for name in DERIVATIVE_SIZES:
+                        derivative = blobs.read_derivative(blob, name)
+                        if derivative is not None:
+                            blobs.write_derivative(blob, name, cipher.rotate_token(derivative))
+                    features = blobs.read_features(blob)
+                    if features is not None:
+                        blobs.write_features(blob, cipher.rotate_token(features))
+                    else:
+                        load_features(blob) # encrypts the features of older versions, with the new key
+                count += len(batch)
+                batch = []
+        return count
+
+    if background:
+        thread = threading.Thread(target=reencrypt, name='reencrypt-images', daemon=True)
+        thread.start()
+        return thread
+    return reencrypt()
+
+def file_state(path):
+    '''
+    :param path: filepath
+    :return: [size, mtime in ns] of the file, or None if it does not exist
+    '''
+    if not os.path.exists(path):
+        return None
+    stat = os.stat(path)
+    return [stat.st_size, stat.st_mtime_ns]
+
+def get_table(storage=None):
+    '''
+    Opens the Table of the database: its columnar snapshot
+    (<DATA_FILENAME>.snapshot, see image_snapshot) followed by the rows
+    stored since it was taken, read with Storage.tail(). Opening it only
+    maps the file, whatever the number of rows; the snapshot is rebuilt
+    when rows were changed in place or more than SESSION_RECENT_ROWS were
+    stored after it.
+    :param storage: open Storage backend to read the rows from (default: opens one)
+    :return: Tuple of (Table, Storage.tail() position it is up to date with)
+    '''
+    if storage is None:
+        with get_storage() as storage:
+            return get_table(storage)
+    snapshot_path = DATA_FILENAME + '.snapshot'
+    if os.path.exists(snapshot_path):
+        try:
+            snapshot = Snapshot(snapshot_path)
+        except ValueError: # written by an older version
+            snapshot = None
+        if snapshot is not None:
+            frame, position = storage.tail(snapshot.source)
+            if frame is not None and len(frame) <= SESSION_RECENT_ROWS:
+                table = Table(snapshot)
+                table.append(frame)
+                return table, position
+    frame, position = storage.tail()
+    if not len(frame):
+        return Table(), position
+    write_snapshot(snapshot_path, frame, source=position)
+    return Table(Snapshot(snapshot_path)), position
+
+def get_repository():
+    '''
+    Gets the Repository of the current session (one per thread), opening
+    it on first use or when DATA_FILENAME, INDEX_FILENAME or KEY_FILENAME
+    point somewhere else. Loading, searching and storing images all go
+    through it, so the database is read once per session, not per call.
+    :return: Repository
+    '''
+    repository = getattr(_SESSION, 'repository', None)
+    if repository is None or repository.paths != (DATA_FILENAME, INDEX_FILENAME, KEY_FILENAME):
+        if repository is not None:
+            repository.close()
+        repository = _SESSION.repository = Repository()
+    return repository
+
+def close_repository():
+    '''
+    Closes the Repository of the current session, if one is open (the
+    CSV journal is compacted into data.csv).
+    '''
+    repository = getattr(_SESSION, 'repository', None)
+    _SESSION.repository = None
+    if repository is not None:
+        repository.close()
 
 def get_dataframe():
     '''
@@ -68,39 +307,282 @@ def get_dataframe():
     dataframe -> database. 
     :return: CSV version of dataframe with headerdata ready for images
     '''
-    if os.path.exists(DATA_FILENAME): #if there is already a dataframe, use it
-        frame = pd.read_csv(DATA_FILENAME, dtype=str)
-        return frame
-    else: # if there is no dataframe, create one
-        DATA_DF = pd.DataFrame({
-            'image_name': pd.Series(dtype='str'), #creates a column in DF
-            'image_code': pd.Series(dtype='str'),
-            'image_keywords': pd.Series(dtype='str'),
-            'image_features':pd.Series(dtype='str'),
-            'image_access':pd.Series(dtype='str'),
-            'user_pass':pd.Series(dtype='str'),
-            'unique_uuid':pd.Series(dtype='str')
-        })
-        return DATA_DF
+    return get_repository().load() # an empty dataframe if there is no database yet
+
+def get_storage():
+    '''
+    Opens the storage backend for DATA_FILENAME: SQLite for .db/.sqlite
+    files, otherwise the original CSV file.
+    :return: Storage backend (use as a context manager, or close() it)
+    '''
+    return open_storage(DATA_FILENAME, INDEX_FILENAME)
+
+def get_scan_manifest(storage=None):
+    '''
+    Opens the manifest of the image files already stored in the database
+    (kept next to it as <DATA_FILENAME>.scan, see image_crawler).
+    :param storage: open Storage backend of the database; its entries are
+                    forgotten if the database was deleted or recreated since
+    :return: ScanManifest (use as a context manager, or close() it)
+    '''
+    return ScanManifest(DATA_FILENAME + '.scan', storage)
+
+def read_image(image_path, image_format, normalize=None):
+    '''
+    Gets the bytes of an image that will be encrypted. By default these
+    are the original file bytes, read in a single call without decoding
+    the pixels; normalize decodes the image and re-compresses it instead.
+    :param image_path: filepath from which image was obtained
+    :param image_format: file extension as a String (with or without the '.')
+    :param normalize: decode + re-encode the image (default NORMALIZE_IMAGES)
+    :return: image file as bytes
+    '''
+    if normalize is None:
+        normalize = NORMALIZE_IMAGES
+    if normalize:
+        return encode_image(image_path, image_format)
+    # Fernet tokens are built from the whole message, so the bytes are read once rather than streamed
+    with open(image_path, 'rb') as image_file:
+        return image_file.read()
 
-def encrypt_file(image_path, image_format):
+def encode_image(image_path, image_format):
+    '''
+    Loads the image and compresses it into bytes
+    :param image_path: filepath from which image was obtained
+    :param image_format: file extension as a String (with or without the '.')
+    :return: image file as bytes
+    '''
+    with stage('decode'):
+        image = cv2.imread(image_path)
+    # compress the image and store it in the memory buffer that is resized to fit the result:
+    # ().imencode needed because F.encrypt() takes bytes as input) 
+    with stage('encode'):
+        return cv2.imencode('.' + image_format.lstrip('.'), image)[1].tobytes()
+
+def encrypt_file(image_path, image_format, normalize=None):
     '''
     Converts image to encrypted code
     :param image_path: filepath from which image was obtained
     :param image_format: file extension as a String 
+    :param normalize: decode + re-encode the image first (default NORMALIZE_IMAGES)
     :return: encrypted image file
     ''' 
-    F = Fernet(get_key()) 
-    image = cv2.imread(image_path)
-    # compress the image and store it in the memory buffer that is resized to fit the result:
-    # ().imencode needed because F.encrypt() takes bytes as input) 
-    return F.encrypt(cv2.imencode('.' + image_format, image)[1].tobytes()) 
+    F = get_cipher() 
+    image_bytes = read_image(image_path, image_format, normalize)
+    with stage('encrypt'):
+        return F.encrypt(image_bytes) 
+
+def store_blob(image_bytes, digest=None):
+    '''
+    Encrypts image bytes into the blob store, keyed by the hash of the
+    bytes. Identical images are only encrypted and written once.
+    :param image_bytes: unencrypted image file as bytes
+    :param digest: content_hash() of image_bytes, if already known
+    :return: Tuple of (blob reference, size of the image in bytes)
+    '''
+    digest = digest or content_hash(image_bytes)
+    blobs = BlobStore(BLOB_DIRECTORY)
+    if not blobs.exists(digest):
+        with stage('encrypt'):
+            token = get_cipher().encrypt(image_bytes)
+        with stage('persist'):
+            blobs.write(digest, token)
+    return digest, len(image_bytes)
+
+def store_features(image_code, features):
+    '''
+    Encrypts the features extracted from an image (as a NumPy .npz file)
+    next to its blob.
+    :param image_code: blob reference of the image
+    :param features: dictionary of name -> array (or scalar)
+    '''
+    buffer = io.BytesIO()
+    np.savez(buffer, **features)
+    with stage('encrypt'):
+        token = get_cipher().encrypt(buffer.getvalue())
+    with stage('persist'):
+        BlobStore(BLOB_DIRECTORY).write_features(image_code, token)
+
+def load_features(image_code):
+    '''
+    Gets the features extracted from an image when it was stored. Features
+    left unencrypted by older versions are encrypted on first use.
+    :param image_code: blob reference of the image (image_code column)
+    :return: dictionary of width, height, aspect_ratio, orb, histogram and
+             dominant_colors NumPy arrays, or None if none were extracted
+    '''
+    blobs = BlobStore(BLOB_DIRECTORY)
+    token = blobs.read_features(image_code)
+    if token is not None:
+        with np.load(io.BytesIO(get_cipher().decrypt(token))) as arrays:
+            return {name: arrays[name] for name in arrays.files}
+    plain_path = blobs.plain_features_path(image_code)
+    if not os.path.exists(plain_path):
+        return None
+    with np.load(plain_path) as arrays:
+        features = {name: arrays[name] for name in arrays.files}
+    store_features(image_code, features)
+    os.remove(plain_path)
+    return features
+
+def make_derivatives(image):
+    '''
+    Shrinks a decoded image to every size in DERIVATIVE_SIZES (longest
+    side, aspect ratio kept; images that are already smaller are not
+    enlarged).
+    :param image: BGR pixel array from cv2
+    :return: dictionary of derivative name -> image file bytes (DERIVATIVE_FORMAT)
+    '''
+    derivatives = {}
+    height, width = image.shape[:2]
+    for name, side in DERIVATIVE_SIZES.items():
+        scale = min(1.0, side / max(height, width))
+        resized = image
+        if scale < 1.0:
+            size = (max(1, round(width * scale)), max(1, round(height * scale)))
+            resized = cv2.resize(image, size, interpolation=cv2.INTER_AREA)
+        derivatives[name] = cv2.imencode(DERIVATIVE_FORMAT, resized)[1].tobytes()
+    return derivatives
+
+def store_derivatives(image_code, image):
+    '''
+    Encrypts the derivatives of an image next to its blob, unless they
+    were already made (for an identical image).
+    :param image_code: blob reference of the image
+    :param image: decoded image
+    :return: dictionary of derivative name -> image file bytes that were written
+    '''
+    blobs = BlobStore(BLOB_DIRECTORY)
+    if all(blobs.has_derivative(image_code, name) for name in DERIVATIVE_SIZES):
+        return {}
+    with stage('encode'):
+        derivatives = make_derivatives(image)
+    F = get_cipher()
+    for name, derivative in derivatives.items():
+        with stage('encrypt'):
+            token = F.encrypt(derivative)
+        with stage('persist'):
+            blobs.write_derivative(image_code, name, token)
+    return derivatives
+
+def get_image(image_code, resolution='thumbnail', viewer=None):
+    '''
+    Returns one stored image at the requested resolution, decrypting only
+    that version. Recently returned images come from DERIVATIVE_CACHE
+    without touching the disk or the cipher. Derivatives missing for
+    images stored by older versions are made (and stored) on first use.
+    :param image_code: blob reference of the image (image_code column)
+    :param resolution: a name in DERIVATIVE_SIZES, or 'original'
+    :param viewer: UUID of the user asking (default CURRENT_USER, '' for anonymous);
+                   the image must be public or theirs
+    :return: image file bytes (DERIVATIVE_FORMAT for the derivatives)
+    '''
+    if resolution != 'original' and resolution not in DERIVATIVE_SIZES:
+        raise ValueError('unknown resolution: %r' % resolution)
+    if not is_blob_reference(image_code):
+        raise ValueError('image is stored inline, run externalize_images() first')
+    viewer = CURRENT_USER if viewer is None else viewer
+    if not get_repository().is_visible('image_code', image_code, viewer):
+        raise ValueError('no image stored under %s' % image_code) # someone else's private image looks missing
+    key = (os.path.abspath(BLOB_DIRECTORY), image_code, resolution)
+    image_bytes = DERIVATIVE_CACHE.get(key)
+    if image_bytes is not None:
+        return image_bytes
+
+    blobs = BlobStore(BLOB_DIRECTORY)
+    F = get_cipher()
+    token = blobs.read(image_code) if resolution == 'original' else blobs.read_derivative(image_code, resolution)
+    if token is not None:
+        image_bytes = F.decrypt(token)
+    else:
+        image = decode_image(F.decrypt(blobs.read(image_code)))
+        derivatives = store_derivatives(image_code, image) or make_derivatives(image)
+        image_bytes = derivatives[resolution]
+    DERIVATIVE_CACHE.put(key, image_bytes)
+    return image_bytes
+
+def decrypt_image(row):
+    '''
+    Decrypts the image of a database row, wherever it is stored: in the
+    blob store (image_code is a blob reference) or inline in image_code,
+    as written by older versions (with or without the b'...' wrapper).
+    The caller checks that the row may be seen (see retrieve_images()).
+    :param row: dictionary or Series with image_code
+    :return: image file bytes (the original file for 'raw' rows, re-encoded
+             by cv2 for 'normalized' and older rows)
+    '''
+    code = row['image_code']
+    if is_blob_reference(code):
+        token = BlobStore(BLOB_DIRECTORY).read(code)
+    else:
+        if code.startswith("b'"): # older versions wrote the repr() of the bytes
+            code = code[2:-1]
+        token = code.encode('ascii')
+    return get_cipher().decrypt(token)
+
+def retrieve_images(uuids, prefetch=0, decode=False, viewer=None):
+    '''
+    Yields the decrypted images of search results one at a time, in the
+    order of uuids. Rows are looked up RETRIEVE_BATCH_SIZE at a time and
+    each image is only read and decrypted when it is about to be yielded,
+    so memory use does not grow with the number of results.
+    :param uuids: iterable of image UUIDs (unknown UUIDs and the images
+                  the viewer may not see are skipped)
+    :param prefetch: number of images decrypted ahead in a thread pool while
+                     the caller works on the current one (0 decrypts inline);
+                     at most prefetch + 1 images are held at a time
+    :param decode: yield cv2 pixel arrays instead of image file bytes
+    :param viewer: UUID of the user asking (default CURRENT_USER, '' for anonymous)
+    :return: generator of (UUID, image) Tuples
+    '''
+    viewer = CURRENT_USER if viewer is None else viewer
+
+    def load(row):
+        image_bytes = decrypt_image(row)
+        return decode_image(image_bytes) if decode else image_bytes
+
+    def rows():
+        uuids_iter = iter(uuids)
+        repository = get_repository() # an indexed lookup, not a read of the whole table per batch
+        while True:
+            batch = [str(image_id) for image_id in itertools.islice(uuids_iter, RETRIEVE_BATCH_SIZE)]
+            if not batch:
+                return
+            found = {row['unique_uuid']: row for row in repository.get(batch, viewer).to_dict('records')}
+            for image_id in batch:
+                if image_id in found:
+                    yield image_id, found[image_id]
+
+    if prefetch <= 0:
+        for image_id, row in rows():
+            yield image_id, load(row)
+        return
+
+    pending = deque()
+    pool = ThreadPoolExecutor(max_workers=prefetch, thread_name_prefix='retrieve-images')
+    try:
+        for image_id, row in rows():
+            pending.append((image_id, pool.submit(load, row)))
+            if len(pending) > prefetch:
+                image_id, future = pending.popleft()
+                yield image_id, future.result()
+        while pending:
+            image_id, future = pending.popleft()
+            yield image_id, future.result()
+    finally: # also when the caller stops early
+        for _, future in pending:
+            future.cancel()
+        pool.shutdown(wait=True)
 
 def get_permission():
     '''Asks user if they want to store 
     image as public or private.
+    Images stored anonymously are public: nobody could see a private one.
     :returns: String indicating permission level (public/private)
     '''
+    if not CURRENT_USER:
+        print("Images stored anonymously are public, sign in to store private images.")
+        return 'public'
     while True:
         permission = get_input("Do you want to store this image as a public image (y/n): ").lower().strip()
         if permission == 'y':
@@ -114,87 +596,675 @@ def image_data(image_path):
     and features for each image. Populates them into dataframe values.
     :param image_path: filepath of the image 
     '''
-    filename, file_format = os.path.splitext(image_path) 
-    filename = os.path.basename(filename) 
+    # the encrypted bytes go to the blob store, the row only keeps the reference
+    blob = encrypt_image(image_path)
     
-    user_pass = "12345"
-    
-    ### TODO in the future add an "auto naming & auto featuring" function via extracting image features 
-    ### TODO with image processing algorithms (ML) here
+    ### TODO in the future add an "auto naming" function via image processing algorithms (ML) here
+    ### (auto featuring is done by encrypt_image() when EXTRACT_FEATURES is on)
+
+    return image_row(image_path, blob, get_metadata())
 
+def get_metadata():
+    '''
+    Asks the user for the keywords, features and permission of an image.
+    :return: dictionary with image_keywords, image_features and image_access
+    '''
     return {
-        "image_name": filename, 
-        "image_code": encrypt_file(image_path, file_format), 
         "image_keywords": get_input_list("Enter the relavant keywords about this image (separate with ','): "), 
         "image_features": get_input_list("Please list any features of the image (separate with ','): "), 
-        "image_access": get_permission(), 
-        "user_pass": user_pass,
-        "unique_uuid": uuid.uuid4() # generate unique UUID (for future MySQL database implementation)
+        "image_access": get_permission()
+    }
+
+def image_row(image_path, blob, metadata):
+    '''
+    Builds the database row for an image that is already in the blob store.
+    :param image_path: filepath of the image
+    :param blob: dictionary returned by encrypt_image()
+    :param metadata: dictionary with image_keywords, image_features (comma separated
+                     Strings or Lists), image_access ('public'/'private') and
+                     optionally image_owner (default: CURRENT_USER; required
+                     for private images, which nobody else may see)
+    :return: dictionary of column -> value
+    '''
+    filename = os.path.basename(os.path.splitext(image_path)[0])
+    image_access, image_owner = image_permission(image_path, metadata)
+
+    # the user's features first, then the extracted ones they didn't already give
+    image_features = [feature for feature in clean_list(metadata.get("image_features", '')).split(',') if feature]
+    given = set(feature.lower() for feature in image_features)
+    image_features += [term for term in blob.get("auto_features", []) if term not in given]
+    return {
+        "image_name": filename, 
+        "image_code": blob["image_code"], 
+        "image_keywords": clean_list(metadata.get("image_keywords", '')), 
+        "image_features": ",".join(image_features), 
+        "image_access": image_access, 
+        "user_pass": '', # no credentials in image rows, see image_users
+        "image_owner": image_owner,
+        "unique_uuid": uuid.uuid4(), # generate unique UUID (for future MySQL database implementation)
+        "image_size": blob["image_size"],
+        "image_encoding": blob["image_encoding"],
+        "image_hash": blob.get("image_hash", ''),
+        "image_phash": blob.get("image_phash", ''),
+        "image_descriptor": blob.get("descriptor") # not a column, appended to DESCRIPTOR_FILENAME by commit_rows()
     }
 
+def image_permission(image_path, metadata):
+    '''
+    :param image_path: filepath of the image
+    :param metadata: dictionary with image_access and optionally image_owner
+    :return: Tuple of (image_access, image_owner) of the row
+    '''
+    image_access = 'public' if metadata.get("image_access") == 'public' else 'private'
+    image_owner = metadata.get("image_owner") or CURRENT_USER
+    if image_access == 'private' and not image_owner: # nobody could ever see it
+        raise ValueError('private image without an owner, sign in first: %s' % image_path)
+    return image_access, image_owner
+
 def get_input_list(message):
     '''
     Gets image keywords and processes them 
     to remove unneccesary spaces.
     :return: List of image keywords
     '''
-    image_keywords = get_input(message).split(',')
-    return ",".join(map(lambda x: x.strip(), image_keywords)) 
+    return clean_list(get_input(message))
+
+def clean_list(values):
+    '''
+    Removes unneccesary spaces from a comma separated String (or List)
+    of keywords.
+    :return: comma separated String of keywords
+    '''
+    if isinstance(values, str):
+        values = values.split(',')
+    return ",".join(map(lambda x: str(x).strip(), values)) 
 
-def store_images(directory):
+def collect_metadata(files):
+    '''
+    Asks the user for the keywords, features and permission of every
+    image before any of them are processed, so the prompts never wait
+    on (or block) the encryption workers.
+    :param files: List of image filepaths
+    :return: dictionary of filepath -> metadata (see get_metadata())
+    '''
+    metadata = {}
+    for file in files:
+        print('Image found: ' + os.path.basename(file))
+        metadata[file] = get_metadata()
+    return metadata
+
+def store_images(directory, workers=None, metadata=None, rescan=False):
     '''
     Stores image(s) in the database by loading the image (via filepath),
-    converting it to a dictionary of values, appends the dictionary to 
-    the Pandas Dataframe, and writes Dataframe to a csv file.
+    converting it to a dictionary of values, and collecting the rows in
+    a List that is committed to the storage backend in batches of
+    INGEST_BATCH_SIZE (one append-only write per batch).
+    The directory and its sub-directories are crawled lazily, a batch at
+    a time. Files stored by an earlier run and unchanged since (same
+    modification time, size and inode in the scan manifest) are skipped
+    without being read.
     :param directory: current directory from which user wants to upload images
+                      (or the filepath of one image)
+    :param workers: number of worker processes (default INGEST_WORKERS); with more
+                    than 1 the images are encrypted in parallel by ingest_images()
+    :param metadata: optional dictionary of filepath -> metadata (see get_metadata())
+                     used instead of asking the user
+    :param rescan: process every image file again, even if unchanged
     '''
-    IMAGE_FORMATS = ['.bmp', '.jpeg', '.jpg', '.png', '.tiff']
+    if workers is None:
+        workers = INGEST_WORKERS
 
-    # get existing, or build new dataframe 
-    DATA_DF = get_dataframe()
-    
-    # Check if the directory is a file or a directory
-    files = glob.glob(os.path.join(directory,'*')) # glob searches over every file in the directory that the user entered
-    
-    # because glob only returns valid info if directory is not pointing at a file
-    if os.path.isfile(directory):  #so if it is pointing at a file, we create our own List to point a file at it
-        files = [directory]
-
-    for file in files: # loop through the files to figure out if we were dealing with an image
-        extension = os.path.splitext(file)
-        if not extension[1] in IMAGE_FORMATS: # is this one of the image formats we want
-            continue
-        # do we already have the image in our list? 
-        filename = os.path.basename(extension[0])
-        if DATA_DF is not None and DATA_DF['image_name'].str.contains(filename).any():
+    storage = get_repository()
+    pool = open_ingest_pool(workers) if workers > 1 else None
+    try:
+        with get_scan_manifest(storage) as manifest:
+            files = crawl(directory, IMAGE_FORMATS) # image files only, in any case (.JPG)
+            if not rescan:
+                files = manifest.changed(files)
+            while True:
+                chunk = list(itertools.islice(files, INGEST_BATCH_SIZE))
+                if not chunk:
+                    break
+                images = [file for file, _ in chunk]
+                if pool is not None or metadata is not None:
+                    ingest_images(storage, images, metadata, workers, pool=pool)
+                else:
+                    store_batch(storage, images)
+                manifest.record(chunk) # only once the batch is committed
+    finally:
+        if pool is not None:
+            pool.shutdown()
+
+def store_batch(storage, images):
+    '''
+    Encrypts images one at a time, asking the user for the attributes of
+    each, and commits the new ones in a single write.
+    :param storage: open Storage backend
+    :param images: List of at most INGEST_BATCH_SIZE image filepaths
+    :return: number of images stored
+    '''
+    batch = []
+    images = new_images(storage, images) # do we already have the image in our list?
+    for file, blob in zip(images, encrypt_images(images)): # encrypted lazily, FEATURE_BATCH_SIZE at a time
+        batch.append(image_row(file, blob, get_metadata()))
+    commit_rows(storage, batch) # one write per batch, also updates the indexes
+    return len(batch)
+
+def commit_rows(storage, rows):
+    '''
+    Stores a batch of rows, then appends the descriptors of the rows that
+    have one to the similarity search matrix (with SIMILARITY_SEARCH).
+    :param storage: open Storage backend
+    :param rows: List of dictionaries from image_row()
+    '''
+    with stage('persist'):
+        storage.insert_many(rows)
+        described = [row for row in rows if SIMILARITY_SEARCH and row.get("image_descriptor") is not None]
+        if described:
+            get_descriptors().append([row["unique_uuid"] for row in described],
+                                     [row["image_descriptor"] for row in described])
+
+def is_duplicate(storage, blob, pending=None):
+    '''
+    Checks whether an image is already stored: exactly (same SHA-256 of
+    the file) or, with DETECT_NEAR_DUPLICATES, nearly (perceptual hash
+    within PHASH_MAX_DISTANCE bits). Both are index lookups.
+    :param storage: open Storage backend
+    :param blob: dictionary returned by fingerprint_image_batch() (or encrypt_image())
+    :param pending: optional dictionary of image_hash -> image_phash for images
+                    accepted but not committed yet; blob is added to it if new
+    :return: True if the image is a duplicate
+    '''
+    if pending is None:
+        pending = {}
+    image_hash = blob['image_hash']
+    image_phash = blob['image_phash']
+    if image_hash in pending or storage.find_duplicate(image_hash, blob.get('image_name')) is not None:
+        return True
+    if image_phash:
+        if any(phash and hamming_distance(phash, image_phash) <= PHASH_MAX_DISTANCE for phash in pending.values()):
+            return True
+        if storage.find_near_duplicates(image_phash, PHASH_MAX_DISTANCE):
+            return True
+    pending[image_hash] = image_phash
+    return False
+
+def new_images(storage, files, pool=None):
+    '''
+    Drops the images that are already stored (or come earlier in files).
+    The files are hashed and checked against the dedup index before any
+    of them is encrypted, so a duplicate leaves no blob, derivatives or
+    features behind.
+    :param storage: open Storage backend
+    :param files: List of image filepaths
+    :param pool: ProcessPoolExecutor from open_ingest_pool(), or None to run serially
+    :return: List of the filepaths to store, in the same order
+    '''
+    pending = {}
+    kept = []
+    for file, fingerprint in zip(files, map_batches(fingerprint_image_batch, files, pool)):
+        if is_duplicate(storage, fingerprint, pending):
             print("duplicate image not added")
             continue # skip adding that image
+        kept.append(file)
+    return kept
+
+def fingerprint_image_batch(image_paths):
+    '''
+    Hashes a batch of images for is_duplicate() (also run in the ingest
+    worker processes). Nothing is encrypted or written.
+    :param image_paths: List of image filepaths
+    :return: List of dictionaries with image_name, image_hash (SHA-256 of
+             the file) and image_phash (dHash, empty unless DETECT_NEAR_DUPLICATES)
+    '''
+    fingerprints = []
+    for image_path in image_paths:
+        with stage('read'), open(image_path, 'rb') as image_file:
+            file_bytes = image_file.read()
+        image_phash = ''
+        if DETECT_NEAR_DUPLICATES:
+            with stage('decode'):
+                image = decode_image(file_bytes)
+            image_phash = dhash(image) if image is not None else ''
+        fingerprints.append({
+            "image_name": os.path.basename(os.path.splitext(image_path)[0]), # rows of older versions only have the name
+            "image_hash": content_hash(file_bytes),
+            "image_phash": image_phash
+        })
+    return fingerprints
+
+def encrypt_image(image_path):
+    '''
+    Encrypts one image into the blob store (see encrypt_image_batch()).
+    :param image_path: filepath of the image
+    :return: dictionary with image_code (blob reference), image_size,
+             image_encoding ('raw' for the original file bytes, 'normalized'
+             for decoded & re-encoded bytes), image_hash (SHA-256 of the file),
+             image_phash (dHash, empty unless DETECT_NEAR_DUPLICATES),
+             auto_features (List of extracted feature words) and descriptor
+             (similarity search vector, None unless EXTRACT_FEATURES)
+    '''
+    return encrypt_image_batch([image_path])[0]
+
+def encrypt_image_batch(image_paths):
+    '''
+    Encrypts a batch of images into the blob store (also the pipeline stage
+    run in the ingest worker processes). Each file is read once and decoded
+    at most once, for feature extraction, derivatives, normalizing or the
+    perceptual hash.
+    The full-resolution pixels are dropped after each image; the color
+    features of the whole batch are then computed in one vectorized pass
+    and stored next to the blobs.
+    :param image_paths: List of image filepaths
+    :return: List of dictionaries, see encrypt_image()
+    '''
+    blobs = []
+    summaries = []
+    for image_path in image_paths:
+        with stage('read'), open(image_path, 'rb') as image_file:
+            file_bytes = image_file.read()
+        image_hash = content_hash(file_bytes)
+
+        image = None
+        if NORMALIZE_IMAGES or DETECT_NEAR_DUPLICATES or EXTRACT_FEATURES or MAKE_DERIVATIVES:
+            with stage('decode'):
+                image = decode_image(file_bytes)
+        if NORMALIZE_IMAGES:
+            image_format = os.path.splitext(image_path)[1].lstrip('.')
+            with stage('encode'):
+                normalized = cv2.imencode('.' + image_format, image)[1].tobytes()
+            image_code, image_size = store_blob(normalized)
+        else:
+            image_code, image_size = store_blob(file_bytes, image_hash)
+        if MAKE_DERIVATIVES and image is not None:
+            store_derivatives(image_code, image)
+
+        blobs.append({
+            "image_code": image_code,
+            "image_size": image_size,
+            "image_encoding": 'normalized' if NORMALIZE_IMAGES else 'raw',
+            "image_hash": image_hash,
+            "image_phash": dhash(image) if DETECT_NEAR_DUPLICATES and image is not None else '',
+            "auto_features": [],
+            "descriptor": None
+        })
+        with stage('features'):
+            summaries.append(image_summary(image) if EXTRACT_FEATURES and image is not None else None)
+
+    with stage('features'):
+        finished = finish_features(summaries)
+    for blob, features in zip(blobs, finished):
+        if features is not None:
+            store_features(blob["image_code"], features)
+            blob["auto_features"] = feature_terms(features)
+            blob["descriptor"] = features["descriptor"]
+    return blobs
+
+def worker_settings():
+    '''
+    :return: dictionary of the module settings the ingest workers need
+    '''
+    return {
+        'KEY_FILENAME': KEY_FILENAME,
+        'BLOB_DIRECTORY': BLOB_DIRECTORY,
+        'NORMALIZE_IMAGES': NORMALIZE_IMAGES,
+        'DETECT_NEAR_DUPLICATES': DETECT_NEAR_DUPLICATES,
+        'EXTRACT_FEATURES': EXTRACT_FEATURES,
+        'MAKE_DERIVATIVES': MAKE_DERIVATIVES
+    }
+
+def init_worker(settings):
+    '''
+    Initializer of the ingest worker processes: gives them the same key
+    file, blob directory and encoding/dedup/feature/derivative settings as
+    the parent.
+    :param settings: dictionary from worker_settings()
+    '''
+    globals().update(settings)
+
+def open_ingest_pool(workers=None):
+    '''
+    Starts the worker processes used by the ingest pipeline.
+    :param workers: number of worker processes (default: one per CPU)
+    :return: ProcessPoolExecutor (use as a context manager)
+    '''
+    get_key() # create the key before the workers can race to create it
+    return ProcessPoolExecutor(max_workers=workers or os.cpu_count() or 1, initializer=init_worker,
+                               initargs=(worker_settings(),))
+
+def map_batches(function, files, pool=None):
+    '''
+    Runs a batch function over files in batches of FEATURE_BATCH_SIZE, in
+    the pool if one is given.
+    :param function: function of a List of filepaths returning a List of results
+    :param files: List of image filepaths
+    :param pool: ProcessPoolExecutor from open_ingest_pool(), or None to run serially
+    :return: iterator of the results in the same order as files
+    '''
+    batches = [files[i:i + FEATURE_BATCH_SIZE] for i in range(0, len(files), FEATURE_BATCH_SIZE)]
+    if pool is None:
+        return itertools.chain.from_iterable(map(function, batches))
+    # map() yields results in input order, so batches are committed in order
+    return itertools.chain.from_iterable(pool.map(function, batches))
+
+def encrypt_images(files, pool=None):
+    '''
+    Runs encrypt_image_batch() over files (see map_batches()).
+    :param files: List of image filepaths
+    :param pool: ProcessPoolExecutor from open_ingest_pool(), or None to run serially
+    :return: iterator of encrypt_image() results in the same order as files
+    '''
+    return map_batches(encrypt_image_batch, files, pool)
+
+def ingest_images(storage, files, metadata=None, workers=None, batch_size=None, pool=None):
+    '''
+    Pipelined ingest: the CPU-bound decode/encode/encrypt work for every
+    image is fanned out to a process pool, and the resulting rows are
+    committed to storage in batches, in the same order as files.
+    :param storage: open Storage backend
+    :param files: List of image filepaths (duplicates are skipped, see new_images())
+    :param metadata: dictionary of filepath -> metadata; asked from the user
+                     up front when not given
+    :param workers: number of worker processes (default: one per CPU)
+    :param batch_size: rows per commit (default INGEST_BATCH_SIZE)
+    :param pool: pool from open_ingest_pool() to use instead of starting one
+    :return: number of images stored
+    '''
+    if metadata is None:
+        metadata = collect_metadata(files)
+    for file in files: # before anything is encrypted
+        image_permission(file, metadata.get(file, {}))
+    batch_size = batch_size or INGEST_BATCH_SIZE
+
+    stored = 0
+    batch = []
+    own_pool = pool is None
+    if own_pool:
+        pool = open_ingest_pool(workers)
+    try:
+        files = new_images(storage, files, pool)
+        for file, blob in zip(files, encrypt_images(files, pool)):
+            batch.append(image_row(file, blob, metadata.get(file, {})))
+            if len(batch) >= batch_size:
+                commit_rows(storage, batch)
+                stored += len(batch)
+                batch = []
+    finally:
+        if own_pool:
+            pool.shutdown()
+    commit_rows(storage, batch)
+    return stored + len(batch)
+
+def read_manifest(manifest_path, start=0):
+    '''
+    Streams the entries of a manifest file one at a time, so manifests of
+    any size can be imported with flat memory use. A manifest is either
+    a CSV file with a header row, or a JSONL file with one object per
+    line, with the fields:
+        path - image filepath (relative paths are relative to the manifest)
+        keywords - comma separated String (or List in JSONL)
+        features - comma separated String (or List in JSONL)
+        access - 'public' or 'private' (default 'private')
+        owner - user name of the owner (default the signed-in user)
+    :param manifest_path: filepath of the manifest (.csv or .jsonl)
+    :param start: number of entries to skip (already imported)
+    :return: generator of (entry number, dictionary of image_path, metadata)
+    '''
+    directory = os.path.dirname(os.path.abspath(manifest_path))
+    owners = {'': CURRENT_USER}
+    with open(manifest_path, newline='') as manifest_file:
+        if os.path.splitext(manifest_path)[1].lower() in ['.jsonl', '.json']:
+            entries = (json.loads(line) for line in manifest_file if line.strip())
+        else:
+            entries = csv.DictReader(manifest_file)
+        for number, entry in enumerate(itertools.islice(entries, start, None), start):
+            access = str(entry.get('access') or '').strip().lower()
+            owner = str(entry.get('owner') or '').strip().lower()
+            if owner not in owners:
+                owners[owner] = get_users().get_id(owner)
+                if owners[owner] is None:
+                    raise ValueError('unknown owner in %s: %s' % (manifest_path, owner))
+            if access not in ['public', 'y', 'yes'] and not owners[owner]:
+                raise ValueError('private image without an owner in %s (entry %d), sign in first' % (manifest_path, number))
+            yield number, {
+                "image_path": os.path.join(directory, entry['path']),
+                "metadata": {
+                    "image_keywords": entry.get('keywords') or '',
+                    "image_features": entry.get('features') or '',
+                    "image_access": 'public' if access in ['public', 'y', 'yes'] else 'private',
+                    "image_owner": owners[owner]
+                }
+            }
+
+def import_manifest(manifest_path, workers=None, batch_size=None):
+    '''
+    Non-interactive bulk import of the images listed in a manifest file
+    (see read_manifest()). Entries are streamed and committed in batches
+    of batch_size; after every commit the number of processed entries is
+    saved to <manifest>.progress, so a killed import resumes from the last
+    committed batch when run again.
+    :param manifest_path: filepath of the manifest (.csv or .jsonl)
+    :param workers: number of worker processes (default INGEST_WORKERS)
+    :param batch_size: manifest entries per commit (default INGEST_BATCH_SIZE)
+    :return: number of images stored by this run
+    '''
+    if workers is None:
+        workers = INGEST_WORKERS
+    batch_size = batch_size or INGEST_BATCH_SIZE
+    progress_path = manifest_path + '.progress'
+    start = 0
+    if os.path.exists(progress_path):
+        with open(progress_path) as progress_file:
+            start = int(progress_file.read().strip() or 0)
 
-        DATA_DF = DATA_DF.append([image_data(file)]) # create a List of the image data
+    stored = 0
+    pool = open_ingest_pool(workers) if workers > 1 else None
+    entries = read_manifest(manifest_path, start)
+    try:
+        with get_storage() as storage:
+            while True:
+                batch = list(itertools.islice(entries, batch_size))
+                if not batch:
+                    break
+                files = []
+                metadata = {}
+                for number, entry in batch:
+                    image_path = entry['image_path']
+                    if os.path.splitext(image_path)[1].lower() not in IMAGE_FORMATS or not os.path.isfile(image_path):
+                        print('skipping entry %d: not an image file: %s' % (number, image_path))
+                        continue
+                    files.append(image_path)
+                    metadata[image_path] = entry['metadata']
 
-    DATA_DF.to_csv(DATA_FILENAME)
+                files = new_images(storage, files, pool) # also what makes a re-run batch safe
+                rows = [image_row(file, blob, metadata[file]) for file, blob in zip(files, encrypt_images(files, pool))]
+                commit_rows(storage, rows)
+                stored += len(rows)
+
+                # record progress only after the batch is committed
+                temp_path = progress_path + '.tmp'
+                with open(temp_path, 'w') as progress_file:
+                    progress_file.write(str(batch[-1][0] + 1))
+                os.replace(temp_path, progress_path)
+    finally:
+        if pool is not None:
+            pool.shutdown()
+    return stored
+
+def externalize_images():
+    '''
+    Moves encrypted images stored inline in image_code by older versions
+    into the blob store, leaving only the blob reference in the row.
+    :return: number of rows converted
+    '''
+    F = get_cipher()
+    updates = []
+    with get_storage() as storage:
+        frame = storage.load()
+        for row in frame.to_dict('records'):
+            code = row['image_code']
+            if not isinstance(code, str) or is_blob_reference(code):
+                continue
+            if code.startswith("b'"): # older versions wrote the repr() of the bytes
+                code = code[2:-1]
+            image_code, image_size = store_blob(F.decrypt(code.encode('ascii')))
+            # no image_hash: these are re-encoded bytes, whose hash never matches a file's; the
+            # duplicate check finds rows without one by name (see legacy_hash())
+            updates.append({'unique_uuid': row['unique_uuid'], 'image_code': image_code,
+                            'image_size': image_size, 'image_encoding': 'normalized'})
+        storage.update_many(updates)
+    return len(updates)
+
+def rebuild_index():
+    '''
+    Rebuilds the keyword/feature index (index.json, or the SQLite
+    keyword table) from the rows in the database.
+    '''
+    with get_storage() as storage:
+        storage.rebuild_index()
+
+def visible_rows(frame):
+    '''
+    :param frame: Pandas dataframe of image rows
+    :return: the public rows, plus the private ones owned by CURRENT_USER
+    '''
+    visible = frame['image_access'] == 'public'
+    if CURRENT_USER and 'image_owner' in frame.columns:
+        visible |= frame['image_owner'] == CURRENT_USER
+    return frame[visible]
 
 def search_images(column):
     '''
     Searches the database for the image keywords entered by the user by 
-    comparing the existing keywords with the keywords searched. 
+    comparing the existing keywords with the keywords searched. Only
+    public images and the signed-in user's own are returned.
     :return: images whose keywords correspond to keywords searched
     '''
-    DATA_DF = get_dataframe()
     keyword_search = get_input("Please enter the keywords(s) that you want to search (separate with ','): ").lower().split(',')
     images_found = []
-    
-    keyword_list = DATA_DF[column].to_list()
-    for i in range(len(keyword_list)):
-        keywords = keyword_list[i].split(',')
-        for keyword in keyword_search:
-            keyword_strip = keyword.strip()
-            if keyword_strip in keywords:
-                images_found.append(DATA_DF.iloc[i])
-                break
+
+    if column in INDEXED_COLUMNS: # answer from the snapshot's posting lists instead of scanning every row
+        terms = [keyword.strip() for keyword in keyword_search if keyword.strip()]
+        if not terms:
+            return images_found
+        with stage('search'):
+            found = get_repository().search(column, terms, CURRENT_USER)
+        return [found.iloc[i] for i in range(len(found))]
+
+    with stage('search'):
+        DATA_DF = visible_rows(get_dataframe()).reset_index(drop=True)
+        keyword_list = DATA_DF[column].to_list()
+        for i in range(len(keyword_list)):
+            keywords = keyword_list[i].split(',')
+            for keyword in keyword_search:
+                keyword_strip = keyword.strip()
+                if keyword_strip in keywords:
+                    images_found.append(DATA_DF.iloc[i])
+                    break
     
     return images_found   
 
+def query_images(query, access=None, page_size=None, cursor=None, viewer=None):
+    '''
+    Runs a boolean query over the keywords and features, e.g.
+    'dog AND (park OR beach) NOT cat' (see image_query), ranked with BM25.
+    Only public images and the viewer's own are searched.
+    :param query: query String
+    :param access: only 'public' or 'private' images (None for both)
+    :param page_size: results per page (default QUERY_PAGE_SIZE)
+    :param cursor: cursor returned with the previous page
+    :param viewer: UUID of the user searching (default CURRENT_USER, '' for anonymous)
+    :return: dictionary with rows (Pandas dataframe of the page), cursor
+             (for the next page, or None) and total (number of matches)
+    '''
+    viewer = CURRENT_USER if viewer is None else viewer
+    with stage('search'):
+        return get_repository().engine.search(query, access, page_size or QUERY_PAGE_SIZE, cursor, viewer)
+
+def browse_query():
+    '''
+    Requests a query (and an optional public/private filter) from the
+    user & prints the ranked results one page at a time.
+    '''
+    query = get_input("Please enter the query, e.g. dog AND (park OR beach) NOT cat: ")
+    access = get_input("Only public or private images? (enter 'public', 'private' or press Enter for both): ").strip().lower()
+    engine = get_repository().engine # kept for the session, so ranking statistics are only counted once
+    cursor = None
+    while True:
+        try:
+            page = engine.search(query, access or None, QUERY_PAGE_SIZE, cursor, CURRENT_USER)
+        except ValueError as error:
+            print('Invalid query: %s' % error)
+            return
+        print('%d images found' % page['total'])
+        print(page['rows'][['image_name', 'image_keywords', 'image_features', 'score']])
+        cursor = page['cursor']
+        if cursor is None or get_input('Press Enter for the next page, q to stop: ').strip().lower() == 'q':
+            return
+
+def get_descriptors():
+    '''
+    :return: DescriptorIndex over DESCRIPTOR_FILENAME (memory-mapped, so
+             opening it is cheap)
+    '''
+    return DescriptorIndex(DESCRIPTOR_FILENAME)
+
+def find_similar(image_path, k=None, nprobe=8):
+    '''
+    Finds the stored images that look most like an image file: the query
+    image's descriptor is scored against every stored descriptor (or only
+    the closest IVF clusters, once build_similarity_index() has been run)
+    in one vectorized pass. Images the signed-in user may not see are
+    masked out before the top k are picked.
+    :param image_path: filepath of the query image (does not need to be stored)
+    :param k: number of results (default SIMILAR_RESULTS)
+    :param nprobe: IVF clusters scanned
+    :return: Pandas dataframe of the matching rows, most similar first,
+             with their cosine similarity in a 'similarity' column
+    '''
+    if not SIMILARITY_SEARCH:
+        raise ValueError('similarity search is off, see SIMILARITY_SEARCH (IMAGE_REPO_SIMILARITY=1)')
+    with open(image_path, 'rb') as image_file:
+        image = decode_image(image_file.read())
+    if image is None:
+        raise ValueError('not an image file: %s' % image_path)
+    query = extract_features([image])[0]['descriptor']
+    descriptors = get_descriptors()
+    repository = get_repository()
+    allowed = repository.visible_descriptors(descriptors, CURRENT_USER) # cached per viewer
+    matches = descriptors.search(query, k or SIMILAR_RESULTS, nprobe, allowed)
+    found = repository.get([uuid for uuid, _ in matches])
+    scores = dict(matches)
+    found = found.assign(similarity=found['unique_uuid'].map(scores))
+    return found.sort_values('similarity', ascending=False, kind='stable')
+
+def build_similarity_index(clusters=None):
+    '''
+    Builds the IVF (coarse quantization) index over the stored descriptors,
+    so similarity searches only score the closest clusters. Worth it for
+    large repositories; images stored later are still searched exhaustively
+    until the index is rebuilt.
+    :param clusters: number of clusters (default sqrt of the number of images)
+    :return: number of clusters
+    '''
+    return get_descriptors().build_ivf(clusters)
+
+def search_similar():
+    '''
+    Requests the filepath of an image & returns the stored images that
+    look most like it.
+    :return: List of image rows, most similar first
+    '''
+    if not SIMILARITY_SEARCH:
+        print('Similarity search is off: set IMAGE_REPO_SIMILARITY=1 before storing images.')
+        return []
+    image_path = get_input('Please enter the filepath of the image to compare with: ').strip()
+    if not os.path.isfile(image_path):
+        print('You did not enter an image file.')
+        return []
+    found = find_similar(image_path)
+    return [found.iloc[i] for i in range(len(found))]
+
 def main():
     '''
     Program logic first requests a directory path from the user
@@ -211,11 +1281,15 @@ def main():
         
         print('You did not enter an appropriate directory, please try again.')
             
+    login()
+
     while True:
         print("Menu")
         print("1. Store images in directory")
         print("2. Search images by keyword")
         print("3. Search images by feature")
+        print("4. Search images similar to an image")
+        print("5. Search images with a query (AND, OR, NOT)")
         print("q. Quit")
         phase = get_input().lower().strip()
         if phase == '1':
@@ -224,9 +1298,207 @@ def main():
             print(search_images('image_keywords'))
         elif phase == '3':
             print(search_images('image_features'))
+        elif phase == '4':
+            print(search_similar())
+        elif phase == '5':
+            browse_query()
         elif phase == 'q':
+            close_repository()
             sys.exit()
 
+## Classes
+class Repository:
+    '''
+    The database opened once for a session (the menu loop, a script, a
+    server thread) instead of once per call: the storage backend and its
+    keyword index, the query engine, the cipher and the Table (columnar
+    snapshot plus the rows stored since) stay loaded. Rows stored by any
+    process, this one included, are read with Storage.tail() and appended
+    to the Table, so a write costs the other sessions the new rows only.
+    Everything is loaded again once rows were changed in place, more than
+    SESSION_RECENT_ROWS were appended or the key file has changed.
+
+    Every Storage method it does not define (find_duplicate(), ...) is
+    passed on to the open backend, so it can be used as one.
+    '''
+    def __init__(self):
+        self.paths = (DATA_FILENAME, INDEX_FILENAME, KEY_FILENAME)
+        self.storage = get_storage()
+        self.engine = QueryEngine(self.table) # queries run over the Table, pages are decoded from it
+        self.cipher = get_cipher()
+        self._key_state = file_state(KEY_FILENAME)
+        self._loaded = False # whether the Table is up to date
+        self._table = None # the snapshot plus the rows stored since it was taken
+        self._position = None # Storage.tail() position the Table is up to date with
+        self._version = None # Storage.version() when it was
+        self._decoded = None # the snapshot decoded, built by the first load()
+        self._frame = None # _decoded plus the rows stored since
+        self._descriptor_rows = np.zeros(0, np.int64) # Table row of every descriptor row (-1: not in it)
+        self._descriptor_table_rows = 0 # len(Table) when -1 was last looked up again
+        self._masks = {} # viewer -> visible_descriptors()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def __getattr__(self, name):
+        if name == 'storage': # not opened (yet)
+            raise AttributeError(name)
+        return getattr(self.storage, name)
+
+    def close(self):
+        self.storage.close()
+
+    def refresh(self):
+        '''
+        Appends the rows stored since the Table was brought up to date, or
+        forgets the loaded state if rows were changed in place (or the keys
+        were rotated) since.
+        :return: True if the state has to be loaded again
+        '''
+        key_state = file_state(KEY_FILENAME)
+        if key_state != self._key_state: # rotated by another process
+            self.cipher.reload()
+            self._key_state = key_state
+        if self._loaded:
+            version = self.storage.version()
+            if version == self._version:
+                return False
+            frame, position = self.storage.tail(self._position)
+            if frame is not None and len(self._table) - self._table.base + len(frame) <= SESSION_RECENT_ROWS:
+                if len(frame):
+                    self._table.append(frame)
+                    self._frame = None
+                    self._masks = {}
+                self._position = position
+                self._version = version
+                return False
+            self._loaded = False # changed in place, or the snapshot is to be rebuilt
+        if not self._loaded:
+            self._table = None
+            self._decoded = None
+            self._frame = None
+            self._descriptor_rows = np.zeros(0, np.int64)
+            self._descriptor_table_rows = 0
+            self._masks = {}
+            return True
+        return False
+
+    def table(self):
+        '''
+        :return: the Table of the database, see get_table()
+        '''
+        if self.refresh():
+            version = self.storage.version() # taken first: a write during the build is caught by the next refresh()
+            self._table, self._position = get_table(self.storage)
+            self._version = version
+            self._loaded = True
+        return self._table
+
+    def insert(self, row):
+        self.insert_many([row])
+
+    def insert_many(self, rows):
+        '''
+        Stores rows in the backend. The next read appends them to the Table
+        (see refresh()), in the order every process stored them.
+        :param rows: List of dictionaries of column -> value
+        '''
+        self.storage.insert_many(rows)
+
+    def update_many(self, rows):
+        self.storage.update_many(rows)
+        self._loaded = False
+
+    def load(self):
+        '''
+        :return: Pandas dataframe of every stored row, like Storage.load()
+        '''
+        table = self.table()
+        if self._frame is None:
+            if self._decoded is None:
+                self._decoded = empty_frame() if table.snapshot is None else table.snapshot.frame()
+            recent = table.recent()
+            self._frame = self._decoded if recent is None else pd.concat([self._decoded, recent], ignore_index=True)
+        return self._frame # copy-on-write: changes made by the caller do not reach the cache
+
+    def get(self, uuids, viewer=None):
+        '''
+        :param uuids: iterable of UUIDs
+        :param viewer: UUID of the user asking ('' for anonymous) to return
+                       only the public rows and theirs, None for every row
+        :return: Pandas dataframe of the stored rows with those UUIDs, in
+                 storage order (only those rows are decoded)
+        '''
+        table = self.table()
+        rows = table.rows_of(np.array([str(uuid).encode('utf-8') for uuid in uuids], dtype='S'))
+        rows = np.unique(rows[rows >= 0])
+        if viewer is not None:
+            rows = rows[table.visible(viewer)[rows]]
+        return table.frame(rows)
+
+    def is_visible(self, column, value, viewer=''):
+        '''
+        :param column: column name, e.g. image_code
+        :param value: String
+        :param viewer: UUID of the user asking ('' for anonymous)
+        :return: True if a row holding exactly value in column is public or the viewer's
+        '''
+        table = self.table()
+        rows = table.postings(column, value)
+        return bool(table.visible(viewer)[rows].any())
+
+    def search(self, column, terms, viewer=''):
+        '''
+        Finds the rows carrying any of terms in a keyword/feature column.
+        :param column: one of INDEXED_COLUMNS
+        :param terms: List of search terms
+        :param viewer: UUID of the user searching ('' for anonymous: public images only)
+        :return: Pandas dataframe of the public rows and the viewer's own, in storage order
+        '''
+        table = self.table()
+        postings = [table.postings(column, term) for term in terms if term.strip()]
+        rows = np.unique(np.concatenate(postings)) if postings else np.zeros(0, np.int64)
+        return table.frame(rows[table.visible(viewer)[rows]]) # hidden rows are never decoded
+
+    def visible_descriptors(self, descriptors, viewer=''):
+        '''
+        The similarity search mask of a viewer: which rows of the descriptor
+        matrix belong to images they may see. Descriptor rows are matched
+        to Table rows once (new rows as they are appended), and the mask
+        of each viewer is kept until rows are stored or changed.
+        :param descriptors: DescriptorIndex of the database
+        :param viewer: UUID of the user ('' for anonymous: public images only)
+        :return: boolean array over the descriptor rows
+        '''
+        table = self.table()
+        ids = descriptors.ids()
+        if len(self._descriptor_rows) > len(ids): # the matrix was replaced
+            self._descriptor_rows = np.zeros(0, np.int64)
+            self._masks = {}
+        if len(self._descriptor_rows) < len(ids):
+            new = np.asarray(ids[len(self._descriptor_rows):])
+            self._descriptor_rows = np.concatenate([self._descriptor_rows, table.rows_of(new)])
+        if len(table) > self._descriptor_table_rows: # rows stored since: their descriptors may be among the -1
+            missing = np.flatnonzero(self._descriptor_rows < 0)
+            if len(missing):
+                self._descriptor_rows[missing] = table.rows_of(np.asarray(ids[missing]))
+            self._descriptor_table_rows = len(table)
+        mask = self._masks.get(viewer)
+        if mask is None or len(mask) != len(ids):
+            rows = self._descriptor_rows
+            mask = np.zeros(len(ids), bool)
+            mask[rows >= 0] = table.visible(viewer)[rows[rows >= 0]]
+            if len(self._masks) >= SESSION_VIEWER_MASKS:
+                self._masks = {}
+            self._masks[viewer] = mask
+        return mask
+
 # main guard
 if __name__ == '__main__':
-    main()
+    if len(sys.argv) > 1: # python keith_data_intern_project_3.py <manifest.csv|manifest.jsonl>
+        print('%d images stored' % import_manifest(sys.argv[1]))
+    else:
+        main()
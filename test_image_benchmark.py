@@ -0,0 +1,40 @@
+import json
+import os
+import tempfile
+import unittest
+import image_benchmark
+
+class TestBenchmark(unittest.TestCase):
+    def test_make_rows(self):
+        vocabulary = image_benchmark.make_vocabulary(1000)
+        first = [row for batch in image_benchmark.make_rows(250, vocabulary, seed=1, batch_size=100) for row in batch]
+        second = [row for batch in image_benchmark.make_rows(250, vocabulary, seed=1, batch_size=100) for row in batch]
+        self.assertEqual(250, len(first))
+        self.assertListEqual(first, second) # reproducible
+        self.assertEqual(250, len(set(row['unique_uuid'] for row in first)))
+        counts = {}
+        for row in first:
+            for keyword in row['image_keywords'].split(','):
+                counts[keyword] = counts.get(keyword, 0) + 1
+        self.assertEqual(vocabulary[0], max(counts, key=counts.get)) # Zipf: the first term is the most frequent
+
+    def test_run(self):
+        with tempfile.TemporaryDirectory() as directory:
+            output = os.path.join(directory, 'results.json')
+            image_benchmark.run([200], output, images=4, searches=5, timing=True)
+            with open(output) as output_file:
+                report = json.load(output_file)
+        results = {result['benchmark']: result for result in report['sizes'][0]['results']}
+        self.assertListEqual(['encrypt_file', 'store_images', 'get_dataframe', 'search_images'], list(results))
+        self.assertEqual(204, results['get_dataframe']['items'] // results['get_dataframe']['calls'])
+        self.assertEqual(5, results['search_images']['calls'])
+        for result in results.values():
+            self.assertGreater(result['throughput_per_s'], 0)
+            self.assertLessEqual(result['latency_ms']['p50'], result['latency_ms']['max'])
+            self.assertGreater(result['peak_rss_mb'], 0)
+        self.assertIn('encrypt', results['store_images']['stages'])
+        self.assertIn('persist', results['store_images']['stages'])
+        self.assertIn('search', results['search_images']['stages'])
+
+if __name__ == '__main__':
+    unittest.main()
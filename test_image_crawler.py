@@ -0,0 +1,82 @@
+import os
+import tempfile
+import time
+import unittest
+from image_crawler import ScanManifest, crawl, is_image_file
+from image_storage import CsvStorage
+
+class TestCrawler(unittest.TestCase):
+    def setUp(self):
+        self.tempdir = tempfile.TemporaryDirectory()
+        self.directory = self.tempdir.name
+        for path in ['a.JPG', 'notes.txt', 'sub/b.tif', 'sub/deeper/c.webp', 'sub/deeper/d.Png', '.git/e.png']:
+            path = os.path.join(self.directory, path)
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            with open(path, 'wb') as image_file:
+                image_file.write(b'image')
+
+    def tearDown(self):
+        self.tempdir.cleanup()
+
+    def names(self, files):
+        return sorted(os.path.relpath(path, self.directory) for path, _ in files)
+
+    def test_is_image_file(self):
+        self.assertTrue(is_image_file('photo.JPEG'))
+        self.assertTrue(is_image_file('scan.tif'))
+        self.assertFalse(is_image_file('notes.txt'))
+        self.assertFalse(is_image_file('png'))
+
+    def test_crawl(self):
+        files = crawl(self.directory)
+        self.assertFalse(isinstance(files, list)) # lazy
+        self.assertListEqual(['a.JPG', 'sub/b.tif', 'sub/deeper/c.webp', 'sub/deeper/d.Png'], self.names(files))
+        self.assertListEqual(['a.JPG'], self.names(crawl(os.path.join(self.directory, 'a.JPG'))))
+        self.assertListEqual([], self.names(crawl(os.path.join(self.directory, 'notes.txt'))))
+        self.assertListEqual([], self.names(crawl(os.path.join(self.directory, 'missing'))))
+
+    def test_scan_manifest(self):
+        with ScanManifest(os.path.join(self.directory, 'scan.db')) as manifest:
+            files = list(manifest.changed(crawl(self.directory)))
+            self.assertEqual(4, len(files))
+            manifest.record(files[:3])
+            self.assertEqual(3, len(manifest))
+            self.assertListEqual([files[3][0]], [path for path, _ in manifest.changed(crawl(self.directory))])
+            manifest.record(files[3:])
+            self.assertListEqual([], list(manifest.changed(crawl(self.directory))))
+
+            changed = os.path.join(self.directory, 'sub', 'b.tif')
+            with open(changed, 'ab') as image_file:
+                image_file.write(b' changed')
+            os.utime(changed, ns=(time.time_ns(), time.time_ns()))
+            with open(os.path.join(self.directory, 'sub', 'new.bmp'), 'wb') as image_file:
+                image_file.write(b'image')
+            self.assertListEqual(['sub/b.tif', 'sub/new.bmp'], self.names(manifest.changed(crawl(self.directory))))
+
+    def test_scan_manifest_follows_database(self):
+        manifest_path = os.path.join(self.directory, 'scan.db')
+        data_path = os.path.join(self.directory, 'data.csv')
+        with CsvStorage(data_path, data_path + '.index.json') as storage:
+            with ScanManifest(manifest_path, storage) as manifest:
+                files = list(manifest.changed(crawl(self.directory)))
+                storage.insert({'image_name': 'a', 'unique_uuid': 'uuid-a'})
+                manifest.record(files) # records the new database's first UUID
+        with CsvStorage(data_path, data_path + '.index.json') as storage:
+            with ScanManifest(manifest_path, storage) as manifest:
+                self.assertListEqual([], list(manifest.changed(crawl(self.directory))))
+
+        # the database is deleted: the files are no longer skipped
+        os.remove(data_path)
+        with CsvStorage(data_path, data_path + '.index.json') as storage:
+            with ScanManifest(manifest_path, storage) as manifest:
+                self.assertEqual(0, len(manifest))
+                self.assertEqual(4, len(list(manifest.changed(crawl(self.directory)))))
+                manifest.record(files) # nothing stored (e.g. all duplicates): not tied to a database yet
+            with ScanManifest(manifest_path, storage) as manifest:
+                self.assertEqual(4, len(manifest))
+                storage.insert({'image_name': 'b', 'unique_uuid': 'uuid-b'}) # stored by someone else
+            with ScanManifest(manifest_path, storage) as manifest:
+                self.assertEqual(0, len(manifest))
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,51 @@
+import os
+import tempfile
+import unittest
+from cryptography.fernet import Fernet
+from image_crypto import KeyProvider, get_provider
+
+class TestKeyProvider(unittest.TestCase):
+    def setUp(self):
+        self.tempdir = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.tempdir.name, 'key.key')
+
+    def tearDown(self):
+        self.tempdir.cleanup()
+
+    def test_creates_key_once(self):
+        provider = get_provider(self.path)
+        self.assertIs(provider, get_provider(self.path))
+        key = provider.primary_key()
+        self.assertEqual(44, len(key))
+        with open(self.path, 'rb') as key_file:
+            self.assertEqual(key, key_file.read())
+        self.assertEqual(key, KeyProvider(self.path).primary_key()) # a second process reuses it
+        self.assertListEqual([], [name for name in os.listdir(self.tempdir.name) if name.endswith('.tmp')])
+
+    def test_reads_single_key_file(self):
+        key = Fernet.generate_key()
+        with open(self.path, 'wb') as key_file:
+            key_file.write(key)
+        provider = KeyProvider(self.path)
+        self.assertEqual(b'data', Fernet(key).decrypt(provider.encrypt(b'data')))
+
+    def test_rotate(self):
+        provider = KeyProvider(self.path)
+        old_token = provider.encrypt(b'image')
+        old_key = provider.primary_key()
+        provider.rotate()
+        self.assertNotEqual(old_key, provider.primary_key())
+        self.assertEqual(b'image', provider.decrypt(old_token))
+        new_token = provider.rotate_token(old_token)
+        provider.retire_old_keys()
+        self.assertEqual(b'image', KeyProvider(self.path).decrypt(new_token))
+
+    def test_decrypt_reloads_after_rotation_elsewhere(self):
+        provider = KeyProvider(self.path)
+        provider.primary_key()
+        other = KeyProvider(self.path)
+        other.rotate()
+        self.assertEqual(b'image', provider.decrypt(other.encrypt(b'image')))
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,49 @@
+import unittest
+import cv2
+import numpy as np
+from image_features import color_features, decode_image, dhash, extract_features, feature_terms
+from image_index import hamming_distance
+
+class TestImageFeatures(unittest.TestCase):
+    def setUp(self):
+        with open('./first_dog.jpg', 'rb') as image_file:
+            self.image = decode_image(image_file.read())
+
+    def test_decode_image(self):
+        self.assertEqual(3, self.image.ndim)
+        self.assertIsNone(decode_image(b'not an image'))
+
+    def test_perceptual_hashes(self):
+        smaller = cv2.resize(self.image, None, fx=0.5, fy=0.5)
+        other = cv2.imread('./best_image.png')
+        self.assertEqual(16, len(dhash(self.image)))
+        self.assertLessEqual(hamming_distance(dhash(self.image), dhash(smaller)), 3)
+        self.assertGreater(hamming_distance(dhash(self.image), dhash(other)), 3)
+
+    def test_dhash_of_gradient(self):
+        gradient = np.tile(np.arange(0, 256, 16, dtype=np.uint8), (16, 1))
+        self.assertEqual('ffffffffffffffff', dhash(gradient))
+        self.assertEqual('0000000000000000', dhash(gradient[:, ::-1]))
+
+    def test_color_features_batch(self):
+        red = np.zeros((32, 32, 3), np.uint8)
+        red[..., 2] = 255 # BGR
+        mixed = red.copy()
+        mixed[:8] = 0
+        histograms, dominant = color_features(np.stack([red, mixed]), dominant=2)
+        self.assertEqual((2, 64), histograms.shape)
+        self.assertTrue(np.allclose(histograms.sum(axis=1), 1))
+        self.assertListEqual([224, 32, 32], dominant[0][0].tolist())
+        self.assertListEqual([32, 32, 32], dominant[1][1].tolist())
+
+    def test_extract_features(self):
+        portrait = np.full((200, 100, 3), (30, 160, 40), np.uint8)
+        features = extract_features([self.image, None, portrait])
+        self.assertIsNone(features[1])
+        self.assertEqual(self.image.shape[1], features[0]['width'])
+        self.assertEqual(32, features[0]['orb'].shape[1])
+        self.assertEqual(0, features[2]['orb'].shape[0]) # a flat image has no keypoints
+        self.assertListEqual(['green', 'portrait'], feature_terms(features[2]))
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,39 @@
+import os
+import tempfile
+import unittest
+import pandas as pd
+from image_index import InvertedIndex, split_terms
+
+class TestInvertedIndex(unittest.TestCase):
+    def setUp(self):
+        self.frame = pd.DataFrame({
+            'image_name': ['best_image', 'first_dog', 'second_dog'],
+            'image_keywords': ['sunset, Beach', 'dog,park', 'dog,beach'],
+            'image_features': ['orange', 'brown', float('nan')],
+            'unique_uuid': ['a', 'b', 'c']
+        })
+        self.index = InvertedIndex()
+        for row in self.frame.to_dict('records'):
+            self.index.add(row['unique_uuid'], row)
+
+    def test_split_terms(self):
+        self.assertListEqual(['sunset', 'beach'], split_terms(' Sunset , beach,,'))
+        self.assertListEqual([], split_terms(float('nan')))
+
+    def test_lookup(self):
+        index = self.index
+        self.assertSetEqual({'a', 'b', 'c'}, index.lookup('image_keywords', ['dog', 'beach']))
+        self.assertSetEqual({'c'}, index.lookup('image_keywords', ['dog', 'beach'], match_all=True))
+        self.assertSetEqual({'b'}, index.lookup('image_features', ['Brown']))
+        self.assertSetEqual(set(), index.lookup('image_keywords', ['cat']))
+
+    def test_save_load(self):
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, 'index.json')
+            self.index.save(path)
+            loaded = InvertedIndex.load(path)
+        self.assertDictEqual(self.index.columns, loaded.columns)
+        self.assertSetEqual({'b', 'c'}, loaded.lookup('image_keywords', ['dog']))
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,114 @@
+import os
+import tempfile
+import unittest
+from unittest.mock import patch
+from image_query import QueryEngine, parse_query
+from image_snapshot import Table
+from image_storage import open_storage
+
+KEYWORDS = ['dog,park', 'dog,beach', 'cat,beach', 'dog,cat,park,ball', 'bird', 'dog', 'dog,park,sunset']
+
+def tables(storage):
+    loaded = {}
+    def table(): # a Table of the rows, loaded again when they change
+        if loaded.get('version') != storage.version():
+            loaded['table'] = Table()
+            loaded['table'].append(storage.load())
+            loaded['version'] = storage.version()
+        return loaded['table']
+    return table
+
+class TestImageQuery(unittest.TestCase):
+    def setUp(self):
+        self.tempdir = tempfile.TemporaryDirectory()
+
+    def tearDown(self):
+        self.tempdir.cleanup()
+
+    def test_parse_query(self):
+        keywords = ('image_keywords', 'image_features')
+        self.assertEqual(('term', keywords, 'dog'), parse_query('Dog'))
+        self.assertEqual(('or', [('term', keywords, 'dog'), ('term', keywords, 'cat')]), parse_query('dog, cat'))
+        self.assertEqual(('or', [('and', [('term', keywords, 'a'), ('term', keywords, 'b')]), ('term', keywords, 'c')]),
+                         parse_query('a b OR c'))
+        self.assertEqual(('and', [('term', keywords, 'a'), ('not', ('term', ('image_features',), 'golden retriever'))]),
+                         parse_query('a -feature:"Golden Retriever"'))
+        self.assertEqual(('and', [('term', keywords, 'a'), ('or', [('term', keywords, 'b'), ('not', ('term', keywords, 'c'))])]),
+                         parse_query('a AND (b OR NOT c)'))
+        for query in ['', '(dog', 'dog)', 'dog AND', 'colour:red']:
+            with self.assertRaises(ValueError):
+                parse_query(query)
+
+    def check_backend(self, storage):
+        with storage:
+            storage.insert_many([{'image_name': 'image%d' % i, 'image_keywords': keywords, 'image_features': 'brown' if i % 2 else '',
+                                  'image_access': 'public' if i < 4 else 'private', 'image_owner': 'owner%d' % (i % 2),
+                                  'unique_uuid': 'u%d' % i}
+                                 for i, keywords in enumerate(KEYWORDS)])
+            engine = QueryEngine(tables(storage))
+
+            def names(query, **options):
+                return set(engine.search(query, page_size=100, **options)['rows']['image_name'])
+
+            self.assertSetEqual({'image0', 'image3', 'image6'}, names('dog AND park'))
+            self.assertSetEqual({'image1', 'image2', 'image4'}, names('beach OR bird'))
+            self.assertSetEqual({'image0', 'image1', 'image5', 'image6'}, names('dog NOT cat'))
+            self.assertSetEqual({'image2', 'image4'}, names('NOT dog'))
+            self.assertSetEqual({'image1', 'image3', 'image5'}, names('dog feature:brown'))
+            self.assertSetEqual({'image0', 'image1', 'image3'}, names('dog', access='public'))
+            self.assertSetEqual({'image0', 'image1', 'image3'}, names('dog access:public'))
+
+            # private images are only seen by their owner, also through NOT
+            self.assertSetEqual({'image0', 'image1', 'image3'}, names('dog', viewer=''))
+            self.assertSetEqual({'image0', 'image1', 'image3', 'image5'}, names('dog', viewer='owner1'))
+            self.assertSetEqual({'image2', 'image4'}, names('NOT dog', viewer='owner0'))
+            self.assertSetEqual({'image2'}, names('NOT dog', viewer='owner1'))
+            self.assertEqual(3, engine.search('dog', viewer='', page_size=1)['total'])
+
+            # the shorter keyword list ranks higher for the same term, the rarer term counts more
+            page = engine.search('dog OR sunset', page_size=100)
+            self.assertEqual('image6', page['rows']['image_name'][0])
+            self.assertEqual('image5', page['rows']['image_name'][1])
+            self.assertEqual(5, page['total'])
+            self.assertListEqual(sorted(page['rows']['score'], reverse=True), page['rows']['score'].to_list())
+
+            # pages of 2 cover the same results in the same order
+            names_paged = []
+            cursor = None
+            while True:
+                page = engine.search('dog OR sunset', page_size=2, cursor=cursor)
+                self.assertLessEqual(len(page['rows']), 2)
+                names_paged += page['rows']['image_name'].to_list()
+                cursor = page['cursor']
+                if cursor is None:
+                    break
+            self.assertListEqual(engine.search('dog OR sunset', page_size=100)['rows']['image_name'].to_list(), names_paged)
+            with self.assertRaises(ValueError):
+                engine.search('cat', cursor=engine.search('dog', page_size=1)['cursor'])
+            with self.assertRaises(ValueError):
+                engine.search('dog', page_size=0)
+
+            # later pages are slices of the ranked matches of the first one
+            page = engine.search('dog OR sunset', page_size=2)
+            with patch.object(Table, 'postings', side_effect=AssertionError('query evaluated again')):
+                second = engine.search('dog OR sunset', page_size=2, cursor=page['cursor'])
+            self.assertListEqual(names_paged[2:4], second['rows']['image_name'].to_list())
+
+            # images added while paging do not move the results of the later pages
+            storage.insert({'image_name': 'image7', 'image_keywords': 'dog', 'image_access': 'private',
+                            'image_owner': 'owner1', 'unique_uuid': 'u7'})
+            self.assertIn('image7', names('dog', viewer='owner1')) # the visible rows follow the database
+            self.assertEqual(6, engine.search('dog OR sunset', page_size=2)['total'])
+            second = engine.search('dog OR sunset', page_size=2, cursor=page['cursor'])
+            self.assertListEqual(names_paged[2:4], second['rows']['image_name'].to_list())
+            self.assertEqual(5, second['total'])
+
+    def test_csv_backend(self):
+        self.check_backend(open_storage(os.path.join(self.tempdir.name, 'data.csv'),
+                                        os.path.join(self.tempdir.name, 'index.json')))
+
+    def test_sqlite_backend(self):
+        self.check_backend(open_storage(os.path.join(self.tempdir.name, 'data.db')))
+
+if __name__ == '__main__':
+    unittest.main()
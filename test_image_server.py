@@ -0,0 +1,155 @@
+import asyncio
+import base64
+import io
+import json
+import os
+import tempfile
+import threading
+import unittest
+import urllib.error
+import urllib.parse
+import urllib.request
+import uuid
+from unittest.mock import patch
+import cv2
+import numpy as np
+import keith_data_intern_project_3
+from image_server import ImageServer
+
+def multipart(fields, files):
+    boundary = uuid.uuid4().hex
+    body = b''
+    for name, value in fields.items():
+        body += ('--%s\r\nContent-Disposition: form-data; name="%s"\r\n\r\n%s\r\n' % (boundary, name, value)).encode('utf-8')
+    for filename, data in files:
+        body += ('--%s\r\nContent-Disposition: form-data; name="image"; filename="%s"\r\n'
+                 'Content-Type: application/octet-stream\r\n\r\n' % (boundary, filename)).encode('utf-8') + data + b'\r\n'
+    body += ('--%s--\r\n' % boundary).encode('utf-8')
+    return 'multipart/form-data; boundary=' + boundary, body
+
+class TestImageServer(unittest.TestCase):
+    def setUp(self):
+        self.tempdir = tempfile.TemporaryDirectory()
+        directory = self.tempdir.name
+        self.patches = [
+            patch.object(keith_data_intern_project_3, 'KEY_FILENAME', os.path.join(directory, 'key.key')),
+            patch.object(keith_data_intern_project_3, 'DATA_FILENAME', os.path.join(directory, 'data.db')),
+            patch.object(keith_data_intern_project_3, 'BLOB_DIRECTORY', os.path.join(directory, 'blobs')),
+            patch.object(keith_data_intern_project_3, 'DESCRIPTOR_FILENAME', os.path.join(directory, 'descriptors')),
+            patch.object(keith_data_intern_project_3, 'USERS_FILENAME', os.path.join(directory, 'users.json')),
+        ]
+        for patcher in self.patches:
+            patcher.start()
+        self.loop = asyncio.new_event_loop()
+        self.server = ImageServer(port=0, workers=1)
+        self.loop.run_until_complete(self.server.start())
+        self.thread = threading.Thread(target=self.loop.run_forever, daemon=True)
+        self.thread.start()
+        self.url = 'http://127.0.0.1:%d' % self.server.port
+        keith_data_intern_project_3.get_users().create('alice', 'secret')
+        self.alice = 'Basic ' + base64.b64encode(b'alice:secret').decode('ascii')
+
+    def tearDown(self):
+        asyncio.run_coroutine_threadsafe(self.server.close(), self.loop).result()
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self.thread.join()
+        self.loop.close()
+        for patcher in self.patches:
+            patcher.stop()
+        self.tempdir.cleanup()
+
+    def request(self, path, body=None, content_type=None, authorization=None):
+        headers = {'Content-Type': content_type} if content_type else {}
+        if authorization:
+            headers['Authorization'] = authorization
+        request = urllib.request.Request(self.url + path, data=body, headers=headers)
+        try:
+            with urllib.request.urlopen(request, timeout=30) as response:
+                return response.status, response.headers['Content-Type'], response.read()
+        except urllib.error.HTTPError as error:
+            return error.code, error.headers['Content-Type'], error.read()
+
+    def upload(self, paths, **fields):
+        files = []
+        for path in paths:
+            with open(path, 'rb') as image_file:
+                files.append((os.path.basename(path), image_file.read()))
+        status, _, body = self.request('/images', *reversed(multipart(fields, files)), authorization=self.alice)
+        return status, json.loads(body)
+
+    def test_store_search_retrieve(self):
+        status, result = self.upload(['./first_dog.jpg', './best_image.png'], keywords='dog, Outdoors', access='public')
+        self.assertEqual(201, status)
+        self.assertListEqual(['first_dog', 'best_image'], [image['image_name'] for image in result['stored']])
+        self.assertListEqual(['first_dog'], self.upload(['./first_dog.jpg'])[1]['duplicates'])
+
+        status, _, body = self.request('/search?q=outdoors&access=public&page_size=1')
+        page = json.loads(body)
+        self.assertEqual((200, 2, 1), (status, page['total'], len(page['results'])))
+        self.assertNotIn('user_pass', page['results'][0])
+        page = json.loads(self.request('/search?q=outdoors&access=public&page_size=1&cursor=' + urllib.parse.quote(page['cursor']))[2])
+        self.assertIsNone(page['cursor'])
+
+        image_id = result['stored'][0]['unique_uuid']
+        status, content_type, body = self.request('/images/' + image_id)
+        with open('./first_dog.jpg', 'rb') as image_file:
+            self.assertEqual((200, 'image/jpeg', image_file.read()), (status, content_type, body))
+        status, _, body = self.request('/images/%s?size=thumbnail' % image_id)
+        thumbnail = cv2.imdecode(np.frombuffer(body, np.uint8), cv2.IMREAD_COLOR)
+        self.assertEqual(128, max(thumbnail.shape[:2]))
+
+    def test_errors(self):
+        self.assertEqual(404, self.request('/images/missing')[0])
+        self.assertEqual(404, self.request('/nothing')[0])
+        self.assertEqual(405, self.request('/images')[0])
+        self.assertEqual(400, self.request('/search?q=(dog')[0])
+        self.assertEqual(401, self.request('/images', *reversed(multipart({}, [('dog.jpg', b'')])))[0])
+        self.assertEqual(401, self.request('/search?q=dog', authorization='Basic ' + base64.b64encode(b'alice:wrong').decode())[0])
+        self.assertEqual(400, self.request('/images', *reversed(multipart({}, [('notes.txt', b'text')])),
+                                           authorization=self.alice)[0])
+        self.assertEqual(400, self.request('/users', json.dumps({'name': 'alice', 'password': 'x'}).encode())[0])
+        for page_size in ['0', '-1', 'ten']:
+            status, _, body = self.request('/search?q=dog&page_size=' + page_size)
+            self.assertEqual(400, status)
+            self.assertIn('page_size', json.loads(body)['error'])
+
+        # unexpected errors are logged, not sent to the client
+        log = io.StringIO()
+        with patch.object(keith_data_intern_project_3, 'query_images', side_effect=RuntimeError('/secret/path')), \
+                patch('sys.stderr', log):
+            status, _, body = self.request('/search?q=dog')
+        self.assertEqual(500, status)
+        self.assertDictEqual({'error': 'internal server error'}, json.loads(body))
+        self.assertIn('/secret/path', log.getvalue())
+
+    def test_private_images(self):
+        image_id = self.upload(['./first_dog.jpg'], keywords='dog')[1]['stored'][0]['unique_uuid']
+        status, _, body = self.request('/users', json.dumps({'name': 'bob', 'password': 'hunter2'}).encode())
+        self.assertEqual(201, status)
+        bob = 'Basic ' + base64.b64encode(b'bob:hunter2').decode('ascii')
+        for authorization, total, retrieved in [(None, 0, 404), (bob, 0, 404), (self.alice, 1, 200)]:
+            self.assertEqual(total, json.loads(self.request('/search?q=dog', authorization=authorization)[2])['total'])
+            self.assertEqual(retrieved, self.request('/images/' + image_id, authorization=authorization)[0])
+
+    def test_reads_while_writing(self):
+        committing = threading.Event()
+        release = threading.Event()
+        commit_rows = keith_data_intern_project_3.commit_rows
+
+        def slow_commit(storage, rows):
+            committing.set()
+            release.wait(30)
+            commit_rows(storage, rows)
+
+        with patch.object(keith_data_intern_project_3, 'commit_rows', side_effect=slow_commit):
+            upload = threading.Thread(target=self.upload, args=(['./first_dog.jpg'],), kwargs={'keywords': 'dog', 'access': 'public'})
+            upload.start()
+            self.assertTrue(committing.wait(30))
+            status, _, body = self.request('/search?q=dog') # answered while the write is in progress
+            self.assertEqual((200, 0), (status, json.loads(body)['total']))
+            release.set()
+            upload.join()
+        self.assertEqual(1, json.loads(self.request('/search?q=dog')[2])['total'])
+
+if __name__ == '__main__':
+    unittest.main()
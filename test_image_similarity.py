@@ -0,0 +1,86 @@
+import os
+import tempfile
+import unittest
+import numpy as np
+from image_features import DESCRIPTOR_SIZE
+from image_similarity import DescriptorIndex, kmeans
+
+def random_vectors(count, seed=0):
+    vectors = np.random.default_rng(seed).normal(size=(count, DESCRIPTOR_SIZE)).astype(np.float32)
+    return vectors / np.linalg.norm(vectors, axis=1, keepdims=True)
+
+class TestImageSimilarity(unittest.TestCase):
+    def setUp(self):
+        self.tempdir = tempfile.TemporaryDirectory()
+        self.index = DescriptorIndex(os.path.join(self.tempdir.name, 'descriptors'))
+
+    def tearDown(self):
+        self.tempdir.cleanup()
+
+    def test_append_and_search(self):
+        self.assertEqual([], self.index.search(random_vectors(1)[0]))
+        vectors = random_vectors(50)
+        uuids = ['%036d' % i for i in range(50)]
+        self.index.append(uuids[:20], vectors[:20])
+        self.index.append(uuids[20:], vectors[20:])
+        self.assertEqual(50, len(self.index))
+        self.assertIsInstance(self.index.vectors(), np.memmap)
+        result = self.index.search(vectors[33], k=5)
+        self.assertEqual(5, len(result))
+        self.assertEqual(uuids[33], result[0][0])
+        self.assertAlmostEqual(1.0, result[0][1], places=5)
+        scores = [score for _, score in result]
+        self.assertListEqual(sorted(scores, reverse=True), scores)
+        allowed = np.arange(50) % 2 == 0 # only the even rows
+        result = self.index.search(vectors[33], k=5, allowed=allowed)
+        self.assertNotIn(uuids[33], [uuid for uuid, _ in result])
+        self.assertTrue(all(int(uuid) % 2 == 0 for uuid, _ in result))
+        self.assertEqual([], self.index.search(vectors[33], allowed=np.zeros(50, bool)))
+
+    def test_append_after_crash(self):
+        vectors = random_vectors(4)
+        uuids = ['%036d' % i for i in range(4)]
+        self.index.append(uuids[:2], vectors[:2])
+        # a writer died after writing an id and half of its vector
+        with open(self.index.ids_path, 'ab') as ids_file:
+            ids_file.write(uuids[2].encode('ascii'))
+        with open(self.index.vectors_path, 'ab') as vectors_file:
+            vectors_file.write(vectors[2].tobytes()[:100])
+        self.index.append(uuids[3:], vectors[3:])
+        self.assertEqual(3, len(self.index))
+        self.assertListEqual([uuids[0], uuids[1], uuids[3]], [uuid.decode('ascii') for uuid in self.index.ids()])
+        self.assertEqual(uuids[3], self.index.search(vectors[3], k=1)[0][0])
+
+        # an id written without any of its vector
+        with open(self.index.ids_path, 'ab') as ids_file:
+            ids_file.write(uuids[2].encode('ascii'))
+        self.index.append(uuids[2:3], vectors[2:3])
+        self.assertListEqual([uuids[0], uuids[1], uuids[3], uuids[2]], [uuid.decode('ascii') for uuid in self.index.ids()])
+        self.assertEqual(4 * 36, os.path.getsize(self.index.ids_path))
+
+    def test_ivf_search(self):
+        centers = random_vectors(8, seed=1)
+        noise = np.random.default_rng(2).normal(scale=0.05, size=(800, DESCRIPTOR_SIZE)).astype(np.float32)
+        vectors = centers[np.arange(800) % 8] + noise
+        vectors /= np.linalg.norm(vectors, axis=1, keepdims=True)
+        uuids = ['%036d' % i for i in range(800)]
+        self.index.append(uuids, vectors)
+        exhaustive = self.index.search(vectors[5], k=10)
+        self.assertEqual(8, self.index.build_ivf(clusters=8))
+        self.assertEqual(exhaustive, self.index.search(vectors[5], k=10, nprobe=2))
+
+        # rows added after the build are still found
+        self.index.append(['%036d' % 800], vectors[5:6])
+        self.assertIn('%036d' % 800, [uuid for uuid, _ in self.index.search(vectors[5], k=2, nprobe=1)])
+        self.index.drop_ivf()
+        self.assertFalse(os.path.exists(self.index.ivf_path))
+
+    def test_kmeans(self):
+        centers = random_vectors(4, seed=3)
+        vectors = np.repeat(centers, 10, axis=0)
+        centroids = kmeans(vectors, 4)
+        self.assertEqual((4, DESCRIPTOR_SIZE), centroids.shape)
+        np.testing.assert_allclose(np.linalg.norm(centroids, axis=1), 1, rtol=1e-5)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,114 @@
+import os
+import tempfile
+import unittest
+import numpy as np
+import pandas as pd
+from image_snapshot import Snapshot, Table, encode_terms, intern_strings, write_snapshot
+
+class TestSnapshot(unittest.TestCase):
+    def setUp(self):
+        self.tempdir = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.tempdir.name, 'data.csv.snapshot')
+        self.frame = pd.DataFrame({
+            'image_name': ['sunset', 'dog', 'café', 'dog'],
+            'image_keywords': ['sunset,beach', 'Dog, park', np.nan, 'dog,beach'],
+            'image_features': ['orange', 'brown', 'white', 'brown'],
+            'image_access': ['public', 'private', 'public', 'private'],
+            'image_owner': ['alice', 'bob', np.nan, 'alice'],
+            'unique_uuid': ['a', 'b', 'c', 'd']
+        }, dtype=object)
+        write_snapshot(self.path, self.frame, source=[[1, 2], None])
+
+    def tearDown(self):
+        self.tempdir.cleanup()
+
+    def test_intern_strings(self):
+        codes, pool, offsets = intern_strings(pd.Series(['b', None, 'a', 'b', 3]))
+        self.assertListEqual([2, -1, 1, 2, 0], codes.tolist())
+        self.assertEqual(b'3ab', pool.tobytes())
+        self.assertListEqual([0, 1, 2, 3], offsets.tolist())
+
+    def test_encode_terms(self):
+        arrays = encode_terms(pd.Series(['b,a', '', 'B']))
+        self.assertEqual(b'ab', arrays['terms'].tobytes())
+        self.assertListEqual([0, 2, 2, 3], arrays['row_offsets'].tolist())
+        self.assertListEqual([1, 0, 1], arrays['row_terms'].tolist())
+        self.assertListEqual([0, 1, 3], arrays['posting_offsets'].tolist())
+        self.assertListEqual([0, 0, 2], arrays['posting_rows'].tolist())
+
+    def test_round_trip(self):
+        snapshot = Snapshot(self.path)
+        self.assertEqual(4, len(snapshot))
+        self.assertListEqual([[1, 2], None], snapshot.source)
+        self.assertIsInstance(snapshot.array('image_access.codes'), np.memmap)
+        frame = snapshot.frame()
+        self.assertListEqual(list(self.frame.columns), list(frame.columns))
+        for column in self.frame.columns:
+            self.assertListEqual(self.frame[column].fillna('-').tolist(), frame[column].fillna('-').tolist())
+        self.assertListEqual(['café', 'dog'], snapshot.frame(np.array([2, 3]))['image_name'].tolist())
+        self.assertListEqual([0, 1], snapshot.frame(np.array([2, 3])).index.tolist())
+
+    def test_lookup(self):
+        snapshot = Snapshot(self.path)
+        self.assertListEqual([1, 3], snapshot.postings('image_keywords', ' DOG ').tolist())
+        self.assertListEqual([0, 1, 3], snapshot.lookup('image_keywords', ['dog', 'beach']).tolist())
+        self.assertListEqual([3], snapshot.lookup('image_keywords', ['dog', 'beach'], match_all=True).tolist())
+        self.assertListEqual([], snapshot.lookup('image_keywords', ['cat']).tolist())
+        self.assertListEqual([], snapshot.lookup('image_keywords', ['']).tolist())
+        self.assertEqual(-1, snapshot.term_id('image_features', 'zzz'))
+
+    def test_rows_of(self):
+        snapshot = Snapshot(self.path)
+        self.assertListEqual([3, -1, 0, 2], snapshot.rows_of('unique_uuid', np.array([b'd', b'x', b'a', b'c'])).tolist())
+        self.assertListEqual([2], snapshot.rows_of('image_name', np.array(['café'.encode('utf-8')])).tolist())
+        self.assertListEqual([3], snapshot.rows_of('image_name', np.array([b'dog'])).tolist()) # the last of the rows
+        self.assertListEqual([], snapshot.rows_of('unique_uuid', np.zeros(0, 'S1')).tolist())
+        self.assertIsInstance(snapshot.array('unique_uuid.fixed'), np.memmap) # read from the file, not copied
+        self.assertNotIn('unique_uuid', snapshot._sorted)
+
+    def test_visible(self):
+        snapshot = Snapshot(self.path)
+        self.assertListEqual([True, False, True, False], snapshot.visible('').tolist())
+        self.assertListEqual([True, False, True, True], snapshot.visible('alice').tolist())
+        self.assertEqual(-1, snapshot.code('image_owner', 'carol'))
+        self.assertListEqual([False] * 4, snapshot.equals('image_owner', 'carol').tolist())
+
+    def test_table(self):
+        table = Table(Snapshot(self.path))
+        table.append(pd.DataFrame({'image_name': ['cat'], 'image_keywords': ['Cat,Dog'], 'image_access': ['private'],
+                                   'image_owner': ['carol'], 'unique_uuid': ['e']}))
+        table.append(pd.DataFrame({'image_name': ['bird'], 'image_keywords': [np.nan], 'image_access': ['public'],
+                                   'image_owner': ['bob'], 'unique_uuid': ['f']}))
+        self.assertEqual(6, len(table))
+        self.assertListEqual([1, 3, 4], table.postings('image_keywords', 'DOG').tolist())
+        self.assertListEqual([0, 2, 5], table.postings('image_access', 'public').tolist())
+        self.assertListEqual([2, 2, 0, 2, 2, 0], table.lengths('image_keywords').tolist())
+        self.assertListEqual([True, False, True, False, True, True], table.visible('carol').tolist())
+        self.assertListEqual([True, False, True, False, False, True], table.visible('').tolist())
+        self.assertListEqual([4, -1, 1], table.rows_of(np.array([b'e', b'x', b'b'])).tolist())
+        self.assertListEqual(['bird', 'sunset', 'cat', 'dog'], table.frame(np.array([5, 0, 4, 1]))['image_name'].to_list())
+        self.assertEqual(6, len(table.frame()))
+
+        # rows appended after a viewer's visibility was looked up
+        table.append(pd.DataFrame({'image_name': ['fish'], 'image_access': ['private'], 'image_owner': ['carol'],
+                                   'unique_uuid': ['g']}))
+        self.assertListEqual([True, False, True, False, True, True, True], table.visible('carol').tolist())
+        self.assertListEqual([], Table().postings('image_keywords', 'dog').tolist())
+        self.assertEqual(0, len(Table().frame(np.zeros(0, np.int64))))
+
+    def test_empty(self):
+        write_snapshot(self.path, self.frame.iloc[:0])
+        snapshot = Snapshot(self.path)
+        self.assertEqual(0, len(snapshot))
+        self.assertEqual(0, len(snapshot.frame()))
+        self.assertListEqual([], snapshot.lookup('image_keywords', ['dog']).tolist())
+        self.assertListEqual([-1], snapshot.rows_of('unique_uuid', np.array([b'a'])).tolist())
+
+    def test_not_a_snapshot(self):
+        with open(self.path, 'wb') as snapshot_file:
+            snapshot_file.write(b'image_name,image_code\n')
+        with self.assertRaises(ValueError):
+            Snapshot(self.path)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,240 @@
+import os
+import tempfile
+import unittest
+from unittest import mock
+from concurrent.futures import ProcessPoolExecutor
+import pandas as pd
+from image_storage import BlobStore, CsvStorage, LRUCache, content_hash, is_blob_reference, SqliteStorage, migrate_csv, open_storage
+
+ROWS = [
+    {'image_name': 'best_image', 'image_code': b'gAAAA1', 'image_keywords': 'sunset,Beach',
+     'image_features': 'orange', 'image_access': 'private', 'user_pass': '12345', 'unique_uuid': 'a',
+     'image_hash': 'hash_a', 'image_phash': '0000000000000001'},
+    {'image_name': 'first_dog', 'image_code': b'gAAAA2', 'image_keywords': 'dog,park',
+     'image_features': 'brown', 'image_access': 'public', 'user_pass': '12345', 'unique_uuid': 'b',
+     'image_hash': 'hash_b', 'image_phash': 'ffffffffffffffff'},
+    {'image_name': 'second_dog', 'image_code': b'gAAAA3', 'image_keywords': 'dog,beach',
+     'image_features': '', 'image_access': 'public', 'user_pass': '12345', 'unique_uuid': 'c'},
+]
+
+def insert_rows(path, writer, count, batch_size=10):
+    with CsvStorage(path, path + '.index.json') as storage:
+        for start in range(0, count, batch_size):
+            storage.insert_many([{'image_name': 'w%d_%d' % (writer, i), 'image_keywords': 'writer%d' % writer,
+                                  'unique_uuid': 'w%d_%d' % (writer, i)} for i in range(start, start + batch_size)])
+            storage.load() # readers alongside the writers
+    return count
+
+class TestStorage(unittest.TestCase):
+    def setUp(self):
+        self.tempdir = tempfile.TemporaryDirectory()
+        self.directory = self.tempdir.name
+
+    def tearDown(self):
+        self.tempdir.cleanup()
+
+    def check_backend(self, storage):
+        with storage:
+            self.assertIsNone(storage.first_uuid())
+            storage.insert(ROWS[0])
+            storage.insert_many(ROWS[1:])
+            self.assertEqual('a', storage.first_uuid())
+            self.assertListEqual(['b'], storage.get(['b'])['unique_uuid'].to_list())
+            self.assertEqual('b', storage.find_duplicate('hash_b'))
+            self.assertIsNone(storage.find_duplicate('hash_x'))
+            self.assertEqual('c', storage.find_duplicate('hash_x', 'second_dog')) # stored without a hash
+            self.assertIsNone(storage.find_duplicate('hash_x', 'first_dog'))
+            self.assertListEqual(['a'], storage.find_near_duplicates('0000000000000003', 3))
+            self.assertListEqual([], storage.find_near_duplicates('0000000000000fff', 3))
+            self.assertEqual('gAAAA1', storage.load()['image_code'][0])
+            storage.update_many([{'unique_uuid': 'a', 'image_keywords': 'dog', 'image_size': 10}])
+            self.assertEqual('dog', storage.get(['a'])['image_keywords'].iloc[0])
+            self.assertEqual('10', storage.get(['a'])['image_size'].iloc[0])
+            self.assertEqual('a', storage.first_uuid())
+
+    def check_tail(self, open_backend, remove):
+        with open_backend() as storage, open_backend() as other:
+            frame, position = storage.tail()
+            self.assertEqual(0, len(frame))
+            other.insert_many(ROWS[:2])
+            frame, position = storage.tail(position)
+            self.assertListEqual(['a', 'b'], frame['unique_uuid'].to_list())
+            if isinstance(other, CsvStorage):
+                other.compact() # the rows move from the journal to data.csv
+            other.insert(ROWS[2])
+            frame, position = storage.tail(position)
+            self.assertListEqual(['c'], frame['unique_uuid'].to_list())
+            self.assertEqual('dog,beach', frame['image_keywords'].iloc[0])
+            frame, position = storage.tail(position)
+            self.assertEqual(0, len(frame))
+            self.assertIsNone(storage.tail([[1, 2], None])[0]) # snapshot source of older versions
+
+            # changed in place: everything is read again
+            other.update_many([{'unique_uuid': 'a', 'image_keywords': 'dog'}])
+            self.assertIsNone(storage.tail(position)[0])
+            frame, position = storage.tail()
+            self.assertListEqual(['a', 'b', 'c'], frame['unique_uuid'].to_list())
+            self.assertListEqual(storage.load()['image_keywords'].to_list(), frame['image_keywords'].to_list())
+        # recreated with other rows
+        remove()
+        with open_backend() as storage:
+            storage.insert_many([dict(ROWS[0], unique_uuid=uuid) for uuid in 'xyzw'])
+            self.assertIsNone(storage.tail(position)[0])
+
+    def test_tail(self):
+        path = os.path.join(self.directory, 'data.csv')
+        self.check_tail(lambda: CsvStorage(path, os.path.join(self.directory, 'index.json')),
+                        lambda: [os.remove(path + suffix) for suffix in ['', '.journal']])
+        path = os.path.join(self.directory, 'data.db')
+        self.check_tail(lambda: SqliteStorage(path), lambda: os.remove(path))
+
+    def test_csv_storage(self):
+        self.check_backend(open_storage(os.path.join(self.directory, 'data.csv'),
+                                        os.path.join(self.directory, 'index.json')))
+
+    def test_sqlite_storage(self):
+        path = os.path.join(self.directory, 'data.db')
+        storage = open_storage(path)
+        self.assertIsInstance(storage, SqliteStorage)
+        self.check_backend(storage)
+        with SqliteStorage(path) as storage:
+            mode = storage.connection.execute('PRAGMA journal_mode').fetchone()[0]
+            self.assertEqual('wal', mode)
+
+    def test_csv_appends_to_legacy_file(self):
+        path = os.path.join(self.directory, 'data.csv')
+        pd.DataFrame([ROWS[0]]).to_csv(path) # older versions wrote the index column
+        with CsvStorage(path, os.path.join(self.directory, 'index.json')) as storage:
+            storage.insert(ROWS[1])
+            frame = storage.load()
+        self.assertListEqual(['best_image', 'first_dog'], frame['image_name'].to_list())
+        self.assertNotIn('Unnamed: 0', frame.columns)
+
+    def test_csv_concurrent_writers(self):
+        path = os.path.join(self.directory, 'data.csv')
+        with ProcessPoolExecutor(4) as pool:
+            self.assertEqual(800, sum(pool.map(insert_rows, [path] * 4, range(4), [200] * 4)))
+        with CsvStorage(path, path + '.index.json') as storage:
+            frame = storage.load()
+            self.assertEqual(800, frame['unique_uuid'].nunique())
+            self.assertEqual(200, (frame['image_keywords'] == 'writer3').sum())
+        self.assertEqual(0, os.path.getsize(path + '.journal'))
+        self.assertEqual(800, len(pd.read_csv(path)))
+
+    def test_csv_journal(self):
+        path = os.path.join(self.directory, 'data.csv')
+        writer = CsvStorage(path, os.path.join(self.directory, 'index.json'))
+        reader = CsvStorage(path, os.path.join(self.directory, 'index.json'))
+        writer.insert_many(ROWS[:2])
+        self.assertFalse(os.path.exists(path)) # still in the journal
+        self.assertListEqual(['a', 'b'], reader.load()['unique_uuid'].to_list())
+        self.assertEqual('b', reader.find_duplicate('hash_b'))
+        self.assertEqual(2, writer.compact())
+        writer.insert_many(ROWS[2:])
+        self.assertListEqual(['a', 'b', 'c'], reader.load()['unique_uuid'].to_list())
+        self.assertEqual('c', reader.find_duplicate('hash_x', 'second_dog'))
+
+        # a compaction interrupted after appending to data.csv is rolled back, not repeated
+        size = os.path.getsize(path)
+        with open(path + '.journal.compacting', 'w') as marker_file:
+            marker_file.write(str(size))
+        with open(path, 'a') as data_file:
+            data_file.write('half,written')
+        writer.close()
+        self.assertListEqual(['a', 'b', 'c'], reader.load()['unique_uuid'].to_list())
+        self.assertEqual('c', reader.find_duplicate('hash_x', 'second_dog'))
+
+    def test_csv_crash_recovery(self):
+        path = os.path.join(self.directory, 'data.csv')
+        storage = CsvStorage(path, os.path.join(self.directory, 'index.json'))
+        storage.insert_many(ROWS[:1])
+        storage.compact()
+        size = os.path.getsize(path)
+        storage.insert_many(ROWS[1:2])
+        journal = open(path + '.journal', 'rb').read()
+
+        # crash after the journal was appended to data.csv, before it was emptied: readers see b once
+        with open(path + '.journal.compacting', 'w') as marker_file:
+            marker_file.write('%d %d' % (size, len(journal)))
+        with open(path, 'ab') as data_file:
+            data_file.write(journal)
+        self.assertListEqual(['a', 'b'], CsvStorage(path, os.path.join(self.directory, 'index.json')).load()['unique_uuid'].to_list())
+        self.assertFalse(os.path.exists(path + '.journal.compacting'))
+
+        # crash after the journal was emptied, before the marker was removed: b is kept
+        with open(path + '.journal.compacting', 'w') as marker_file:
+            marker_file.write('%d %d' % (size, len(journal)))
+        storage.compact()
+        with open(path + '.journal.compacting', 'w') as marker_file:
+            marker_file.write('%d %d' % (size, len(journal)))
+        storage.insert_many(ROWS[2:])
+        storage.close()
+        self.assertListEqual(['a', 'b', 'c'], pd.read_csv(path)['unique_uuid'].to_list())
+
+        # a row cut short by a crash is dropped, not glued to the next batch
+        with open(path + '.journal', 'ab') as journal_file:
+            journal_file.write(b'd,gAAAA4,torn')
+        storage.insert_many([{'image_name': 'e', 'unique_uuid': 'e'}])
+        self.assertListEqual(['a', 'b', 'c', 'e'], storage.load()['unique_uuid'].to_list())
+        self.assertEqual('e', storage.load()['image_name'].iloc[-1])
+
+    def test_csv_rewrites_atomically(self):
+        path = os.path.join(self.directory, 'data.csv')
+        storage = CsvStorage(path, os.path.join(self.directory, 'index.json'))
+        storage.insert_many(ROWS)
+        storage.compact()
+        # a crash while rewriting data.csv leaves the old file as it was
+        with mock.patch('pandas.DataFrame.to_csv', side_effect=OSError('disk full')):
+            with self.assertRaises(OSError):
+                storage.update_many([{'unique_uuid': 'a', 'image_name': 'renamed'}])
+        self.assertListEqual(['a', 'b', 'c'], pd.read_csv(path)['unique_uuid'].to_list())
+        self.assertEqual('best_image', pd.read_csv(path)['image_name'].iloc[0])
+        storage.update_many([{'unique_uuid': 'a', 'image_name': 'renamed'}])
+        self.assertEqual('renamed', CsvStorage(path, os.path.join(self.directory, 'index.json')).load()['image_name'].iloc[0])
+        self.assertListEqual([], [name for name in os.listdir(self.directory) if name.endswith('.tmp')])
+
+    def test_migrate_csv(self):
+        csv_path = os.path.join(self.directory, 'data.csv')
+        db_path = os.path.join(self.directory, 'data.db')
+        pd.DataFrame(ROWS).to_csv(csv_path)
+        CsvStorage(csv_path, os.path.join(self.directory, 'index.json')).insert_many(
+            [{'image_name': 'journal_beach', 'image_keywords': 'beach', 'unique_uuid': 'd'}]) # not compacted
+        self.assertEqual(4, migrate_csv(csv_path, db_path, batch_size=2))
+        with SqliteStorage(db_path) as storage:
+            self.assertListEqual(['best_image', 'first_dog', 'second_dog', 'journal_beach'],
+                                 storage.load()['image_name'].to_list())
+            self.assertListEqual(['d'], storage.get(['d'])['unique_uuid'].to_list())
+
+    def test_blob_store(self):
+        blobs = BlobStore(os.path.join(self.directory, 'blobs'))
+        digest = content_hash(b'image bytes')
+        self.assertTrue(is_blob_reference(digest))
+        self.assertFalse(is_blob_reference('gAAAA1'))
+        self.assertFalse(blobs.exists(digest))
+        blobs.write(digest, b'ciphertext')
+        self.assertTrue(blobs.exists(digest))
+        self.assertEqual(b'ciphertext', blobs.read(digest))
+        self.assertTrue(blobs.path(digest).endswith(os.path.join(digest[:2], digest[2:4], digest)))
+        self.assertIsNone(blobs.read_derivative(digest, 'thumbnail'))
+        blobs.write_derivative(digest, 'thumbnail', b'small ciphertext')
+        self.assertTrue(blobs.has_derivative(digest, 'thumbnail'))
+        self.assertEqual(b'small ciphertext', blobs.read_derivative(digest, 'thumbnail'))
+        self.assertListEqual([digest], list(blobs.digests()))
+
+    def test_lru_cache(self):
+        cache = LRUCache(10)
+        cache.put('a', b'1234')
+        cache.put('b', b'1234')
+        self.assertEqual(b'1234', cache.get('a')) # 'b' is now least recently used
+        cache.put('c', b'1234')
+        self.assertIsNone(cache.get('b'))
+        self.assertEqual(8, cache.size)
+        cache.put('d', b'x' * 11) # larger than the budget, not cached
+        self.assertIsNone(cache.get('d'))
+        cache.resize(4)
+        self.assertListEqual([None, b'1234'], [cache.get('a'), cache.get('c')])
+        cache.clear()
+        self.assertEqual((0, 0), (len(cache), cache.size))
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,40 @@
+import time
+import unittest
+import image_timing
+
+class TestTiming(unittest.TestCase):
+    def setUp(self):
+        self.enabled = image_timing.ENABLED
+        image_timing.reset()
+
+    def tearDown(self):
+        image_timing.enable(self.enabled)
+        image_timing.reset()
+
+    def test_disabled(self):
+        image_timing.enable(False)
+        with image_timing.stage('decode'):
+            pass
+        self.assertDictEqual({}, image_timing.summary())
+
+    def test_stages(self):
+        image_timing.enable()
+        for _ in range(3):
+            with image_timing.stage('decode'):
+                time.sleep(0.001)
+        with image_timing.stage('search'):
+            pass
+        summary = image_timing.summary()
+        self.assertListEqual(['decode', 'search'], list(summary))
+        self.assertEqual(3, summary['decode']['count'])
+        self.assertGreaterEqual(summary['decode']['p50_ms'], 1.0)
+        self.assertLessEqual(summary['decode']['p50_ms'], summary['decode']['max_ms'])
+
+    def test_percentile(self):
+        values = list(range(1, 101))
+        self.assertEqual(50, image_timing.percentile(values, 0.5))
+        self.assertEqual(99, image_timing.percentile(values, 0.99))
+        self.assertEqual(0.0, image_timing.percentile([], 0.5))
+
+if __name__ == '__main__':
+    unittest.main()
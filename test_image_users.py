@@ -0,0 +1,38 @@
+import os
+import tempfile
+import unittest
+from image_users import UserStore, hash_password, verify_password
+
+class TestUsers(unittest.TestCase):
+    def setUp(self):
+        self.tempdir = tempfile.TemporaryDirectory()
+        self.users = UserStore(os.path.join(self.tempdir.name, 'users.json'))
+
+    def tearDown(self):
+        self.tempdir.cleanup()
+
+    def test_hash_password(self):
+        stored = hash_password('secret', n=2 ** 4)
+        self.assertTrue(stored.startswith('scrypt$16$'))
+        self.assertNotIn('secret', stored)
+        self.assertNotEqual(stored, hash_password('secret', n=2 ** 4)) # a new salt every time
+        self.assertTrue(verify_password('secret', stored))
+        self.assertFalse(verify_password('Secret', stored))
+        self.assertFalse(verify_password('secret', '12345'))
+
+    def test_user_store(self):
+        self.assertIsNone(self.users.authenticate('alice', 'secret'))
+        user_id = self.users.create('Alice', 'secret')
+        self.assertEqual(user_id, self.users.get_id('alice'))
+        self.assertEqual(user_id, self.users.authenticate(' ALICE ', 'secret'))
+        self.assertIsNone(self.users.authenticate('alice', 'wrong'))
+        self.assertIsNone(self.users.get_id('bob'))
+        with self.assertRaises(ValueError):
+            self.users.create('alice', 'other')
+        with self.assertRaises(ValueError):
+            self.users.create('bob', '')
+        with open(self.users.path) as users_file:
+            self.assertNotIn('secret', users_file.read())
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,518 @@
+import json
+import os
+import shutil
+import tempfile
+import unittest
+from unittest.mock import patch
+import cv2
+import numpy as np
+import pandas as pd
+from cryptography.fernet import Fernet
+import keith_data_intern_project_3
+from image_storage import BlobStore
+
+class TestKeithProject3(unittest.TestCase):
+    def setUp(self):
+        self.tempdir = tempfile.TemporaryDirectory()
+        directory = self.tempdir.name
+        self.patches = [
+            patch.object(keith_data_intern_project_3, 'KEY_FILENAME', os.path.join(directory, 'key.key')),
+            patch.object(keith_data_intern_project_3, 'DATA_FILENAME', os.path.join(directory, 'data.csv')),
+            patch.object(keith_data_intern_project_3, 'INDEX_FILENAME', os.path.join(directory, 'index.json')),
+            patch.object(keith_data_intern_project_3, 'BLOB_DIRECTORY', os.path.join(directory, 'blobs')),
+            patch.object(keith_data_intern_project_3, 'DESCRIPTOR_FILENAME', os.path.join(directory, 'descriptors')),
+            patch.object(keith_data_intern_project_3, 'USERS_FILENAME', os.path.join(directory, 'users.json')),
+            patch.object(keith_data_intern_project_3, 'CURRENT_USER', 'tester'),
+        ]
+        for patcher in self.patches:
+            patcher.start()
+
+    def tearDown(self):
+        keith_data_intern_project_3.close_repository()
+        for patcher in self.patches:
+            patcher.stop()
+        self.tempdir.cleanup()
+
+    def write_rows(self):
+        pd.DataFrame({
+            'image_name': ['best_image', 'first_dog'],
+            'image_code': ['x', 'y'],
+            'image_keywords': ['sunset,beach', 'dog,park'],
+            'image_features': ['orange', 'brown'],
+            'image_access': ['private', 'public'],
+            'user_pass': ['12345', '12345'],
+            'unique_uuid': ['a', 'b'],
+            'image_owner': ['tester', 'someone']
+        }).reindex(columns=keith_data_intern_project_3.COLUMNS).to_csv(keith_data_intern_project_3.DATA_FILENAME, index=False)
+
+    @patch('keith_data_intern_project_3.get_input', return_value='dog, cat')
+    def test_search_images_uses_index(self, input):
+        self.write_rows()
+        result = keith_data_intern_project_3.search_images('image_keywords')
+        self.assertEqual(1, len(result))
+        self.assertEqual('first_dog', result[0]['image_name'])
+        self.assertTrue(os.path.exists(keith_data_intern_project_3.DATA_FILENAME + '.snapshot'))
+
+    @patch('keith_data_intern_project_3.get_input', return_value='dog, sunset')
+    def test_snapshot_follows_writes(self, input):
+        table, position = keith_data_intern_project_3.get_table()
+        self.assertEqual(0, len(table))
+        self.assertIsNone(table.snapshot)
+        self.write_rows()
+        table, position = keith_data_intern_project_3.get_table()
+        self.assertEqual(2, len(table.snapshot))
+        self.assertEqual(position, table.snapshot.source)
+        self.assertEqual(position, keith_data_intern_project_3.get_table()[1]) # reused, not rebuilt
+        with keith_data_intern_project_3.get_storage() as storage:
+            storage.insert({'image_name': 'second_dog', 'image_keywords': 'dog', 'image_access': 'public',
+                            'unique_uuid': 'c', 'image_owner': 'someone'})
+        table, position = keith_data_intern_project_3.get_table()
+        self.assertEqual(3, len(table))
+        self.assertEqual(2, len(table.snapshot)) # the new row is read from the tail
+        with patch.object(keith_data_intern_project_3, 'SESSION_RECENT_ROWS', 0):
+            self.assertEqual(3, len(keith_data_intern_project_3.get_table()[0].snapshot))
+        self.assertListEqual(['best_image', 'first_dog', 'second_dog'],
+                             [row['image_name'] for row in keith_data_intern_project_3.search_images('image_keywords')])
+        self.assertListEqual(['best_image', 'first_dog', 'second_dog'],
+                             keith_data_intern_project_3.get_dataframe()['image_name'].to_list())
+
+    @patch('keith_data_intern_project_3.get_input', return_value='dog')
+    def test_repository_session(self, input):
+        self.write_rows()
+        repository = keith_data_intern_project_3.get_repository()
+        self.assertIs(repository, keith_data_intern_project_3.get_repository())
+        self.assertEqual(['first_dog'], [row['image_name'] for row in keith_data_intern_project_3.search_images('image_keywords')])
+        snapshot_state = os.stat(keith_data_intern_project_3.DATA_FILENAME + '.snapshot').st_mtime_ns
+
+        # stored through the session: visible at once, without rebuilding the snapshot
+        repository.insert_many([{'image_name': 'second_dog', 'image_keywords': 'dog', 'image_access': 'private',
+                                 'unique_uuid': 'c', 'image_owner': 'tester'}])
+        self.assertEqual(['first_dog', 'second_dog'],
+                         [row['image_name'] for row in keith_data_intern_project_3.search_images('image_keywords')])
+        self.assertEqual(3, len(keith_data_intern_project_3.get_dataframe()))
+        self.assertTrue(pd.isna(keith_data_intern_project_3.get_dataframe()['image_code'].iloc[2]))
+        self.assertEqual(['c'], repository.get(['c'])['unique_uuid'].to_list())
+        self.assertEqual(snapshot_state, os.stat(keith_data_intern_project_3.DATA_FILENAME + '.snapshot').st_mtime_ns)
+
+        # pages of a warm session are served from memory, without reading data.csv again
+        with patch('image_storage.CsvStorage.load', side_effect=AssertionError('data.csv read again')):
+            self.assertEqual(3, len(repository.table()))
+            for _ in range(2):
+                page = repository.engine.search('dog', page_size=1, viewer='tester')
+                self.assertEqual(2, page['total'])
+                self.assertEqual(1, len(page['rows']))
+                page = repository.engine.search('dog', page_size=1, cursor=page['cursor'], viewer='tester')
+                self.assertIsNone(page['cursor'])
+
+        # stored by someone else: the session reads the new row only
+        with keith_data_intern_project_3.get_storage() as storage:
+            storage.insert({'image_name': 'third_dog', 'image_keywords': 'dog', 'image_access': 'public',
+                            'unique_uuid': 'd', 'image_owner': 'someone'})
+        with patch('image_storage.CsvStorage.load', side_effect=AssertionError('data.csv read again')):
+            self.assertEqual(['first_dog', 'second_dog', 'third_dog'],
+                             [row['image_name'] for row in keith_data_intern_project_3.search_images('image_keywords')])
+        self.assertEqual(snapshot_state, os.stat(keith_data_intern_project_3.DATA_FILENAME + '.snapshot').st_mtime_ns)
+
+        # changed in place: loaded again
+        with keith_data_intern_project_3.get_storage() as storage:
+            storage.update_many([{'unique_uuid': 'd', 'image_keywords': 'cat'}])
+        self.assertEqual(['first_dog', 'second_dog'],
+                         [row['image_name'] for row in keith_data_intern_project_3.search_images('image_keywords')])
+        self.assertIs(repository, keith_data_intern_project_3.get_repository())
+
+        keith_data_intern_project_3.close_repository()
+        self.assertIsNot(repository, keith_data_intern_project_3.get_repository())
+
+    @patch('keith_data_intern_project_3.get_input', return_value='orange')
+    def test_rebuild_index(self, input):
+        self.write_rows()
+        keith_data_intern_project_3.rebuild_index()
+        self.assertTrue(os.path.exists(keith_data_intern_project_3.INDEX_FILENAME))
+        result = keith_data_intern_project_3.search_images('image_features')
+        self.assertEqual('best_image', result[0]['image_name'])
+
+    @patch('keith_data_intern_project_3.get_input', return_value='n')
+    def test_store_images(self, input):
+        keith_data_intern_project_3.store_images('./')
+        keith_data_intern_project_3.store_images('./') # second run only finds duplicates
+        result = keith_data_intern_project_3.get_dataframe()
+        self.assertListEqual(['best_image', 'first_dog'], sorted(result['image_name'].to_list()))
+
+    @patch('keith_data_intern_project_3.get_input', return_value='n')
+    def test_store_images_rescan(self, input):
+        directory = os.path.join(self.tempdir.name, 'images')
+        os.makedirs(os.path.join(directory, 'nested'))
+        shutil.copy('./first_dog.jpg', os.path.join(directory, 'nested', 'DOG.JPG'))
+        shutil.copy('./best_image.png', os.path.join(directory, 'best.png'))
+        keith_data_intern_project_3.store_images(directory)
+        self.assertListEqual(['DOG', 'best'], sorted(keith_data_intern_project_3.get_dataframe()['image_name'].to_list()))
+
+        # unchanged files are not read again
+        with patch.object(keith_data_intern_project_3, 'encrypt_image_batch', side_effect=AssertionError):
+            keith_data_intern_project_3.store_images(directory)
+        cv2.imwrite(os.path.join(directory, 'best.png'), cv2.imread('./best_image.png')[::-1])
+        calls = []
+        encrypt_image_batch = keith_data_intern_project_3.encrypt_image_batch
+        with patch.object(keith_data_intern_project_3, 'encrypt_image_batch',
+                          side_effect=lambda paths: calls.append(paths) or encrypt_image_batch(paths)):
+            keith_data_intern_project_3.store_images(directory)
+        self.assertListEqual([[os.path.join(directory, 'best.png')]], calls)
+        self.assertEqual(3, len(keith_data_intern_project_3.get_dataframe()))
+
+        # the database is deleted: the files are stored again instead of being skipped
+        keith_data_intern_project_3.close_repository()
+        data = keith_data_intern_project_3.DATA_FILENAME
+        for path in [data, data + '.journal', data + '.snapshot', keith_data_intern_project_3.INDEX_FILENAME]:
+            if os.path.exists(path):
+                os.remove(path)
+        keith_data_intern_project_3.store_images(directory)
+        self.assertListEqual(['DOG', 'best'], sorted(keith_data_intern_project_3.get_dataframe()['image_name'].to_list()))
+
+    @patch('keith_data_intern_project_3.get_input', return_value='n')
+    def test_store_images_sqlite(self, input):
+        with patch.object(keith_data_intern_project_3, 'DATA_FILENAME', os.path.join(self.tempdir.name, 'data.db')):
+            keith_data_intern_project_3.store_images('./best_image.png')
+            result = keith_data_intern_project_3.search_images('image_keywords')
+        self.assertEqual(1, len(result))
+        self.assertEqual('best_image', result[0]['image_name'])
+
+    @patch('keith_data_intern_project_3.get_input', return_value='n')
+    def test_image_data_uses_blob_store(self, input):
+        shutil.copy('./best_image.png', os.path.join(self.tempdir.name, 'copy.png'))
+        first = keith_data_intern_project_3.image_data('./best_image.png')
+        second = keith_data_intern_project_3.image_data(os.path.join(self.tempdir.name, 'copy.png'))
+        self.assertEqual(64, len(first['image_code']))
+        self.assertEqual(first['image_code'], second['image_code'])
+        blobs = [files for _, _, files in os.walk(keith_data_intern_project_3.BLOB_DIRECTORY) if files]
+        self.assertEqual(1, len(blobs))
+
+    def test_store_images_writes_per_batch(self):
+        # ingest used to copy the whole dataframe per image (quadratic): rows are committed with one
+        # insert_many() per batch and never read back while storing (throughput: see image_benchmark)
+        directory = os.path.join(self.tempdir.name, 'images')
+        os.mkdir(directory)
+        pixels = np.random.default_rng(0).integers(0, 256, (120, 8, 8), dtype=np.uint8)
+        for i in range(120):
+            cv2.imwrite(os.path.join(directory, 'image_%d.png' % i), pixels[i])
+        insert_many = keith_data_intern_project_3.Repository.insert_many
+        with patch.object(keith_data_intern_project_3, 'INGEST_BATCH_SIZE', 50), \
+                patch('keith_data_intern_project_3.get_input', return_value='n'), \
+                patch.object(keith_data_intern_project_3.Repository, 'insert_many', autospec=True,
+                             side_effect=insert_many) as writes, \
+                patch('image_storage.CsvStorage.load', side_effect=AssertionError('rows read back while storing')):
+            keith_data_intern_project_3.store_images(directory, workers=1)
+        self.assertListEqual([50, 50, 20], [len(call.args[1]) for call in writes.call_args_list])
+        self.assertEqual(120, len(keith_data_intern_project_3.get_dataframe()))
+
+    @patch('keith_data_intern_project_3.get_input', return_value='n')
+    def test_store_images_dedup_by_content(self, input):
+        directory = os.path.join(self.tempdir.name, 'images')
+        os.mkdir(directory)
+        shutil.copy('./first_dog.jpg', os.path.join(directory, 'dog.jpg')) # same picture, new name
+        shutil.copy('./best_image.png', os.path.join(directory, 'dog.png'))
+        keith_data_intern_project_3.store_images('./first_dog.jpg')
+        keith_data_intern_project_3.store_images(directory)
+        result = keith_data_intern_project_3.get_dataframe()
+        self.assertListEqual(['first_dog', 'dog'], result['image_name'].to_list())
+
+    @patch('keith_data_intern_project_3.get_input', return_value='n')
+    def test_store_images_near_duplicates(self, input):
+        image = cv2.imread('./first_dog.jpg')
+        directory = os.path.join(self.tempdir.name, 'images')
+        os.mkdir(directory)
+        cv2.imwrite(os.path.join(directory, 'smaller_dog.png'), cv2.resize(image, None, fx=0.5, fy=0.5))
+        with patch.object(keith_data_intern_project_3, 'DETECT_NEAR_DUPLICATES', True):
+            keith_data_intern_project_3.store_images('./first_dog.jpg')
+            blobs = BlobStore(keith_data_intern_project_3.BLOB_DIRECTORY)
+            written = list(blobs.digests())
+            # checked before anything is encrypted: no blob, derivatives or features are left behind
+            with patch.object(keith_data_intern_project_3, 'encrypt_image_batch', side_effect=AssertionError):
+                keith_data_intern_project_3.store_images(directory)
+        result = keith_data_intern_project_3.get_dataframe()
+        self.assertListEqual(['first_dog'], result['image_name'].to_list())
+        self.assertEqual(16, len(result['image_phash'][0]))
+        self.assertListEqual(written, list(blobs.digests()))
+
+    @patch('keith_data_intern_project_3.get_input', return_value='n')
+    def test_store_images_anonymous(self, input):
+        with patch.object(keith_data_intern_project_3, 'CURRENT_USER', ''):
+            keith_data_intern_project_3.store_images('./first_dog.jpg') # not asked: nobody could see a private image
+            with self.assertRaises(ValueError):
+                keith_data_intern_project_3.store_images('./best_image.png', metadata={'./best_image.png': {'image_access': 'private'}})
+        frame = keith_data_intern_project_3.get_dataframe()
+        self.assertListEqual(['first_dog'], frame['image_name'].to_list())
+        self.assertEqual('public', frame['image_access'][0])
+        self.assertEqual(1, len(list(BlobStore(keith_data_intern_project_3.BLOB_DIRECTORY).digests()))) # refused before encrypting
+
+    @patch('keith_data_intern_project_3.get_input', return_value='n')
+    def test_store_images_legacy_rows(self, input):
+        self.write_rows() # stored by an older version: no image_hash
+        keith_data_intern_project_3.store_images('./')
+        self.assertListEqual(['best_image', 'first_dog'], keith_data_intern_project_3.get_dataframe()['image_name'].to_list())
+
+    def test_store_images_extracts_features(self):
+        metadata = {'./first_dog.jpg': {'image_features': 'Brown, fluffy'}}
+        keith_data_intern_project_3.store_images('./first_dog.jpg', metadata=metadata)
+        row = keith_data_intern_project_3.get_dataframe().iloc[0]
+        self.assertTrue(row['image_features'].startswith('Brown,fluffy,'))
+        self.assertIn('landscape', row['image_features'].split(','))
+        self.assertEqual(1, row['image_features'].lower().split(',').count('brown'))
+        features = keith_data_intern_project_3.load_features(row['image_code'])
+        self.assertEqual((64,), features['histogram'].shape)
+        self.assertEqual((3, 3), features['dominant_colors'].shape)
+
+        # encrypted like the image; features left unencrypted by older versions are encrypted on first use
+        blobs = BlobStore(keith_data_intern_project_3.BLOB_DIRECTORY)
+        self.assertTrue(Fernet(keith_data_intern_project_3.get_key()).decrypt(blobs.read_features(row['image_code'])))
+        os.remove(blobs.features_path(row['image_code']))
+        np.savez(blobs.plain_features_path(row['image_code']), **features)
+        self.assertEqual((64,), keith_data_intern_project_3.load_features(row['image_code'])['histogram'].shape)
+        self.assertFalse(os.path.exists(blobs.plain_features_path(row['image_code'])))
+        self.assertIsNotNone(blobs.read_features(row['image_code']))
+        with patch.object(keith_data_intern_project_3, 'EXTRACT_FEATURES', False):
+            blob = keith_data_intern_project_3.encrypt_image('./best_image.png')
+        self.assertListEqual([], blob['auto_features'])
+        self.assertIsNone(keith_data_intern_project_3.load_features(blob['image_code']))
+
+    @patch.object(keith_data_intern_project_3, 'SIMILARITY_SEARCH', True)
+    def test_find_similar(self):
+        directory = os.path.join(self.tempdir.name, 'images')
+        os.mkdir(directory)
+        image = cv2.imread('./first_dog.jpg')
+        cv2.imwrite(os.path.join(directory, 'dog.jpg'), image)
+        cv2.imwrite(os.path.join(directory, 'dog_small.png'), cv2.resize(image, None, fx=0.5, fy=0.5))
+        cv2.imwrite(os.path.join(directory, 'flipped.png'), image[::-1])
+        shutil.copy('./best_image.png', directory)
+        metadata = {os.path.join(directory, name): {} for name in os.listdir(directory)}
+        keith_data_intern_project_3.store_images(directory, metadata=metadata, workers=1)
+        self.assertEqual(4, len(keith_data_intern_project_3.get_descriptors()))
+
+        found = keith_data_intern_project_3.find_similar('./first_dog.jpg', k=2)
+        self.assertListEqual(['dog', 'dog_small'], found['image_name'].to_list())
+        self.assertGreater(found['similarity'].iloc[1], 0.95)
+        keith_data_intern_project_3.build_similarity_index(clusters=2)
+        found = keith_data_intern_project_3.find_similar('./first_dog.jpg', k=2, nprobe=2)
+        self.assertListEqual(['dog', 'dog_small'], found['image_name'].to_list())
+
+        with patch('keith_data_intern_project_3.get_input', return_value='./best_image.png'):
+            self.assertEqual('best_image', keith_data_intern_project_3.search_similar()[0]['image_name'])
+
+        # the images are private: other users only find public ones
+        with patch.object(keith_data_intern_project_3, 'CURRENT_USER', 'someone'):
+            self.assertEqual(0, len(keith_data_intern_project_3.find_similar('./first_dog.jpg', k=2)))
+
+        # the mask of a viewer is cached, and follows the images stored by the session
+        repository = keith_data_intern_project_3.get_repository()
+        descriptors = keith_data_intern_project_3.get_descriptors()
+        mask = repository.visible_descriptors(descriptors, 'tester')
+        self.assertIs(mask, repository.visible_descriptors(descriptors, 'tester'))
+        self.assertListEqual([False] * 4, repository.visible_descriptors(descriptors, 'someone').tolist())
+        cv2.imwrite(os.path.join(directory, 'dog_again.png'), image)
+        metadata = {os.path.join(directory, name): {} for name in os.listdir(directory)}
+        keith_data_intern_project_3.store_images(directory, metadata=metadata, workers=1)
+        found = keith_data_intern_project_3.find_similar('./first_dog.jpg', k=3)
+        self.assertIn('dog_again', found['image_name'].to_list())
+        self.assertEqual(5, len(repository.visible_descriptors(descriptors, 'tester')))
+
+    def test_similarity_search_is_opt_in(self):
+        keith_data_intern_project_3.store_images('./first_dog.jpg', metadata={'./first_dog.jpg': {}})
+        self.assertEqual(0, len(keith_data_intern_project_3.get_descriptors())) # nothing unencrypted about the image
+        with self.assertRaises(ValueError):
+            keith_data_intern_project_3.find_similar('./first_dog.jpg')
+
+    @patch('keith_data_intern_project_3.get_password', return_value='secret')
+    def test_login(self, password):
+        with patch('keith_data_intern_project_3.get_input', return_value='Alice'):
+            user_id = keith_data_intern_project_3.login()
+        self.assertEqual(user_id, keith_data_intern_project_3.CURRENT_USER)
+        self.assertEqual(user_id, keith_data_intern_project_3.get_users().authenticate('alice', 'secret'))
+        self.write_rows()
+        with patch('keith_data_intern_project_3.get_input', return_value='beach'):
+            self.assertEqual(0, len(keith_data_intern_project_3.search_images('image_keywords'))) # owned by 'tester'
+        with patch('keith_data_intern_project_3.get_input', return_value='best_image'):
+            self.assertEqual(0, len(keith_data_intern_project_3.search_images('image_name')))
+        with patch.object(keith_data_intern_project_3, 'CURRENT_USER', 'tester'), \
+                patch('keith_data_intern_project_3.get_input', return_value='best_image'):
+            self.assertEqual(1, len(keith_data_intern_project_3.search_images('image_name')))
+        with patch('keith_data_intern_project_3.get_input', return_value=''):
+            self.assertEqual('', keith_data_intern_project_3.login())
+
+    def test_get_image(self):
+        metadata = {'./best_image.png': {}}
+        keith_data_intern_project_3.store_images('./best_image.png', metadata=metadata)
+        code = keith_data_intern_project_3.get_dataframe()['image_code'][0]
+        blobs = BlobStore(keith_data_intern_project_3.BLOB_DIRECTORY)
+        self.assertTrue(blobs.has_derivative(code, 'thumbnail'))
+        shapes = {}
+        for resolution in ['thumbnail', 'preview', 'original']:
+            image_bytes = keith_data_intern_project_3.get_image(code, resolution)
+            shapes[resolution] = cv2.imdecode(np.frombuffer(image_bytes, np.uint8), cv2.IMREAD_COLOR).shape
+        self.assertEqual((44, 128, 3), shapes['thumbnail'])
+        self.assertEqual((219, 640, 3), shapes['preview'])
+        self.assertEqual((554, 1622, 3), shapes['original'])
+        with open('./best_image.png', 'rb') as image_file:
+            self.assertEqual(image_file.read(), keith_data_intern_project_3.get_image(code, 'original'))
+
+        # cached: neither the blob store nor the cipher is used again
+        with patch.object(keith_data_intern_project_3, 'get_cipher', side_effect=AssertionError):
+            keith_data_intern_project_3.get_image(code, 'thumbnail')
+        with self.assertRaises(ValueError):
+            keith_data_intern_project_3.get_image(code, 'huge')
+        for viewer in ['', 'someone']: # private to 'tester', even when cached
+            with self.assertRaises(ValueError):
+                keith_data_intern_project_3.get_image(code, 'thumbnail', viewer)
+
+        # derivatives missing (stored by an older version) are made on first use
+        keith_data_intern_project_3.DERIVATIVE_CACHE.clear()
+        os.remove(blobs.derivative_path(code, 'preview'))
+        self.assertTrue(keith_data_intern_project_3.get_image(code, 'preview'))
+        self.assertTrue(blobs.has_derivative(code, 'preview'))
+
+    def test_retrieve_images(self):
+        keith_data_intern_project_3.store_images('./', metadata={'./first_dog.jpg': {}, './best_image.png': {}})
+        legacy = Fernet(keith_data_intern_project_3.get_key()).encrypt(b'legacy image')
+        with keith_data_intern_project_3.get_storage() as storage:
+            storage.insert_many([{'image_name': 'old', 'image_code': str(legacy), 'unique_uuid': 'old-uuid',
+                                  'image_access': 'public'}])
+        frame = keith_data_intern_project_3.get_dataframe()
+        uuids = frame['unique_uuid'].to_list()[::-1] + ['missing']
+        with open('./first_dog.jpg', 'rb') as image_file:
+            original = image_file.read()
+
+        for prefetch in [0, 2]:
+            images = list(keith_data_intern_project_3.retrieve_images(uuids, prefetch=prefetch))
+            self.assertListEqual(uuids[:3], [image_id for image_id, _ in images])
+            self.assertEqual(b'legacy image', images[0][1])
+            self.assertIn(original, [image for _, image in images])
+
+        # batches are looked up in the session, not by reading data.csv again
+        with patch.object(keith_data_intern_project_3, 'RETRIEVE_BATCH_SIZE', 1), \
+                patch('image_storage.CsvStorage.load', side_effect=AssertionError('data.csv read again')):
+            self.assertListEqual(uuids[:3], [image_id for image_id, _ in keith_data_intern_project_3.retrieve_images(uuids)])
+
+        decoded = keith_data_intern_project_3.retrieve_images(uuids[1:2], decode=True)
+        self.assertEqual(3, next(decoded)[1].ndim)
+
+        # the private images of 'tester' are skipped for anyone else
+        self.assertListEqual(['old-uuid'], [image_id for image_id, _ in keith_data_intern_project_3.retrieve_images(uuids, viewer='')])
+        self.assertListEqual(['old-uuid'], [image_id for image_id, _ in keith_data_intern_project_3.retrieve_images(uuids, viewer='someone')])
+
+        # only prefetch + 1 images are decrypted before the first one is consumed
+        calls = []
+        decrypt = keith_data_intern_project_3.decrypt_image
+        with patch.object(keith_data_intern_project_3, 'decrypt_image', side_effect=lambda row: calls.append(row) or decrypt(row)):
+            stream = keith_data_intern_project_3.retrieve_images(uuids[1:] * 10, prefetch=2)
+            next(stream)
+            stream.close()
+        self.assertLessEqual(len(calls), 3)
+
+    def test_encrypt_file_raw_and_normalized(self):
+        F = Fernet(keith_data_intern_project_3.get_key())
+        with open('./first_dog.jpg', 'rb') as image_file:
+            original = image_file.read()
+        raw = F.decrypt(keith_data_intern_project_3.encrypt_file('./first_dog.jpg', 'jpg'))
+        normalized = F.decrypt(keith_data_intern_project_3.encrypt_file('./first_dog.jpg', 'jpg', normalize=True))
+        self.assertEqual(original, raw)
+        self.assertNotEqual(original, normalized)
+        self.assertIsNotNone(cv2.imdecode(np.frombuffer(normalized, np.uint8), cv2.IMREAD_COLOR))
+
+    @patch('keith_data_intern_project_3.get_input', return_value='n')
+    def test_image_data_records_encoding(self, input):
+        self.assertEqual('raw', keith_data_intern_project_3.image_data('./best_image.png')['image_encoding'])
+        with patch.object(keith_data_intern_project_3, 'NORMALIZE_IMAGES', True):
+            self.assertEqual('normalized', keith_data_intern_project_3.image_data('./best_image.png')['image_encoding'])
+
+    @patch('keith_data_intern_project_3.get_input', return_value='n')
+    def test_rotate_key(self, input):
+        keith_data_intern_project_3.store_images('./')
+        old_key = keith_data_intern_project_3.get_key()
+        thread = keith_data_intern_project_3.rotate_key(background=True, batch_size=1)
+        thread.join()
+        self.assertNotEqual(old_key, keith_data_intern_project_3.get_key())
+        new_cipher = Fernet(keith_data_intern_project_3.get_key())
+        blobs = BlobStore(keith_data_intern_project_3.BLOB_DIRECTORY)
+        for code in keith_data_intern_project_3.get_dataframe()['image_code']:
+            self.assertTrue(new_cipher.decrypt(blobs.read(code)))
+            self.assertTrue(new_cipher.decrypt(blobs.read_derivative(code, 'thumbnail')))
+            self.assertTrue(new_cipher.decrypt(blobs.read_features(code)))
+
+    def test_externalize_images(self):
+        self.write_rows()
+        frame = pd.read_csv(keith_data_intern_project_3.DATA_FILENAME, dtype=str)
+        token = keith_data_intern_project_3.encrypt_file('./best_image.png', 'png')
+        frame.loc[0, 'image_code'] = str(token) # the b'...' form older versions wrote
+        frame.loc[1, 'image_code'] = token.decode('ascii')
+        frame.to_csv(keith_data_intern_project_3.DATA_FILENAME)
+        self.assertEqual(2, keith_data_intern_project_3.externalize_images())
+        codes = keith_data_intern_project_3.get_dataframe()['image_code'].to_list()
+        self.assertEqual(codes[0], codes[1])
+        self.assertTrue(keith_data_intern_project_3.get_dataframe()['image_hash'].isna().all()) # not a file hash
+        self.assertEqual(0, keith_data_intern_project_3.externalize_images())
+
+    def test_store_images_parallel(self):
+        directory = os.path.join(self.tempdir.name, 'images')
+        os.mkdir(directory)
+        files = []
+        for i in range(6):
+            files.append(os.path.join(directory, 'image_%d.png' % i))
+            shutil.copy('./best_image.png' if i % 2 else './first_dog.jpg', files[-1])
+        metadata = {file: {'image_keywords': ['dog ', ' n%d' % i], 'image_access': 'public'}
+                    for i, file in enumerate(files)}
+        files.append(os.path.join(directory, 'image_6.png'))
+        cv2.imwrite(files[-1], np.arange(64 * 64, dtype=np.uint8).reshape(64, 64))
+        metadata[files[-1]] = {'image_keywords': 'dog'}
+        with keith_data_intern_project_3.get_storage() as storage:
+            stored = keith_data_intern_project_3.ingest_images(storage, files, metadata, workers=2, batch_size=2)
+        self.assertEqual(3, stored) # copies of the same file are only stored once
+        result = keith_data_intern_project_3.get_dataframe()
+        self.assertListEqual(['image_0', 'image_1', 'image_6'], result['image_name'].to_list())
+        self.assertListEqual(['dog,n0', 'dog,n1', 'dog'], result['image_keywords'].to_list())
+        self.assertEqual(3, len(set(result['image_code'])))
+
+    @patch('keith_data_intern_project_3.get_input', return_value='y')
+    def test_store_images_collects_metadata_first(self, input):
+        keith_data_intern_project_3.store_images('./', workers=2)
+        result = keith_data_intern_project_3.get_dataframe()
+        self.assertListEqual(['public', 'public'], result['image_access'].to_list())
+
+    def write_manifest(self, name, lines):
+        path = os.path.join(self.tempdir.name, name)
+        with open(path, 'w') as manifest_file:
+            manifest_file.write('\n'.join(lines) + '\n')
+        return path
+
+    def test_import_manifest_csv(self):
+        for name in ['a.png', 'b.png', 'c.jpg']:
+            shutil.copy('./best_image.png' if name.endswith('png') else './first_dog.jpg',
+                        os.path.join(self.tempdir.name, name))
+        manifest = self.write_manifest('manifest.csv', [
+            'path,keywords,features,access',
+            'a.png,"sunset, beach",orange,public',
+            'missing.png,x,y,public',
+            'b.png,beach,,private',
+            'c.jpg,dog,brown,',
+        ])
+        self.assertEqual(2, keith_data_intern_project_3.import_manifest(manifest, workers=1, batch_size=2))
+        result = keith_data_intern_project_3.get_dataframe()
+        self.assertListEqual(['a', 'c'], result['image_name'].to_list()) # b.png is a copy of a.png
+        self.assertListEqual(['sunset,beach', 'dog'], result['image_keywords'].to_list())
+        self.assertListEqual(['public', 'private'], result['image_access'].to_list())
+        with open(manifest + '.progress') as progress_file:
+            self.assertEqual('4', progress_file.read())
+        self.assertEqual(0, keith_data_intern_project_3.import_manifest(manifest, workers=1))
+
+    def test_import_manifest_resumes(self):
+        for name in ['a.png', 'b.png', 'c.png']:
+            shutil.copy('./best_image.png', os.path.join(self.tempdir.name, name))
+        manifest = self.write_manifest('manifest.jsonl', [
+            json.dumps({'path': name, 'keywords': ['dog', name]}) for name in ['a.png', 'b.png', 'c.png']
+        ])
+        with open(manifest + '.progress', 'w') as progress_file:
+            progress_file.write('2') # a previous run committed the first two entries
+        self.assertEqual(1, keith_data_intern_project_3.import_manifest(manifest, workers=2))
+        result = keith_data_intern_project_3.get_dataframe()
+        self.assertListEqual(['c'], result['image_name'].to_list())
+        self.assertListEqual(['dog,c.png'], result['image_keywords'].to_list())
+
+if __name__ == '__main__':
+    unittest.main()